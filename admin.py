@@ -1,12 +1,19 @@
+from sqlalchemy.exc import IntegrityError
+
 from database import SessionLocal
 from models import User
-from services import hash
+from services import bcrypt_context
 
 def initialize_admin():
-    db = SessionLocal()
-    admin_user = db.query(User).filter(User.name == 'admin').first()
-    
-    if not admin_user:
-        admin = User(name='admin', password=hash('123'), isAdmin=True, balance=1000000000)
-        db.add(admin)
-        db.commit()
\ No newline at end of file
+    with SessionLocal() as db:
+        admin_user = db.query(User).filter(User.name == 'admin').first()
+
+        if not admin_user:
+            admin = User(name='admin', password=bcrypt_context.hash('123'), isAdmin=True, balance=1000000000)
+            db.add(admin)
+
+            try:
+                db.commit()
+            except IntegrityError:
+                # Администратора одновременно создал другой процесс
+                db.rollback()
@@ -0,0 +1,169 @@
+from fastapi import Depends, HTTPException
+from fastapi.responses import ORJSONResponse
+from starlette.requests import HTTPConnection
+from functools import lru_cache
+from jose import jwt, JWTError
+import math
+import os
+import time
+
+import database
+import metrics
+from services import SECRET_KEY, ALGORITHM
+
+# Контроль нагрузки внутри воркера.
+#   AdmissionMiddleware — быстрый отказ 503 для всех маршрутов, когда воркер перегружен:
+#     слишком много запросов ещё без ответа или пул соединений БД заставляет ждать.
+#   limit(...) — зависимость роутера: ограничение одновременных запросов на каждый маршрут (503)
+#     и token bucket на клиента (429). Клиент — пользователь из токена, без токена — IP.
+#     Работает только вместе с AdmissionMiddleware, который освобождает занятые места.
+# Всё состояние меняется только в потоке цикла событий, поэтому блокировки не нужны.
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "True").lower() in ("1", "true", "yes")
+# Запросы, по которым ещё не начат ответ; потоковые ответы (SSE) перестают считаться после заголовков
+ADMISSION_MAX_PENDING = int(os.getenv("ADMISSION_MAX_PENDING", "256"))
+# Отказ, если последнее ожидание соединения из пула дольше этого (секунды) и было не раньше ADMISSION_POOL_WINDOW назад
+ADMISSION_MAX_POOL_WAIT = float(os.getenv("ADMISSION_MAX_POOL_WAIT", "1"))
+ADMISSION_POOL_WINDOW = float(os.getenv("ADMISSION_POOL_WINDOW", "1"))
+ADMISSION_RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", "1"))
+# Предел числа клиентов с корзинами; при переполнении вытесняются самые старые
+ADMISSION_MAX_CLIENTS = int(os.getenv("ADMISSION_MAX_CLIENTS", "100000"))
+# Мониторинг не должен отваливаться вместе с перегруженным API
+ADMISSION_EXEMPT = ('/metrics',)
+
+pending = 0
+# 'метод шаблон маршрута' -> запросы в обработке
+active: dict[str, int] = {}
+# (роутер, клиент) -> (токены, момент обновления)
+buckets: dict[tuple, tuple[float, float]] = {}
+
+def overloaded() -> str | None:
+    if pending >= ADMISSION_MAX_PENDING:
+        return "Server is overloaded"
+
+    at, waited = database.last_pool_wait
+    if waited >= ADMISSION_MAX_POOL_WAIT and time.monotonic() - at <= ADMISSION_POOL_WINDOW:
+        return "Database is overloaded"
+
+    return None
+
+# Снимает запрос со счётчика маршрута, на который его пропустил limit()
+def finish(scope):
+    route = scope.pop('admission_route', None)
+
+    if route is not None:
+        active[route] -= 1
+        if not active[route]:
+            del active[route]
+
+class AdmissionMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        global pending
+
+        if not ADMISSION_ENABLED or scope['type'] != 'http' or scope['path'] in ADMISSION_EXEMPT:
+            return await self.app(scope, receive, send)
+
+        reason = overloaded()
+
+        if reason is not None:
+            metrics.admission_shed.inc()
+            response = ORJSONResponse({"detail": reason}, status_code=503, headers={"Retry-After": str(ADMISSION_RETRY_AFTER)})
+            return await response(scope, receive, send)
+
+        pending += 1
+        counted = True
+
+        # Запрос освобождает места с началом ответа: поток SSE не держит их, пока открыт
+        def release():
+            global pending
+            nonlocal counted
+
+            if counted:
+                counted = False
+                pending -= 1
+                finish(scope)
+
+        async def send_with_release(message):
+            if message['type'] == 'http.response.start':
+                release()
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_release)
+        finally:
+            release()
+
+# Подпись проверяется, иначе случайный заголовок Authorization давал бы новую корзину на каждый запрос.
+# Недействительный токен не ошибка здесь: такой клиент считается по IP, а 401 вернёт сам маршрут.
+@lru_cache(maxsize=4096)
+def token_client(token: str) -> str | None:
+    try:
+        id = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM], options={'verify_exp': False}).get('id')
+    except JWTError:
+        return None
+    return f'user:{id}' if id is not None else None
+
+def client_key(connection: HTTPConnection) -> str:
+    scheme, _, token = connection.headers.get('authorization', '').partition(' ')
+
+    if scheme.lower() == 'bearer' and token:
+        key = token_client(token)
+        if key is not None:
+            return key
+
+    return f'ip:{connection.client.host}' if connection.client is not None else 'ip:'
+
+# Возвращает 0, если токен взят, иначе секунды до появления следующего
+def take(key: tuple, rate: float, burst: float) -> float:
+    now = time.monotonic()
+    state = buckets.pop(key, None)
+    tokens = burst if state is None else min(burst, state[0] + (now - state[1]) * rate)
+
+    if len(buckets) >= ADMISSION_MAX_CLIENTS:
+        del buckets[next(iter(buckets))]
+
+    # Повторная вставка переносит клиента в конец, так что вытесняются давно не приходившие
+    if tokens >= 1:
+        buckets[key] = (tokens - 1, now)
+        return 0
+    buckets[key] = (tokens, now)
+    return (1 - tokens) / rate
+
+# Ограничения для роутера: dependencies=[limit('rent', concurrency=200, rate=20, burst=40)].
+# concurrency — одновременных запросов на каждый маршрут роутера, rate и burst — запросов в секунду
+# и запас корзины одного клиента на весь роутер. Значения переопределяются переменными окружения
+# ADMISSION_<ИМЯ>_CONCURRENCY, ADMISSION_<ИМЯ>_RATE, ADMISSION_<ИМЯ>_BURST; 0 отключает ограничение.
+def limit(name: str, concurrency: int = 0, rate: float = 0, burst: float = 0):
+    prefix = f"ADMISSION_{name.upper()}_"
+    concurrency = int(os.getenv(prefix + "CONCURRENCY", concurrency))
+    rate = float(os.getenv(prefix + "RATE", rate))
+    burst = max(1.0, float(os.getenv(prefix + "BURST", burst or rate)))
+
+    # WebSocket пропускается: исключение в его зависимости не закрывает соединение, у подписок свои пределы.
+    # Место на маршруте освобождает AdmissionMiddleware, когда начинается ответ
+    async def admit(connection: HTTPConnection):
+        if not ADMISSION_ENABLED or connection.scope['type'] != 'http':
+            return
+
+        if rate > 0:
+            wait = take((name, client_key(connection)), rate, burst)
+
+            if wait > 0:
+                metrics.admission_throttled.inc()
+                raise HTTPException(status_code=429, detail="Too many requests", headers={"Retry-After": str(math.ceil(wait))})
+
+        if concurrency <= 0:
+            return
+
+        route = f"{connection.scope['method']} {connection.scope['route'].path}"
+
+        if active.get(route, 0) >= concurrency:
+            metrics.admission_shed.inc()
+            raise HTTPException(status_code=503, detail="Too many concurrent requests", headers={"Retry-After": str(ADMISSION_RETRY_AFTER)})
+
+        active[route] = active.get(route, 0) + 1
+        connection.scope['admission_route'] = route
+
+    return Depends(admit)
@@ -0,0 +1,186 @@
+from sqlalchemy import delete, insert, text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from datetime import date, datetime, timedelta, timezone
+import asyncio
+import logging
+import os
+
+import querystats
+from database import run_cpu, run_in_session
+from locks import ANALYTICS_LOCK_KEY
+from models import RentDaily, FleetDaily, AnalyticsBackfill, FindAnalytics
+from scheduler import utc
+
+logger = logging.getLogger(__name__)
+
+# Сводки для /api/Admin/Analytics: таблицы rent_daily и fleet_daily пересчитываются по дням,
+# поэтому запросы аналитики читают O(дней) строк, а не всю таблицу rent.
+# Раз в ANALYTICS_REFRESH_INTERVAL секунд пересчитываются последние ANALYTICS_REFRESH_DAYS дней (завершения
+# и продления аренд меняют в основном их); более старые дни после ручной правки аренд — через POST /Refresh.
+ANALYTICS_REFRESH_INTERVAL = float(os.getenv("ANALYTICS_REFRESH_INTERVAL", "60"))
+ANALYTICS_REFRESH_DAYS = int(os.getenv("ANALYTICS_REFRESH_DAYS", "2"))
+# Завершённые аренды, начатые больше чем за столько дней до пересчитываемого периода, в него не попадают (активные — всегда)
+ANALYTICS_MAX_RENT_DAYS = int(os.getenv("ANALYTICS_MAX_RENT_DAYS", "31"))
+DAY = timedelta(days=1)
+
+task: asyncio.Task | None = None
+stopping: asyncio.Event | None = None
+
+def today() -> date:
+    return datetime.now(timezone.utc).date()
+
+def day_start(day: date) -> datetime:
+    return datetime(day.year, day.month, day.day, tzinfo=timezone.utc)
+
+# (день, тип, владелец) -> [аренд, выручка, секунд аренды] по дням [first, last]
+def rollup(rows, first: date, last: date, now: datetime) -> dict:
+    totals = {}
+
+    for row in rows:
+        start = utc(row.startTime).astimezone(timezone.utc)
+        # Активная аренда учитывается до текущего момента, а не до оплаченного конца
+        end = min(utc(row.endTime), now) if row.endTime is not None else now
+        type, owner = row.transportType or '', row.user_id or 0
+
+        if first <= start.date() <= last:
+            current = totals.setdefault((start.date(), type, owner), [0, 0.0, 0.0])
+            current[0] += 1
+            current[1] += row.finalPrice or 0.0
+
+        day = max(start.date(), first)
+
+        while day <= last and day_start(day) < end:
+            seconds = (min(end, day_start(day) + DAY) - max(start, day_start(day))).total_seconds()
+
+            if seconds > 0:
+                totals.setdefault((day, type, owner), [0, 0.0, 0.0])[2] += seconds
+            day += DAY
+
+    return totals
+
+# Сводка по дням из уже посчитанных строк: (день, тип) -> (машин, секунд аренды)
+def utilization(first: date, last: date, type: str, db: Session):
+    rented = {(row.day, row.transportType): row.seconds for row in FindAnalytics.rented_seconds(first, last, type, db)}
+    now = datetime.now(timezone.utc)
+    result = []
+
+    for day, transportType, vehicles in FindAnalytics.fleet_by_day(first, last, type, db):
+        seconds = rented.get((day, transportType), 0.0)
+        # Сегодняшний день ещё не закончился: доля считается от прошедшего времени
+        period = min(DAY, max(now - day_start(day), timedelta(seconds=1))).total_seconds()
+        result.append({
+            'day': day,
+            'transportType': transportType,
+            'vehicles': vehicles,
+            'rentedHours': round(seconds / 3600, 3),
+            'utilization': round(seconds / (vehicles * period), 4) if vehicles else 0.0,
+        })
+
+    return result
+
+def active_rents(db: Session):
+    by_type = {type or '': count for type, count in FindAnalytics.active_rents(db)}
+    return {'total': sum(by_type.values()), 'byType': by_type}
+
+# Пересчитывает дни [first, last] одной транзакцией; None — пересчёт уже идёт в другом воркере
+def rebuild(first: date, last: date, db: Session, wait: bool = False):
+    if db.bind.dialect.name == 'postgresql':
+        if wait:
+            db.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': ANALYTICS_LOCK_KEY})
+        elif not db.execute(text('SELECT pg_try_advisory_xact_lock(:key)'), {'key': ANALYTICS_LOCK_KEY}).scalar():
+            db.rollback()
+            return None
+
+    now = datetime.now(timezone.utc)
+    rows = FindAnalytics.overlapping(day_start(first), day_start(last) + DAY, ANALYTICS_MAX_RENT_DAYS, db)
+    totals = run_cpu(rollup, rows, first, last, now)
+
+    db.execute(delete(RentDaily).where(RentDaily.day.between(first, last)).execution_options(synchronize_session=False))
+    if totals:
+        db.execute(insert(RentDaily), [
+            {'day': day, 'transportType': type, 'owner_id': owner, 'rents': rents, 'revenue': revenue, 'rented_seconds': seconds}
+            for (day, type, owner), (rents, revenue, seconds) in totals.items()])
+
+    # Известен только текущий размер парка: он записывается за сегодня при каждом пересчёте, и прошедший день
+    # сохраняет последнее значение. Дни до первого запуска остаются без парка, загрузка за них не отдаётся
+    if first <= now.date() <= last:
+        db.execute(delete(FleetDaily).where(FleetDaily.day == now.date()))
+        fleet = FindAnalytics.fleet(db)
+
+        if fleet:
+            db.execute(insert(FleetDaily), [{'day': now.date(), 'transportType': type, 'vehicles': count} for type, count in fleet])
+
+    db.commit()
+    return (last - first).days + 1
+
+# Пересчёт длинного периода кусками, чтобы не держать все аренды в памяти.
+# Одинаковые запросы по кускам не учитываются в статистике запросов, иначе они выглядели бы как N+1
+def rebuild_range(first: date, last: date, db: Session):
+    days = 0
+    token = querystats.current.set(None)
+
+    try:
+        while first <= last:
+            end = min(last, first + DAY * (ANALYTICS_MAX_RENT_DAYS - 1))
+            days += rebuild(first, end, db, wait=True)
+            first = end + DAY
+    finally:
+        querystats.current.reset(token)
+
+    return days
+
+# Первый запуск: сводки аренд строятся за всю историю, парк — только за сегодня.
+# Завершение отмечается строкой в analytics_backfill, а не выводится из самих сводок: при пустом парке их может не быть
+def backfill(db: Session):
+    if FindAnalytics.backfilled(db):
+        return 0
+
+    started = FindAnalytics.first_rent_start(db)
+    first = utc(started).astimezone(timezone.utc).date() if started is not None else today()
+    days = rebuild_range(first, today(), db)
+
+    try:
+        db.execute(insert(AnalyticsBackfill).values(id=1, completed_at=datetime.now(timezone.utc)))
+        db.commit()
+    except IntegrityError:
+        # Другой воркер успел построить сводки одновременно
+        db.rollback()
+
+    return days
+
+async def refresh():
+    last = today()
+    await run_in_session(rebuild, last - DAY * (ANALYTICS_REFRESH_DAYS - 1), last)
+
+async def run():
+    try:
+        days = await run_in_session(backfill)
+        if days:
+            logger.info("Analytics rollups built for %s days", days)
+    except Exception:
+        logger.exception("Analytics backfill failed")
+
+    while not stopping.is_set():
+        try:
+            await refresh()
+        except Exception:
+            logger.exception("Analytics refresh failed")
+
+        try:
+            await asyncio.wait_for(stopping.wait(), ANALYTICS_REFRESH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+def start():
+    global task, stopping
+    stopping = asyncio.Event()
+    task = asyncio.get_running_loop().create_task(run())
+
+async def stop():
+    global task
+
+    if task is not None:
+        stopping.set()
+        await task
+        task = None
@@ -0,0 +1,284 @@
+from sqlalchemy import event, func, select
+from sqlalchemy.orm import Session
+from bisect import bisect_left, insort
+import anyio
+import asyncio
+import hashlib
+import logging
+import os
+import orjson
+
+from database import engine, run_in_session
+from models import Transport, TRANSPORT_COLUMNS
+
+logger = logging.getLogger(__name__)
+
+# Снимок доступного транспорта для публичной карты: /api/Rent/Transport отвечает из памяти.
+# Изменения транспорта отмечаются через changed(); на postgres другие воркеры узнают о них
+# через LISTEN/NOTIFY, а снимок дочитывает из БД только изменившиеся строки.
+CHANNEL = 'transport_changed'
+# Полная перезагрузка снимка не реже этого интервала — страховка от потерянных уведомлений
+AVAILABILITY_MAX_AGE = float(os.getenv("AVAILABILITY_MAX_AGE", "60"))
+LISTEN_RETRY = 5.0
+# Длинный список id в NOTIFY заменяется полной перезагрузкой (предел payload — 8000 байт)
+NOTIFY_MAX_PAYLOAD = 7000
+
+SNAPSHOT_COLUMNS = TRANSPORT_COLUMNS + (Transport.geohash,)
+RESPONSE_FIELDS = [column.name for column in TRANSPORT_COLUMNS]
+
+version = 0
+# id -> (строка, готовый JSON объекта)
+entries: dict[int, tuple] = {}
+# Отсортированные (geohash, id) для поиска по префиксам ячеек
+keys: list[tuple[str, int]] = []
+dirty: set[int] = set()
+reload_all = True
+# Подписчики на изменения снимка: callback(changes), changes — список (старая строка, новая строка),
+# None вместо строки означает, что транспорта в снимке не было или больше нет
+listeners: list = []
+
+loop: asyncio.AbstractEventLoop | None = None
+wakeup: asyncio.Event | None = None
+task: asyncio.Task | None = None
+listener = None
+
+# Снимок запущен и загружен хотя бы раз
+def ready() -> bool:
+    return task is not None and version > 0
+
+def mark(ids):
+    global reload_all
+
+    if ids is None:
+        reload_all = True
+    else:
+        dirty.update(ids)
+    wakeup.set()
+
+# Отметка из любого потока; до старта снимка ничего не делает
+def mark_threadsafe(ids):
+    if loop is not None:
+        loop.call_soon_threadsafe(mark, ids)
+
+# Вызывается сервисами до commit: ids изменившегося транспорта (None — всё сразу).
+# Локальный снимок обновляется после commit, другие воркеры получают NOTIFY в той же транзакции.
+def changed(db: Session, ids=None):
+    pending = db.info.setdefault('transport_changed', set())
+
+    if ids is None or None in pending:
+        pending.clear()
+        pending.add(None)
+    else:
+        pending.update(ids)
+
+    if db.bind.dialect.name == 'postgresql':
+        payload = '*' if ids is None else ','.join(map(str, ids))
+        db.execute(select(func.pg_notify(CHANNEL, payload if len(payload) <= NOTIFY_MAX_PAYLOAD else '*')))
+
+@event.listens_for(Session, 'after_commit')
+def after_commit(session):
+    pending = session.info.pop('transport_changed', None)
+
+    if pending:
+        mark_threadsafe(None if None in pending else pending)
+
+@event.listens_for(Session, 'after_rollback')
+def after_rollback(session):
+    session.info.pop('transport_changed', None)
+
+def entry(row):
+    data = {name: row._mapping[name] for name in RESPONSE_FIELDS}
+    return row, orjson.dumps(data)
+
+def load_all(db: Session):
+    return db.execute(select(*SNAPSHOT_COLUMNS).filter(Transport.canBeRented == True)).all()
+
+def load_ids(ids, db: Session):
+    return db.execute(select(*SNAPSHOT_COLUMNS).filter(Transport.id.in_(ids), Transport.canBeRented == True)).all()
+
+def remove(id: int):
+    old = entries.pop(id, None)
+
+    if old is not None and old[0].geohash is not None:
+        key = (old[0].geohash, id)
+        index = bisect_left(keys, key)
+        if index < len(keys) and keys[index] == key:
+            del keys[index]
+
+def put(row):
+    remove(row.id)
+    entries[row.id] = entry(row)
+
+    if row.geohash is not None:
+        insort(keys, (row.geohash, row.id))
+
+def current(id: int):
+    found = entries.get(id)
+    return found[0] if found is not None else None
+
+def publish(changes):
+    if not changes:
+        return
+
+    for callback in listeners:
+        try:
+            callback(changes)
+        except Exception:
+            logger.exception("Availability listener failed")
+
+async def refresh():
+    global version, reload_all, entries, keys
+
+    if reload_all:
+        reload_all = False
+        dirty.clear()
+        rows = await run_in_session(load_all)
+        previous = entries
+        entries = {row.id: entry(row) for row in rows}
+        keys = sorted((row.geohash, row.id) for row in rows if row.geohash is not None)
+        version += 1
+
+        if listeners:
+            changes = [(old[0], None) for id, old in previous.items() if id not in entries]
+            for id, (new, _) in entries.items():
+                old = previous.get(id)
+                if old is None or old[0] != new:
+                    changes.append((old[0] if old is not None else None, new))
+            publish(changes)
+        return
+
+    if not dirty:
+        return
+
+    ids = list(dirty)
+    dirty.clear()
+    rows = await run_in_session(load_ids, ids)
+    previous = {id: current(id) for id in ids}
+    found = {new.id for new in rows}
+
+    for id in ids:
+        if id not in found:
+            remove(id)
+
+    for new in rows:
+        put(new)
+
+    version += 1
+    publish([(previous[id], current(id)) for id in ids if previous[id] != current(id)])
+
+# Тот же интерфейс, что и FindTransport.get_available, но без БД
+def available(type: str, cells):
+    if cells is None:
+        rows = [row for row, _ in entries.values()]
+    else:
+        rows = []
+        for cell in sorted(set(cells)):
+            start = bisect_left(keys, (cell,))
+            end = bisect_left(keys, (cell + '~',))
+            rows.extend(entries[id][0] for _, id in keys[start:end])
+
+    if type is not None:
+        rows = [row for row in rows if row.transportType == type]
+
+    return rows
+
+# Для поиска в пуле потоков: снимок меняется только в цикле событий, поэтому и читается там же
+def available_from_thread(type: str, cells):
+    return anyio.from_thread.run_sync(available, type, cells)
+
+# Готовый JSON строки; строка, которую снимок успел заменить или убрать за время поиска, сериализуется заново
+def serialized(row):
+    found = entries.get(row.id)
+    return found[1] if found is not None and found[0] is row else entry(row)[1]
+
+# Тело ответа собирается из заранее сериализованных объектов; ETag — хэш тела,
+# поэтому он совпадает у всех воркеров с одинаковым снимком
+def render(rows):
+    body = b'[' + b','.join(serialized(row) for row in rows) + b']'
+    return body, '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+def on_notify(connection):
+    try:
+        connection.poll()
+    except Exception:
+        logger.exception("Availability listener lost connection")
+        stop_listening()
+        loop.call_later(LISTEN_RETRY, listen)
+        return
+
+    while connection.notifies:
+        payload = connection.notifies.pop(0).payload
+        mark(None if payload == '*' else [int(id) for id in payload.split(',') if id])
+
+# Отдельное соединение вне пула, только для LISTEN
+def listen():
+    global listener
+
+    if engine.dialect.name != 'postgresql' or loop is None:
+        return
+
+    try:
+        cargs, cparams = engine.dialect.create_connect_args(engine.url)
+        listener = engine.dialect.connect(*cargs, **cparams)
+        listener.autocommit = True
+        listener.cursor().execute(f'LISTEN {CHANNEL}')
+    except Exception:
+        logger.exception("Availability listener failed to connect")
+        listener = None
+        loop.call_later(LISTEN_RETRY, listen)
+        return
+
+    loop.add_reader(listener.fileno(), on_notify, listener)
+    # Уведомления, пришедшие до подписки, потеряны — перечитываем снимок целиком
+    mark(None)
+
+def stop_listening():
+    global listener
+
+    if listener is None:
+        return
+
+    try:
+        loop.remove_reader(listener.fileno())
+        listener.close()
+    except Exception:
+        pass
+    listener = None
+
+# stop() сбрасывает loop до отмены задачи: wait_for теряет отмену, если событие успело сработать
+# одновременно с ней, и тогда цикл завершается по этой проверке
+async def run():
+    while loop is not None:
+        try:
+            await refresh()
+        except Exception:
+            logger.exception("Availability refresh failed")
+            mark(None)
+            await asyncio.sleep(LISTEN_RETRY)
+            continue
+
+        try:
+            await asyncio.wait_for(wakeup.wait(), AVAILABILITY_MAX_AGE)
+        except asyncio.TimeoutError:
+            mark(None)
+        wakeup.clear()
+
+def start():
+    global loop, wakeup, task
+    loop = asyncio.get_running_loop()
+    wakeup = asyncio.Event()
+    listen()
+    task = loop.create_task(run())
+
+async def stop():
+    global loop, task
+    stop_listening()
+    loop = None
+
+    if task is not None:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        task = None
@@ -0,0 +1,87 @@
+# Сравнение пропускной способности при конкурентных запросах:
+#   blocking — синхронная сессия вызывается прямо в цикле событий (поведение до async-режима)
+#   sync     — синхронная сессия в пуле потоков (DB_ASYNC=0)
+#   async    — AsyncSession поверх asyncpg (DB_ASYNC=1)
+#
+#   python benchmarks/async_db.py --requests 2000 --concurrency 100
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+
+from bootstrap import ROOT, prepare
+
+MODES = ['blocking', 'sync', 'async']
+
+def patch_blocking():
+    import routers.admin, routers.payment, routers.rent, routers.transport, routers.user
+
+    async def run_inline(db, fn, *args, **kwargs):
+        return fn(*args, db, **kwargs)
+
+    for module in (routers.admin, routers.payment, routers.rent, routers.transport, routers.user):
+        module.run_db = run_inline
+
+async def measure(path: str, requests: int, concurrency: int):
+    import httpx
+    from main import app
+    from database import engine
+    from migrations import upgrade
+
+    upgrade(engine)
+    latencies = []
+    queue = asyncio.Queue()
+
+    for _ in range(requests):
+        queue.put_nowait(path)
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://bench') as client:
+        async def worker():
+            while not queue.empty():
+                url = queue.get_nowait()
+                started = time.perf_counter()
+                response = await client.get(url)
+                response.raise_for_status()
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'rps': round(requests / elapsed, 1),
+        'p50_ms': round(latencies[len(latencies) // 2] * 1000, 2),
+        'p99_ms': round(latencies[int(len(latencies) * 0.99) - 1] * 1000, 2),
+    }
+
+def run_mode(mode: str, args):
+    env = dict(os.environ, DB_ASYNC='1' if mode == 'async' else '0')
+    command = [sys.executable, __file__, '--child', mode, '--requests', str(args.requests),
+               '--concurrency', str(args.concurrency), '--path', args.path]
+    output = subprocess.run(command, env=env, cwd=ROOT, capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument('--path', default='/api/Rent/Transport')
+    parser.add_argument('--child')
+    args = parser.parse_args()
+
+    if args.child:
+        prepare()
+        if args.child == 'blocking':
+            patch_blocking()
+        print(json.dumps(asyncio.run(measure(args.path, args.requests, args.concurrency))))
+        return
+
+    for mode in MODES:
+        print(mode, run_mode(mode, args))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,13 @@
+# Общая подготовка прогонов, которые поднимают приложение: корень репозитория в sys.path
+# и окружение до импорта main
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def prepare():
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+
+    # Контроль нагрузки (admission.py) отбрасывал бы часть прогона — замеряется само приложение
+    os.environ.setdefault('ADMISSION_ENABLED', '0')
@@ -0,0 +1,63 @@
+# Проверка гонки при аренде: сотни параллельных запросов на один транспорт.
+# Успешной должна быть ровно одна аренда, а баланс списан ровно один раз.
+# Запускать на отдельной (тестовой) базе PostgreSQL:
+#   SQLALCHEMY_URL=postgresql://... py benchmarks/rent_race.py --requests 300
+import argparse
+import asyncio
+import uuid
+
+from bootstrap import prepare
+
+prepare()
+
+async def race(requests: int):
+    import httpx
+    from main import app
+    from database import SessionLocal, engine
+    from migrations import upgrade
+    from models import User, Transport, Rent
+    from services import bcrypt_context, create_access_token
+
+    upgrade(engine)
+    suffix = uuid.uuid4().hex[:8]
+
+    with SessionLocal() as db:
+        owner = User(name=f'race-owner-{suffix}', password=bcrypt_context.hash('race'))
+        renter = User(name=f'race-renter-{suffix}', password=bcrypt_context.hash('race'), balance=1000000)
+        db.add_all([owner, renter])
+        db.flush()
+        transport = Transport(user_id=owner.id, canBeRented=True, transportType='Scooter', identifier=f'RACE-{suffix}',
+                              latitude=55.75, longitude=37.61, minutePrice=10, dayPrice=1000)
+        db.add(transport)
+        db.commit()
+        token = create_access_token(renter)
+        transport_id, renter_id = transport.id, renter.id
+
+    headers = {'Authorization': f'Bearer {token}'}
+    body = {'rentType': 'Minutes', 'transportId': transport_id, 'duration': 10}
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://race') as client:
+        responses = await asyncio.gather(*[
+            client.post(f'/api/Rent/New/{transport_id}', json=body, headers=headers) for _ in range(requests)])
+
+    statuses = {}
+    for response in responses:
+        statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    with SessionLocal() as db:
+        rents = db.query(Rent).filter(Rent.transportId == transport_id).count()
+        balance = db.get(User, renter_id).balance
+
+    print('statuses', statuses, 'rents', rents, 'balance', balance)
+    assert statuses.get(200) == 1, 'exactly one rent must succeed'
+    assert rents == 1, 'exactly one rent row must exist'
+    assert balance == 1000000 - 100, 'balance must be debited once'
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=300)
+    args = parser.parse_args()
+    asyncio.run(race(args.requests))
+
+if __name__ == '__main__':
+    main()
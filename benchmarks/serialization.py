@@ -0,0 +1,92 @@
+# Сериализация больших списков: как раньше (ORM-объекты -> jsonable_encoder -> json)
+# и как сейчас (кортежи колонок -> orjson), плюс ORM-объекты через модель ответа pydantic.
+#
+#   python benchmarks/serialization.py --rows 10000 --repeat 20
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def seed(rows: int):
+    from sqlalchemy import insert
+    import geo
+    from database import SessionLocal
+    from models import User, Transport
+
+    with SessionLocal() as db:
+        owner = User(name='serialization-owner', password='x')
+        db.add(owner)
+        db.flush()
+        db.execute(insert(Transport), [
+            {'user_id': owner.id, 'canBeRented': True, 'transportType': 'Scooter', 'model': 'Bench', 'color': 'White',
+             'identifier': f'SER-{i}', 'description': 'bench', 'latitude': 55.75 + i * 1e-5, 'longitude': 37.61,
+             'geohash': geo.encode(55.75 + i * 1e-5, 37.61), 'minutePrice': 5, 'dayPrice': 500}
+            for i in range(rows)])
+        db.commit()
+
+def measure(fn, repeat: int):
+    timings = []
+
+    for _ in range(repeat):
+        started = time.perf_counter()
+        body = fn()
+        timings.append(time.perf_counter() - started)
+
+    return {'median_ms': round(statistics.median(timings) * 1000, 2), 'bytes': len(body)}
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.gettempdir(), 'rentapi-serialization.db')
+    if os.path.exists(path):
+        os.remove(path)
+    os.environ['SQLALCHEMY_URL'] = f'sqlite:///{path}'
+    sys.path.insert(0, ROOT)
+
+    from fastapi.encoders import jsonable_encoder
+    from fastapi.responses import JSONResponse
+    from pydantic import TypeAdapter
+    from sqlalchemy import select
+    from database import SessionLocal, engine
+    from dtos import TransportRead
+    from models import Transport, FindTransport
+    from services import list_response
+    from migrations import upgrade
+
+    upgrade(engine)
+    seed(args.rows)
+    adapter = TypeAdapter(list[TransportRead])
+
+    def orm_jsonable_encoder():
+        with SessionLocal() as db:
+            transports = db.execute(select(Transport).limit(args.rows)).scalars().all()
+            return JSONResponse(jsonable_encoder(transports)).body
+
+    def orm_response_model():
+        with SessionLocal() as db:
+            transports = db.execute(select(Transport).limit(args.rows)).scalars().all()
+            return JSONResponse(adapter.dump_python(adapter.validate_python(transports), mode='json')).body
+
+    def columns_orjson():
+        with SessionLocal() as db:
+            return list_response(FindTransport.get_transports(0, args.rows, 'All', db)).body
+
+    results = {
+        'orm + jsonable_encoder': measure(orm_jsonable_encoder, args.repeat),
+        'orm + response_model': measure(orm_response_model, args.repeat),
+        'columns + orjson': measure(columns_orjson, args.repeat),
+    }
+    baseline = results['orm + jsonable_encoder']['median_ms']
+
+    for name, result in results.items():
+        print(f"{name:24} {result['median_ms']:9.2f} ms  x{baseline / result['median_ms']:.1f}  {result['bytes']} bytes")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,249 @@
+# Нагрузочный прогон основных сценариев на настоящем main:app (httpx ASGITransport, без сети)
+# поверх заранее заполненной базы. Для каждого сценария считаются p50/p95/p99 и запросы в секунду.
+#
+#   python benchmarks/suite.py --fleet 5000 --users 500                # sqlite во временном файле
+#   SQLALCHEMY_URL=postgresql://... python benchmarks/suite.py         # локальный PostgreSQL (отдельная база!)
+#   python benchmarks/suite.py --save                                  # записать базовую линию
+#   python benchmarks/suite.py --check                                 # сравнить с базовой линией, код 1 при регрессии
+#
+# Базовые линии лежат в benchmarks/baselines/<диалект>.json и зависят от машины:
+# перезаписывайте их на той же машине, где потом запускается --check.
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+
+from bootstrap import ROOT, prepare
+
+BASELINES = os.path.join(ROOT, 'benchmarks', 'baselines')
+SCENARIOS = ['signup', 'signin', 'radius', 'rent_cycle', 'admin_lists']
+PASSWORD = 'bench'
+
+# Центр и разброс парка (градусы): примерно 20×20 км
+CENTER = (55.75, 37.61)
+SPREAD = 0.09
+
+def percentile(values: list[float], q: float) -> float:
+    return values[min(len(values) - 1, max(0, round(q * len(values)) - 1))]
+
+def summary(latencies: list[float], elapsed: float) -> dict:
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'rps': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+    }
+
+def seed(fleet: int, users: int, rng: random.Random):
+    from sqlalchemy import insert, select
+    import geo
+    from database import SessionLocal
+    from models import User, Transport
+    from services import bcrypt_context
+
+    prefix = f'bench-{uuid.uuid4().hex[:8]}'
+    password = bcrypt_context.hash(PASSWORD)
+
+    with SessionLocal() as db:
+        db.execute(insert(User), [
+            {'name': f'{prefix}-{i}', 'password': password, 'isAdmin': i == 0, 'balance': 10 ** 9}
+            for i in range(users)])
+        owners = db.execute(select(User.id).filter(User.name.startswith(prefix)).order_by(User.id)).scalars().all()
+
+        transports = []
+        for i in range(fleet):
+            latitude = CENTER[0] + rng.uniform(-SPREAD, SPREAD)
+            longitude = CENTER[1] + rng.uniform(-SPREAD, SPREAD)
+            transports.append({
+                'user_id': owners[i % len(owners)], 'canBeRented': True, 'transportType': rng.choice(['Car', 'Bike', 'Scooter']),
+                'model': 'Bench', 'color': 'White', 'identifier': f'{prefix}-T{i}', 'description': None,
+                'latitude': latitude, 'longitude': longitude, 'geohash': geo.encode(latitude, longitude),
+                'minutePrice': 5, 'dayPrice': 500})
+        db.execute(insert(Transport), transports)
+        db.commit()
+
+        vehicles = db.execute(select(Transport.id, Transport.user_id).filter(Transport.identifier.startswith(prefix)).order_by(Transport.id)).all()
+
+    return prefix, owners, vehicles
+
+def token_for(user_id: int, admin: bool = False) -> str:
+    from types import SimpleNamespace
+    from services import create_access_token
+
+    return create_access_token(SimpleNamespace(id=user_id, isAdmin=admin, disabled=False))
+
+# Каждая операция сценария — корутина op(client, worker, i), которая возвращает False при неожиданном ответе
+def build_scenarios(prefix: str, owners: list[int], vehicles: list, rng: random.Random):
+    admin = {'Authorization': f'Bearer {token_for(owners[0], admin=True)}'}
+    renters = owners[1:]
+    headers = {user_id: {'Authorization': f'Bearer {token_for(user_id)}'} for user_id in renters}
+
+    async def signup(client, worker, i):
+        response = await client.post('/api/Account/SignUp', json={'name': f'{prefix}-new-{worker}-{i}', 'password': PASSWORD})
+        return response.status_code == 200
+
+    async def signin(client, worker, i):
+        name = f'{prefix}-{1 + (worker * 7919 + i) % len(renters)}'
+        response = await client.post('/api/Account/SignIn', data={'username': name, 'password': PASSWORD})
+        return response.status_code == 200
+
+    async def radius(client, worker, i):
+        params = {
+            'latitude': CENTER[0] + rng.uniform(-SPREAD, SPREAD), 'longitude': CENTER[1] + rng.uniform(-SPREAD, SPREAD),
+            'radius': 1000}
+        response = await client.get('/api/Rent/Transport', params=params)
+        return response.status_code == 200
+
+    async def rent_cycle(client, worker, i):
+        # Номер операции уникален, поэтому параллельные операции берут разные транспорты;
+        # свой транспорт арендовать нельзя — тогда арендатором становится следующий пользователь
+        transport_id, owner_id = vehicles[i % len(vehicles)]
+        user_id = renters[worker % len(renters)]
+        if user_id == owner_id:
+            user_id = renters[(worker + 1) % len(renters)]
+
+        response = await client.post(f'/api/Rent/New/{transport_id}', headers=headers[user_id],
+                                     json={'rentType': 'Minutes', 'transportId': transport_id, 'duration': 10})
+        if response.status_code != 200:
+            return False
+
+        rent_id = response.json()['id']
+        response = await client.post(f'/api/Rent/End/{rent_id}', headers=headers[user_id], params={'latitude': CENTER[0], 'longitude': CENTER[1]})
+        return response.status_code == 200
+
+    async def admin_lists(client, worker, i):
+        path = '/api/Admin/Account/' if i % 2 else '/api/Admin/Transport/'
+        response = await client.get(path, headers=admin, params={'cursor': '', 'count': 100})
+        return response.status_code == 200
+
+    return {'signup': signup, 'signin': signin, 'radius': radius, 'rent_cycle': rent_cycle, 'admin_lists': admin_lists}
+
+async def run_scenario(client, op, requests: int, concurrency: int, warmup: int):
+    for i in range(warmup):
+        await op(client, concurrency + i, -1 - i)
+
+    latencies = []
+    failures = 0
+    counter = iter(range(requests))
+
+    async def worker(number):
+        nonlocal failures
+
+        for i in counter:
+            started = time.perf_counter()
+            ok = await op(client, number, i)
+            latencies.append(time.perf_counter() - started)
+            failures += not ok
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker(number) for number in range(concurrency)])
+    result = summary(latencies, time.perf_counter() - started)
+    result['failures'] = failures
+    return result
+
+async def run(args):
+    import httpx
+    from main import app
+    from database import engine
+    from migrations import upgrade
+
+    upgrade(engine)
+    rng = random.Random(args.seed)
+    prefix, owners, vehicles = seed(args.fleet, args.users, rng)
+    scenarios = build_scenarios(prefix, owners, vehicles, rng)
+
+    await app.router.startup()
+    results = {}
+
+    try:
+        # Ошибка приложения — это 500 и неудачный запрос сценария, а не обрыв всего прогона
+        transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+        async with httpx.AsyncClient(transport=transport, base_url='http://bench') as client:
+            for name in args.scenarios:
+                # Сценарии с bcrypt на порядки медленнее остальных
+                requests = max(1, args.requests // 10) if name in ('signup', 'signin') else args.requests
+                results[name] = await run_scenario(client, scenarios[name], requests, args.concurrency, args.warmup)
+                print(name, results[name], file=sys.stderr)
+    finally:
+        await app.router.shutdown()
+
+    return {
+        'dialect': engine.dialect.name,
+        'params': {'fleet': args.fleet, 'users': args.users, 'requests': args.requests, 'concurrency': args.concurrency, 'db_async': os.getenv('DB_ASYNC', '0')},
+        'results': results,
+    }
+
+# Регрессия: p95 вырос или пропускная способность упала больше чем на tolerance.
+# Сценарий без базовой линии тоже ошибка: иначе --check молча пропускал бы его
+def compare(report: dict, baseline: dict, tolerance: float) -> list[str]:
+    problems = []
+
+    if report['params'] != baseline['params']:
+        problems.append(f"params differ from baseline: {report['params']} != {baseline['params']}")
+        return problems
+
+    for name, result in report['results'].items():
+        reference = baseline['results'].get(name)
+
+        if result['failures']:
+            problems.append(f'{name}: {result["failures"]} failed requests')
+        if reference is None:
+            problems.append(f'{name}: no baseline, record one with --save')
+            continue
+        if result['p95_ms'] > reference['p95_ms'] * (1 + tolerance):
+            problems.append(f'{name}: p95 {result["p95_ms"]}ms > baseline {reference["p95_ms"]}ms')
+        if result['rps'] < reference['rps'] * (1 - tolerance):
+            problems.append(f'{name}: {result["rps"]} req/s < baseline {reference["rps"]} req/s')
+
+    return problems
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--fleet', type=int, default=5000)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument('--baseline', help='путь к файлу базовой линии (по умолчанию benchmarks/baselines/<диалект>.json)')
+    parser.add_argument('--save', action='store_true')
+    parser.add_argument('--check', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args()
+
+    if not os.getenv('SQLALCHEMY_URL'):
+        path = os.path.join(tempfile.gettempdir(), 'rentapi-bench.db')
+        if os.path.exists(path):
+            os.remove(path)
+        os.environ['SQLALCHEMY_URL'] = f'sqlite:///{path}'
+
+    prepare()
+    report = asyncio.run(run(args))
+    print(json.dumps(report, indent=2))
+
+    baseline_path = args.baseline or os.path.join(BASELINES, f"{report['dialect']}.json")
+
+    if args.save:
+        os.makedirs(os.path.dirname(baseline_path), exist_ok=True)
+        with open(baseline_path, 'w') as file:
+            json.dump(report, file, indent=2)
+            file.write('\n')
+
+    if args.check:
+        with open(baseline_path) as file:
+            problems = compare(report, json.load(file), args.tolerance)
+
+        for problem in problems:
+            print('REGRESSION', problem, file=sys.stderr)
+        sys.exit(1 if problems else 0)
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,133 @@
 from sqlalchemy import create_engine
+from sqlalchemy.exc import MissingGreenlet
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.util import await_only
 from dotenv.main import load_dotenv
 from sqlalchemy.orm import Session
-from fastapi import Depends
+from starlette.concurrency import run_in_threadpool
+from fastapi import Depends, Request
 from typing import Annotated
+import asyncio
 import os
+import time
+
+import metrics
+from querystats import instrument
 
 load_dotenv()
 SQLALCHEMY_URL = os.getenv("SQLALCHEMY_URL")
+# Асинхронный режим: запросы идут через AsyncSession и asyncpg, не блокируя цикл событий
+DB_ASYNC = os.getenv("DB_ASYNC", "False").lower() in ("1", "true", "yes")
+
+# Настройки пула соединений (для каждого воркера и каждого движка отдельно); по умолчанию — как в SQLAlchemy
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+# Пересоздавать соединения старше стольких секунд (-1 — никогда)
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "-1"))
+# Проверять соединение перед выдачей из пула (лишний round-trip, зато без ошибок после рестарта БД)
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "False").lower() in ("1", "true", "yes")
+
+# Необязательная реплика для чтения: списки, история аренд, поиск транспорта
+SQLALCHEMY_REPLICA_URL = os.getenv("SQLALCHEMY_REPLICA_URL")
+# После своего изменения клиент столько секунд читает с основной БД, чтобы не увидеть отставание реплики
+REPLICA_STICKY_SECONDS = float(os.getenv("REPLICA_STICKY_SECONDS", "5"))
+READ_PRIMARY_COOKIE = "read_primary_until"
+
+ASYNC_DRIVERS = {
+    "postgresql": "postgresql+asyncpg",
+    "postgresql+psycopg2": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+}
+
+def async_url(url: str) -> str:
+    scheme, rest = url.split("://", 1)
+    return f"{ASYNC_DRIVERS.get(scheme, scheme)}://{rest}"
+
+# Последнее ожидание соединения: (момент по time.monotonic(), секунды) — по нему admission отказывает при перегрузке
+last_pool_wait = (0.0, 0.0)
+
+# Пулы, которые замеряют ожидание свободного соединения
+class TimedCheckout:
+    def _do_get(self):
+        global last_pool_wait
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            waited = time.perf_counter() - started
+            # Кортеж присваивается целиком, поэтому запись из пула потоков не требует блокировки
+            last_pool_wait = (time.monotonic(), waited)
+            metrics.observe_threadsafe(metrics.pool_wait, waited)
 
-engine = create_engine(SQLALCHEMY_URL)
+class TimedQueuePool(TimedCheckout, QueuePool):
+    pass
+
+class TimedAsyncQueuePool(TimedCheckout, AsyncAdaptedQueuePool):
+    pass
+
+def pool_args(url: str, poolclass) -> dict:
+    # sqlite по умолчанию запрещает использовать соединение из другого потока; пул у него свой.
+    # Запись в sqlite идёт по одной транзакции: ожидание блокировки базы ограничено тем же DB_POOL_TIMEOUT,
+    # а не 5 секундами по умолчанию, после которых конкурентная запись падала бы с «database is locked»
+    if url.startswith("sqlite"):
+        return {"connect_args": {"check_same_thread": False, "timeout": DB_POOL_TIMEOUT}} if poolclass is TimedQueuePool else {"connect_args": {"timeout": DB_POOL_TIMEOUT}}
+
+    return {
+        "poolclass": poolclass,
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": DB_POOL_PRE_PING,
+    }
+
+engine = create_engine(SQLALCHEMY_URL, **pool_args(SQLALCHEMY_URL, TimedQueuePool))
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+instrument(engine)
 Base = declarative_base()
 
+# Без реплики чтение идёт через тот же движок
+replica_engine = engine
+ReplicaSessionLocal = SessionLocal
+
+if SQLALCHEMY_REPLICA_URL:
+    replica_engine = create_engine(SQLALCHEMY_REPLICA_URL, **pool_args(SQLALCHEMY_REPLICA_URL, TimedQueuePool))
+    ReplicaSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=replica_engine)
+    instrument(replica_engine)
+
+async_engine = None
+async_replica_engine = None
+AsyncSessionLocal = None
+AsyncReplicaSessionLocal = None
+
+if DB_ASYNC:
+    async_engine = create_async_engine(os.getenv("ASYNC_SQLALCHEMY_URL") or async_url(SQLALCHEMY_URL), **pool_args(SQLALCHEMY_URL, TimedAsyncQueuePool))
+    # После commit объекты отдаются наружу, поэтому атрибуты не должны истекать
+    AsyncSessionLocal = sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+    AsyncReplicaSessionLocal = AsyncSessionLocal
+    instrument(async_engine.sync_engine)
+
+    if SQLALCHEMY_REPLICA_URL:
+        async_replica_engine = create_async_engine(async_url(SQLALCHEMY_REPLICA_URL), **pool_args(SQLALCHEMY_REPLICA_URL, TimedAsyncQueuePool))
+        AsyncReplicaSessionLocal = sessionmaker(async_replica_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+        instrument(async_replica_engine.sync_engine)
+
+# Соединения нельзя делить между процессами: воркер после fork начинает с пустыми пулами,
+# не закрывая сокеты, которые принадлежат родителю
+def dispose_after_fork():
+    engines = {engine, replica_engine}
+
+    for pooled in (async_engine, async_replica_engine):
+        if pooled is not None:
+            engines.add(pooled.sync_engine)
+
+    for pooled in engines:
+        pooled.dispose(close=False)
+
 def get_db():
     db = SessionLocal()
     try:
@@ -21,4 +135,106 @@ def get_db():
     finally:
         db.close()
 
-db_dependency = Annotated[Session, Depends(get_db)]
\ No newline at end of file
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+# Чтение с основной БД вместо реплики: заголовок X-Read-Primary или недавнее изменение этим клиентом
+def read_primary(request: Request) -> bool:
+    if request.headers.get("x-read-primary"):
+        return True
+
+    try:
+        return float(request.cookies.get(READ_PRIMARY_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+def get_read_db(request: Request):
+    db = SessionLocal() if read_primary(request) else ReplicaSessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+async def get_async_read_db(request: Request):
+    async with (AsyncSessionLocal() if read_primary(request) else AsyncReplicaSessionLocal()) as db:
+        yield db
+
+# Успешный изменяющий запрос ставит клиенту cookie, и следующие REPLICA_STICKY_SECONDS секунд
+# его чтения идут на основную БД (read-your-writes); подключается только при заданной реплике
+class ReadYourWritesMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['method'] in ('GET', 'HEAD', 'OPTIONS'):
+            return await self.app(scope, receive, send)
+
+        async def send_with_cookie(message):
+            if message['type'] == 'http.response.start' and message['status'] < 400:
+                until = time.time() + REPLICA_STICKY_SECONDS
+                cookie = f'{READ_PRIMARY_COOKIE}={until:.3f}; Max-Age={int(REPLICA_STICKY_SECONDS) + 1}; Path=/; HttpOnly; SameSite=Lax'
+                message['headers'] = list(message.get('headers', [])) + [(b'set-cookie', cookie.encode())]
+            await send(message)
+
+        await self.app(scope, receive, send_with_cookie)
+
+# Выполняет синхронную функцию работы с БД (db передаётся последним аргументом), не блокируя цикл событий:
+# в асинхронном режиме через AsyncSession.run_sync, в синхронном — в пуле потоков
+async def run_db(db, fn, *args, **kwargs):
+    if isinstance(db, AsyncSession):
+        return await db.run_sync(lambda session: fn(*args, session, **kwargs))
+    return await run_in_threadpool(fn, *args, db, **kwargs)
+
+# CPU-работа внутри функции, вызванной через run_db: в асинхронном режиме run_sync выполняет эту функцию
+# в потоке цикла событий, поэтому разбор файлов, ранжирование и свёртки уходят в пул потоков, пока сессия ждёт.
+# В пуле потоков (синхронный режим) и прямо в обработчике функция вызывается на месте
+def run_cpu(fn, *args):
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return fn(*args)
+
+    call = run_in_threadpool(fn, *args)
+    try:
+        return await_only(call)
+    except MissingGreenlet:
+        call.close()
+        return fn(*args)
+
+# То же для фоновых задач: открывает собственную сессию на время вызова
+async def run_in_session(fn, *args, **kwargs):
+    if DB_ASYNC:
+        async with AsyncSessionLocal() as db:
+            return await run_db(db, fn, *args, **kwargs)
+
+    def call():
+        with SessionLocal() as db:
+            return fn(*args, db, **kwargs)
+
+    return await run_in_threadpool(call)
+
+STREAM_BATCH = int(os.getenv("STREAM_BATCH", "500"))
+
+# Выдача результата запроса пачками через серверный курсор: в памяти не больше одной пачки строк
+async def stream_batches(db, query):
+    query = query.execution_options(yield_per=STREAM_BATCH)
+
+    if isinstance(db, AsyncSession):
+        result = await db.stream(query)
+        async for partition in result.partitions(STREAM_BATCH):
+            yield partition
+        return
+
+    result = await run_in_threadpool(db.execute, query)
+    while True:
+        rows = await run_in_threadpool(result.fetchmany, STREAM_BATCH)
+
+        if not rows:
+            break
+
+        yield rows
+
+db_dependency = Annotated[Session, Depends(get_async_db if DB_ASYNC else get_db)]
+# Для обработчиков, которые только читают и терпят отставание реплики
+read_db_dependency = Annotated[Session, Depends(get_async_read_db if DB_ASYNC else get_read_db)]
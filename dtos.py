@@ -1,4 +1,6 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict, Field
+from datetime import date, datetime
+from typing import Annotated, Generic, Literal, TypeVar
 
 class UserRequest(BaseModel):
     name: str
@@ -7,6 +9,15 @@ class UserRequest(BaseModel):
 class AdminUserRequest(UserRequest):
     isAdmin: bool
     balance: float
+    disabled: bool = False
+
+# Пользователь, восстановленный из claims токена без запроса к БД
+class CurrentUser(BaseModel):
+    id: int
+    isAdmin: bool = False
+    disabled: bool = False
+    jti: str | None = None
+    exp: int | None = None
 
 class Token(BaseModel):
     access_token: str
@@ -27,6 +38,13 @@ class TransportModel(BaseModel):
 class AdminTransportModel(TransportModel):
     ownerId: int
 
+# Точка телеметрии: транспорт определяется по identifier, ts — время измерения на устройстве
+class TelemetryPoint(BaseModel):
+    identifier: str
+    latitude: float = Field(ge=-90, le=90)
+    longitude: float = Field(ge=-180, le=180)
+    ts: datetime
+
 class RentModel(BaseModel):
     rentType: str
     transportId: int
@@ -36,7 +54,101 @@ class AdminRentModel(RentModel):
     renter_user_id: int
 
 class AdminRentModelWithAll(AdminRentModel):
-    startTime: str
-    endTime: str
+    startTime: datetime
+    endTime: datetime
+    priceOfUnit: float
+    finalPrice: float
+
+# Расчёт цен без аренды: транспорт по списку id или поиск в радиусе (метры), длительности — в минутах
+class QuoteRequest(BaseModel):
+    transportIds: list[int] | None = Field(None, max_length=1000)
+    latitude: float | None = None
+    longitude: float | None = None
+    radius: float | None = None
+    type: str | None = None
+    durations: list[Annotated[int, Field(gt=0)]] = Field(min_length=1, max_length=16)
+
+# Параметры выдачи истории аренд: json с cursor — ограниченная страница, без cursor и ndjson — потоковая выгрузка всей истории
+class HistoryQuery(BaseModel):
+    since: datetime | None = None
+    until: datetime | None = None
+    count: int = 100
+    cursor: str | None = None
+    format: Literal['json', 'ndjson'] = 'json'
+
+# Модели ответов: читаются прямо из ORM-объектов, пароль наружу не попадает
+class UserRead(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    id: int
+    name: str
+    isAdmin: bool
+    balance: float
+    disabled: bool
+
+class TransportRead(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    id: int
+    user_id: int
+    canBeRented: bool
+    transportType: str
+    model: str
+    color: str
+    identifier: str
+    description: str | None = None
+    latitude: float
+    longitude: float
+    minutePrice: float | None = None
+    dayPrice: float | None = None
+
+class RentRead(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    id: int
+    rentType: str
+    transportId: int
+    renter_user_id: int
+    startTime: datetime
+    endTime: datetime | None = None
+    priceOfUnit: float
+    finalPrice: float | None = None
+    isActive: bool
+
+# Самый дешёвый тариф для одной длительности: rentType и duration подходят для /api/Rent/New
+class Quote(BaseModel):
+    minutes: int
+    rentType: str
+    duration: int
     priceOfUnit: float
-    finalPrice: float
\ No newline at end of file
+    finalPrice: float
+
+class TransportQuote(BaseModel):
+    transportId: int
+    canBeRented: bool
+    # по порядку durations запроса; None — у транспорта нет цены ни по одному тарифу
+    quotes: list[Quote | None]
+
+# Админская аналитика: key — день, тип транспорта или id владельца, в зависимости от groupBy
+class RevenueRead(BaseModel):
+    key: date | int | str
+    rents: int
+    revenue: float
+
+class UtilizationRead(BaseModel):
+    day: date
+    transportType: str
+    vehicles: int
+    rentedHours: float
+    # доля времени парка этого типа в аренде (за сегодня — от начала дня до текущего момента)
+    utilization: float
+
+class ActiveRentsRead(BaseModel):
+    total: int
+    byType: dict[str, int]
+
+T = TypeVar('T')
+
+class Page(BaseModel, Generic[T]):
+    items: list[T]
+    next_cursor: str | None
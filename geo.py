@@ -0,0 +1,111 @@
+from math import radians, degrees, sin, cos, asin, sqrt, ceil
+
+EARTH_RADIUS = 6371008.8
+METERS_PER_DEGREE = 111320.0
+GEOHASH_PRECISION = 9
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+def encode(latitude: float, longitude: float, precision: int = GEOHASH_PRECISION) -> str:
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    geohash = []
+    bits = 0
+    bit_count = 0
+    even = True
+
+    while len(geohash) < precision:
+        if even:
+            mid = (lon_range[0] + lon_range[1]) / 2
+            if longitude >= mid:
+                bits = (bits << 1) | 1
+                lon_range[0] = mid
+            else:
+                bits = bits << 1
+                lon_range[1] = mid
+        else:
+            mid = (lat_range[0] + lat_range[1]) / 2
+            if latitude >= mid:
+                bits = (bits << 1) | 1
+                lat_range[0] = mid
+            else:
+                bits = bits << 1
+                lat_range[1] = mid
+
+        even = not even
+        bit_count += 1
+
+        if bit_count == 5:
+            geohash.append(BASE32[bits])
+            bits = 0
+            bit_count = 0
+
+    return ''.join(geohash)
+
+def haversine(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    lat1, lon1, lat2, lon2 = map(radians, (lat1, lon1, lat2, lon2))
+    a = sin((lat2 - lat1) / 2) ** 2 + cos(lat1) * cos(lat2) * sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * asin(sqrt(a))
+
+# Размер ячейки geohash заданной точности в градусах (высота, ширина)
+def cell_size(precision: int) -> tuple[float, float]:
+    bits = precision * 5
+    lon_bits = ceil(bits / 2)
+    lat_bits = bits - lon_bits
+    return 180.0 / 2 ** lat_bits, 360.0 / 2 ** lon_bits
+
+# Минимальный размер ячейки в метрах вокруг точки с учётом сужения по долготе
+def cell_size_meters(latitude: float, precision: int, margin: float = 0) -> float:
+    height, width = cell_size(precision)
+    pole_side = min(90.0, abs(latitude) + margin / METERS_PER_DEGREE)
+    return min(height * METERS_PER_DEGREE, width * METERS_PER_DEGREE * cos(radians(pole_side)))
+
+# Ячейка точки и её 8 соседей
+def neighbours(latitude: float, longitude: float, precision: int) -> set[str]:
+    height, width = cell_size(precision)
+    cells = set()
+
+    for dy in (-height, 0, height):
+        for dx in (-width, 0, width):
+            lat = max(-90.0, min(90.0, latitude + dy))
+            lon = (longitude + dx + 180.0) % 360.0 - 180.0
+            cells.add(encode(lat, lon, precision))
+
+    return cells
+
+# Прямоугольник (min_lat, max_lat, min_lon, max_lon), гарантированно содержащий круг радиусом radius метров.
+# Дешёвый отсев кандидатов перед haversine; у полюсов и через антимеридиан — без ограничения по долготе.
+def bounding_box(latitude: float, longitude: float, radius: float):
+    delta_lat = degrees(radius / EARTH_RADIUS)
+    pole_side = abs(latitude) + delta_lat
+
+    if pole_side >= 89.0:
+        return latitude - delta_lat, latitude + delta_lat, -180.0, 180.0
+
+    delta_lon = delta_lat / cos(radians(pole_side))
+    if abs(longitude) + delta_lon >= 180.0:
+        return latitude - delta_lat, latitude + delta_lat, -180.0, 180.0
+
+    return latitude - delta_lat, latitude + delta_lat, longitude - delta_lon, longitude + delta_lon
+
+# Префиксы geohash, покрывающие круг радиусом radius метров.
+# None означает, что круг слишком большой и нужен полный просмотр.
+def cells_for_radius(latitude: float, longitude: float, radius: float):
+    for precision in range(GEOHASH_PRECISION, 0, -1):
+        if cell_size_meters(latitude, precision, radius) >= radius:
+            return neighbours(latitude, longitude, precision)
+    return None
+
+# Ячейки заданной точности, покрывающие прямоугольник; шаг сетки не больше размера ячейки,
+# поэтому в каждую пересекающуюся ячейку попадает хотя бы одна точка.
+# None, если ячеек больше limit.
+def cells_for_box(min_lat: float, max_lat: float, min_lon: float, max_lon: float, precision: int, limit: int):
+    height, width = cell_size(precision)
+    rows = ceil((max_lat - min_lat) / height) + 1
+    columns = ceil((max_lon - min_lon) / width) + 1
+
+    if rows * columns > limit:
+        return None
+
+    latitudes = [min(max_lat, min_lat + i * height) for i in range(rows)]
+    longitudes = [min(max_lon, min_lon + i * width) for i in range(columns)]
+    return {encode(lat, lon, precision) for lat in latitudes for lon in longitudes}
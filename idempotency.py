@@ -0,0 +1,236 @@
+from fastapi import Header, HTTPException, Request, Response
+from sqlalchemy import delete, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Annotated
+import asyncio
+import hashlib
+import logging
+import os
+import time
+import orjson
+
+import querystats
+from database import run_in_session
+from models import IdempotencyKey, FindIdempotencyKey
+from scheduler import utc
+
+logger = logging.getLogger(__name__)
+
+# Повтор запроса с тем же заголовком Idempotency-Key получает сохранённый ответ первого, не выполняя его снова.
+# Ключ сначала резервируется строкой в idempotency_key, затем выполняется обработчик. Ответ записывается в эту строку
+# той же транзакцией, что и изменение данных (stage() перед commit), поэтому изменение без сохранённого ответа невозможно.
+# Неуспешный запрос (HTTPException, ошибка) не меняет данных — резерв снимается, и повтор выполнится заново.
+IDEMPOTENCY_TTL = float(os.getenv("IDEMPOTENCY_TTL", str(24 * 3600)))
+# Сохранённые ответы, которые воркер отдаёт без обращения к БД
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", "10000"))
+# Сколько повтор ждёт запрос с тем же ключом, выполняющийся в другом воркере, прежде чем ответить 409
+IDEMPOTENCY_WAIT = float(os.getenv("IDEMPOTENCY_WAIT", "10"))
+IDEMPOTENCY_POLL = 0.1
+# Резерв ключа без сохранённого ответа (воркер упал посреди запроса, данные не изменены) через столько секунд
+# считается свободным. Обработчик, не успевший за это время, не сохраняет изменения и получает 409
+IDEMPOTENCY_LOCK_TTL = float(os.getenv("IDEMPOTENCY_LOCK_TTL", "60"))
+IDEMPOTENCY_CLEANUP_INTERVAL = float(os.getenv("IDEMPOTENCY_CLEANUP_INTERVAL", "600"))
+MAX_KEY_LENGTH = 255
+
+idempotency_header = Annotated[str | None, Header(alias='Idempotency-Key', min_length=1, max_length=MAX_KEY_LENGTH)]
+
+# (user_id, ключ) -> (fingerprint, status_code, тело, истекает (epoch)); порядок — давность использования
+cache: OrderedDict[tuple, tuple] = OrderedDict()
+# (user_id, ключ) -> future запроса, выполняющегося в этом воркере
+running: dict[tuple, asyncio.Future] = {}
+
+task: asyncio.Task | None = None
+stopping: asyncio.Event | None = None
+
+def remember(ident: tuple, stored: tuple):
+    cache[ident] = stored
+    cache.move_to_end(ident)
+
+    while len(cache) > IDEMPOTENCY_CACHE_SIZE:
+        cache.popitem(last=False)
+
+def cached(ident: tuple):
+    stored = cache.get(ident)
+
+    if stored is None:
+        return None
+    if stored[3] <= time.time():
+        del cache[ident]
+        return None
+
+    cache.move_to_end(ident)
+    return stored
+
+# Возвращает существующую строку ключа или None, если ключ зарезервирован этим вызовом до lease.
+# Пока ответа нет, expires_at — срок резерва, после сохранения ответа — срок хранения ключа
+def reserve(user_id: int, key: str, fingerprint: str, lease: datetime, db: Session):
+    now = datetime.now(timezone.utc)
+    existing = FindIdempotencyKey.get(user_id, key, db)
+
+    if existing is not None:
+        if utc(existing.expires_at) > now:
+            db.rollback()
+            return existing
+        db.execute(delete(IdempotencyKey).where(IdempotencyKey.user_id == user_id, IdempotencyKey.key == key))
+
+    db.add(IdempotencyKey(user_id=user_id, key=key, fingerprint=fingerprint, expires_at=lease))
+
+    try:
+        db.commit()
+    except IntegrityError:
+        # Тот же ключ одновременно зарезервировал другой воркер
+        db.rollback()
+        return FindIdempotencyKey.get(user_id, key, db)
+
+    return None
+
+# Вызывается обработчиком перед commit, который фиксирует изменение данных: ответ сохраняется в той же транзакции.
+# Без Idempotency-Key ничего не делает. Срок резерва определяет, что строка всё ещё принадлежит этому запросу
+def stage(db: Session, result):
+    pending = db.info.get('idempotency')
+
+    if pending is None:
+        return
+
+    user_id, key, lease, response_model = pending
+    body = orjson.dumps(response_model.model_validate(result).model_dump(mode='json')).decode()
+    stored = db.execute(update(IdempotencyKey)
+        .where(IdempotencyKey.user_id == user_id, IdempotencyKey.key == key, IdempotencyKey.status_code == None, IdempotencyKey.expires_at == lease)
+        .values(status_code=200, body=body, expires_at=datetime.now(timezone.utc) + timedelta(seconds=IDEMPOTENCY_TTL))
+        .execution_options(synchronize_session=False))
+
+    if stored.rowcount != 1:
+        db.rollback()
+        raise HTTPException(status_code=409, detail="Idempotency-Key reservation expired before the request completed, retry it")
+
+    db.info['idempotency_body'] = body
+
+# Снимает только свой резерв: ключ, перехваченный другим запросом после истечения, остаётся ему
+def release(user_id: int, key: str, lease: datetime, db: Session):
+    db.execute(delete(IdempotencyKey).where(IdempotencyKey.user_id == user_id, IdempotencyKey.key == key, IdempotencyKey.status_code == None, IdempotencyKey.expires_at == lease))
+    db.commit()
+
+def fingerprint(request: Request, body: bytes) -> str:
+    return hashlib.blake2b(f"{request.method} {request.url.path}\n".encode() + body, digest_size=16).hexdigest()
+
+def replay(stored: tuple, expected: str) -> Response:
+    if stored[0] != expected:
+        raise HTTPException(status_code=422, detail="Idempotency-Key was already used with a different request")
+
+    return Response(content=stored[2], status_code=stored[1], media_type='application/json', headers={'Idempotent-Replayed': 'true'})
+
+# Ждёт завершения запроса с тем же ключом в другом воркере; None — ключ освобождён.
+# Повторяющийся опрос не учитывается в статистике запросов, иначе он выглядел бы как N+1
+async def wait_stored(user_id: int, key: str):
+    deadline = time.monotonic() + IDEMPOTENCY_WAIT
+    token = querystats.current.set(None)
+
+    try:
+        while time.monotonic() < deadline:
+            await asyncio.sleep(IDEMPOTENCY_POLL)
+            row = await run_in_session(FindIdempotencyKey.get, user_id, key)
+
+            if row is None:
+                return None
+            if row.status_code is not None:
+                return row
+    finally:
+        querystats.current.reset(token)
+
+    raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is still in progress")
+
+# Выполняет handler() не больше одного раза на ключ. handler() изменяет данные в сессии db и перед своим commit
+# вызывает stage(db, результат), который сохраняет ответ по response_model. Без ключа просто возвращает результат handler()
+async def execute(request: Request, key: str | None, user_id: int, response_model, db, handler):
+    if key is None:
+        return await handler()
+
+    ident = (user_id, key)
+    expected = fingerprint(request, await request.body())
+
+    while True:
+        stored = cached(ident)
+        if stored is not None:
+            return replay(stored, expected)
+
+        # Повтор в том же воркере ждёт первый запрос без обращения к БД
+        first = running.get(ident)
+        if first is not None:
+            await asyncio.shield(first)
+            continue
+
+        future = running[ident] = asyncio.get_running_loop().create_future()
+
+        try:
+            lease = datetime.now(timezone.utc) + timedelta(seconds=IDEMPOTENCY_LOCK_TTL)
+            row = await run_in_session(reserve, user_id, key, expected, lease)
+
+            if row is not None and row.status_code is None:
+                row = await wait_stored(user_id, key)
+                if row is None:
+                    continue
+
+            if row is not None:
+                stored = (row.fingerprint, row.status_code, row.body, utc(row.expires_at).timestamp())
+                remember(ident, stored)
+                return replay(stored, expected)
+
+            info = db.sync_session.info if isinstance(db, AsyncSession) else db.info
+            info['idempotency'] = (user_id, key, lease, response_model)
+
+            try:
+                await handler()
+                body = info.get('idempotency_body')
+                if body is None:
+                    raise RuntimeError("Idempotent handler did not call idempotency.stage()")
+            except BaseException:
+                # Сохранённый ответ release() не трогает: если commit прошёл, повтор получит его
+                await run_in_session(release, user_id, key, lease)
+                raise
+            finally:
+                info.pop('idempotency', None)
+                info.pop('idempotency_body', None)
+
+            remember(ident, (expected, 200, body, time.time() + IDEMPOTENCY_TTL))
+            return Response(content=body, media_type='application/json')
+        finally:
+            running.pop(ident, None)
+            future.set_result(None)
+
+async def cleanup():
+    now = time.time()
+
+    for ident, stored in list(cache.items()):
+        if stored[3] <= now:
+            cache.pop(ident, None)
+
+    await run_in_session(FindIdempotencyKey.delete_expired, datetime.now(timezone.utc))
+
+async def run():
+    while not stopping.is_set():
+        try:
+            await asyncio.wait_for(stopping.wait(), IDEMPOTENCY_CLEANUP_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+        try:
+            await cleanup()
+        except Exception:
+            logger.exception("Idempotency key cleanup failed")
+
+def start():
+    global task, stopping
+    stopping = asyncio.Event()
+    task = asyncio.get_running_loop().create_task(run())
+
+async def stop():
+    global task
+
+    if task is not None:
+        stopping.set()
+        await task
+        task = None
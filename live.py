@@ -0,0 +1,236 @@
+from fastapi import HTTPException
+import asyncio
+import logging
+import os
+import orjson
+
+import availability
+import geo
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Подписки на изменения доступного транспорта вместо опроса /api/Rent/Transport.
+# Клиент задаёт область (радиус или прямоугольник) и тип, получает снимок, затем события:
+#   available   — транспорт появился в области или изменился (клиент заменяет объект целиком)
+#   unavailable — транспорт арендован, удалён или покинул область
+#   moved       — транспорт остался в области, но сменил координаты
+# События строятся из изменений снимка availability, поэтому приходят во все воркеры.
+
+# Подписчики раскладываются по ячейкам geohash этой точности (~5 км), событие проверяется
+# только у подписчиков ячеек старой и новой позиции транспорта
+LIVE_BUCKET_PRECISION = 5
+# Область, покрытая большим числом ячеек, подписывается на все события
+LIVE_MAX_CELLS = 64
+LIVE_QUEUE_SIZE = int(os.getenv("LIVE_QUEUE_SIZE", "256"))
+LIVE_MAX_SUBSCRIBERS = int(os.getenv("LIVE_MAX_SUBSCRIBERS", "10000"))
+# Пустое сообщение SSE, чтобы прокси не закрывали простаивающее соединение
+LIVE_PING = 15.0
+
+# Маркер в очереди: события потеряны, нужно отправить новый снимок
+RESYNC = object()
+
+class Subscription:
+    def __init__(self, type: str, box: tuple, center: tuple = None, radius: float = None):
+        self.type = type
+        self.box = box
+        self.center = center
+        self.radius = radius
+        self.cells = geo.cells_for_box(*box, LIVE_BUCKET_PRECISION, LIVE_MAX_CELLS) if box is not None else None
+        self.queue = asyncio.Queue(LIVE_QUEUE_SIZE)
+
+    def matches(self, row) -> bool:
+        if row is None or row.latitude is None or row.longitude is None:
+            return False
+        if self.type is not None and row.transportType != self.type:
+            return False
+
+        if self.box is not None:
+            min_lat, max_lat, min_lon, max_lon = self.box
+            if not (min_lat <= row.latitude <= max_lat and min_lon <= row.longitude <= max_lon):
+                return False
+
+        if self.radius is not None:
+            return geo.haversine(self.center[0], self.center[1], row.latitude, row.longitude) <= self.radius
+
+        return True
+
+    # Очередь ограничена: у медленного клиента она сбрасывается, и вместо пропущенных событий
+    # он получит один свежий снимок
+    def push(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(RESYNC)
+            metrics.live_resyncs.inc()
+
+    def snapshot(self):
+        rows = [row for row in availability.available(self.type, self.cells) if self.matches(row)]
+        body, _ = availability.render(rows)
+        return 'snapshot', b'{"event":"snapshot","transports":' + body + b'}'
+
+# Префикс geohash -> подписчики; подписчики без ячеек получают все события
+buckets: dict[str, set[Subscription]] = {}
+everywhere: set[Subscription] = set()
+count = 0
+
+# Область подписки из параметров запроса: радиус вокруг точки или прямоугольник, иначе вся карта
+def subscription(
+    type: str = None,
+    latitude: float = None,
+    longitude: float = None,
+    radius: float = None,
+    minLatitude: float = None,
+    maxLatitude: float = None,
+    minLongitude: float = None,
+    maxLongitude: float = None) -> Subscription:
+    if radius is not None:
+        if latitude is None or longitude is None:
+            raise HTTPException(status_code=400, detail="Radius requires latitude and longitude")
+        if radius <= 0:
+            raise HTTPException(status_code=400, detail="Radius must be positive")
+
+        return Subscription(type, geo.bounding_box(latitude, longitude, radius), (latitude, longitude), radius)
+
+    box = (minLatitude, maxLatitude, minLongitude, maxLongitude)
+
+    if all(value is None for value in box):
+        return Subscription(type, None)
+    if any(value is None for value in box):
+        raise HTTPException(status_code=400, detail="Bounding box requires minLatitude, maxLatitude, minLongitude and maxLongitude")
+    if minLatitude > maxLatitude or minLongitude > maxLongitude:
+        raise HTTPException(status_code=400, detail="Bounding box is empty")
+
+    return Subscription(type, box)
+
+def check_capacity():
+    if not availability.ready():
+        raise HTTPException(status_code=503, detail="Availability snapshot is not loaded yet")
+    if count >= LIVE_MAX_SUBSCRIBERS:
+        raise HTTPException(status_code=503, detail="Too many subscribers")
+
+def subscribe(sub: Subscription):
+    global count
+
+    check_capacity()
+
+    if sub.cells is None:
+        everywhere.add(sub)
+    else:
+        for cell in sub.cells:
+            buckets.setdefault(cell, set()).add(sub)
+
+    count += 1
+    metrics.live_subscribers.value += 1
+
+def unsubscribe(sub: Subscription):
+    global count
+
+    if sub.cells is None:
+        everywhere.discard(sub)
+    else:
+        for cell in sub.cells:
+            subscribers = buckets.get(cell)
+            if subscribers is not None:
+                subscribers.discard(sub)
+                if not subscribers:
+                    del buckets[cell]
+
+    count -= 1
+    metrics.live_subscribers.value -= 1
+
+def targets(row):
+    if row is None or row.geohash is None:
+        return ()
+    return buckets.get(row.geohash[:LIVE_BUCKET_PRECISION], ())
+
+# Вызывается снимком после каждого обновления; тело события сериализуется один раз на всех подписчиков
+def publish(changes):
+    if not buckets and not everywhere:
+        return
+
+    for old, new in changes:
+        subscribers = everywhere.union(targets(old), targets(new))
+
+        if not subscribers:
+            continue
+
+        id = new.id if new is not None else old.id
+        moved = old is not None and new is not None and (old.latitude, old.longitude) != (new.latitude, new.longitude)
+        events = {}
+
+        for sub in subscribers:
+            was, now = sub.matches(old), sub.matches(new)
+
+            if now:
+                name = 'moved' if was and moved else 'available'
+            elif was:
+                name = 'unavailable'
+            else:
+                continue
+
+            if name not in events:
+                if name == 'unavailable':
+                    events[name] = (name, orjson.dumps({'event': name, 'id': id}))
+                else:
+                    events[name] = (name, b'{"event":"' + name.encode() + b'","transport":' + availability.entries[id][1] + b'}')
+            sub.push(events[name])
+
+availability.listeners.append(publish)
+
+# Снимок, затем события из очереди; ping — None после LIVE_PING секунд тишины
+async def events(sub: Subscription, ping: float = None):
+    yield sub.snapshot()
+
+    while True:
+        try:
+            event = await asyncio.wait_for(sub.queue.get(), ping)
+        except asyncio.TimeoutError:
+            yield None
+            continue
+
+        yield sub.snapshot() if event is RESYNC else event
+
+# Подписка оформляется при первой итерации: если клиент отключился раньше, генератор не запускается,
+# и подписки, которую некому снять, не остаётся. Место проверено маршрутом заранее; если его успели занять, поток пустой
+async def sse(sub: Subscription):
+    try:
+        subscribe(sub)
+    except HTTPException:
+        return
+
+    try:
+        async for event in events(sub, LIVE_PING):
+            if event is None:
+                yield b': ping\n\n'
+            else:
+                name, body = event
+                yield b'event: ' + name.encode() + b'\ndata: ' + body + b'\n\n'
+    finally:
+        unsubscribe(sub)
+
+# WebSocket: события отправляются по одному; пока клиент не успевает читать, send ждёт,
+# а новые события копятся в ограниченной очереди подписки
+async def websocket(websocket, sub: Subscription):
+    async def send():
+        async for event in events(sub):
+            await websocket.send_text(event[1].decode())
+
+    async def receive():
+        while (await websocket.receive())['type'] != 'websocket.disconnect':
+            pass
+
+    tasks = [asyncio.ensure_future(send()), asyncio.ensure_future(receive())]
+
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        # Ошибка отправки обычно означает, что клиент отключился
+        for task in done:
+            if task.exception() is not None:
+                logger.debug("Live websocket closed: %r", task.exception())
+    finally:
+        for task in tasks:
+            task.cancel()
+        unsubscribe(sub)
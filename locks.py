@@ -0,0 +1,9 @@
+# Ключи advisory-lock PostgreSQL. Ключ общий для всей базы, поэтому все они собраны здесь и не должны совпадать
+# Один воркер освобождает пачку просроченных аренд (scheduler.py)
+EXPIRY_LOCK_KEY = 720001
+# Миграции выполняются только одним процессом (migrations.py)
+MIGRATION_LOCK_KEY = 720002
+# Проверка схемы и создание администратора при запуске сервера (main.py)
+STARTUP_LOCK_KEY = 720003
+# Пересчёт сводок аналитики (analytics.py)
+ANALYTICS_LOCK_KEY = 720004
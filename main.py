@@ -1,28 +1,54 @@
 import uvicorn
 from fastapi import FastAPI
+from sqlalchemy import text
+import os
+import sys
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import PlainTextResponse
+from fastapi.responses import ORJSONResponse, PlainTextResponse
 
-from database import engine, Base
+from database import engine, SQLALCHEMY_REPLICA_URL, ReadYourWritesMiddleware
 from routers.user import account
 from routers.transport import transport
 from routers.rent import rent
 from routers.payment import payment
-from routers.admin import adminaccount, admintranstor, adminrent
+from routers.admin import adminaccount, admintranstor, adminrent, adminanalytics
 from admin import initialize_admin
+from migrations import check_schema
+from locks import STARTUP_LOCK_KEY
+import scheduler
+import availability
+import telemetry
+import revocation
+import idempotency
+import analytics
+from querystats import QueryStatsMiddleware
+from admission import AdmissionMiddleware
+import metrics
+import prefork
 
-Base.metadata.create_all(bind=engine)
+SERVER_HOST = os.getenv("SERVER_HOST", "0.0.0.0")
+SERVER_PORT = int(os.getenv("SERVER_PORT", "3000"))
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 
 @app.get("/main")
 def main():
     return PlainTextResponse("Главная страница")
 
-routers = [account, transport, rent, payment, adminaccount, admintranstor, adminrent]
+# async: метрики меняются только в потоке цикла событий, и читать их можно только там же (не из пула потоков)
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    return PlainTextResponse(await metrics.render(), media_type="text/plain; version=0.0.4")
+
+routers = [account, transport, rent, payment, adminaccount, admintranstor, adminrent, adminanalytics]
 for router in routers:
     app.include_router(router)
 
+app.add_middleware(QueryStatsMiddleware)
+if SQLALCHEMY_REPLICA_URL:
+    app.add_middleware(ReadYourWritesMiddleware)
+app.add_middleware(AdmissionMiddleware)
+app.add_middleware(metrics.MetricsMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -31,9 +57,57 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Проверка схемы и создание администратора; параллельно запущенные серверы выполняют её по очереди
+def prepare():
+    postgres = engine.dialect.name == 'postgresql'
+
+    with engine.execution_options(isolation_level='AUTOCOMMIT').connect() as lock:
+        if postgres:
+            lock.execute(text('SELECT pg_advisory_lock(:key)'), {'key': STARTUP_LOCK_KEY})
+
+        try:
+            check_schema(engine)
+            initialize_admin()
+        finally:
+            if postgres:
+                lock.execute(text('SELECT pg_advisory_unlock(:key)'), {'key': STARTUP_LOCK_KEY})
+
+# В production-режиме подготовку один раз выполняет главный процесс до запуска воркеров
+prepared = False
+
 @app.on_event("startup")
 async def on_startup():
-    initialize_admin()
+    if not prepared:
+        prepare()
+    await revocation.start()
+    metrics.start()
+    scheduler.start()
+    availability.start()
+    telemetry.start()
+    idempotency.start()
+    analytics.start()
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    await analytics.stop()
+    await idempotency.stop()
+    await revocation.stop()
+    await telemetry.stop()
+    await availability.stop()
+    await scheduler.stop()
+    await metrics.stop()
 
+# py main.py — один процесс для разработки, py main.py production — воркеры по числу ядер (WEB_CONCURRENCY)
 if __name__ == "__main__":
-    uvicorn.run('main:app', host='0.0.0.0', port=3000, reload=False)
\ No newline at end of file
+    command = sys.argv[1] if len(sys.argv) > 1 else 'development'
+
+    if command == 'production':
+        prepare()
+        prepared = True
+        # Соединения главного процесса воркерам не нужны
+        engine.dispose()
+        sys.exit(prefork.serve(app, SERVER_HOST, SERVER_PORT))
+    elif command != 'development':
+        sys.exit(f'Unknown command: {command}')
+
+    uvicorn.run('main:app', host=SERVER_HOST, port=SERVER_PORT, reload=False)
@@ -0,0 +1,292 @@
+from bisect import bisect_left
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+# Каталог, через который воркеры обмениваются снимками метрик для общего /metrics. Каждый запуск сервера
+# пишет в собственный подкаталог, поэтому снимки прошлых запусков и других процессов в сумму не попадают
+METRICS_DIR = os.getenv("METRICS_DIR", os.path.join(tempfile.gettempdir(), "rentapi-metrics"))
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "5"))
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Все изменения происходят в потоке цикла событий, поэтому блокировки не нужны
+class Histogram:
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        # значения меток -> [счётчики по корзинам..., +Inf, сумма]
+        self.series: dict[tuple, list] = {}
+
+    def observe(self, value: float, labels: tuple = ()):
+        series = self.series.get(labels)
+
+        if series is None:
+            series = self.series[labels] = [0] * (len(BUCKETS) + 1) + [0.0]
+
+        series[bisect_left(BUCKETS, value)] += 1
+        series[-1] += value
+
+class Gauge:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount: int = 1):
+        self.value += amount
+
+request_duration = Histogram("http_request_duration_seconds", "HTTP request latency by route and status", ("method", "route", "router", "status"))
+pool_wait = Histogram("db_pool_checkout_wait_seconds", "Time spent waiting for a database connection from the pool")
+hash_wait = Histogram("bcrypt_queue_wait_seconds", "Time a password hash waited for a bcrypt worker")
+in_flight = Gauge("http_requests_in_flight", "Requests currently being processed")
+live_subscribers = Gauge("live_subscribers", "Open availability subscriptions (WebSocket and SSE)")
+live_resyncs = Counter("live_resyncs_total", "Slow availability subscribers whose queue overflowed and was replaced by a snapshot")
+telemetry_flush_lag = Histogram("telemetry_flush_lag_seconds", "Time from the oldest buffered telemetry point to its write into the database")
+telemetry_buffered = Gauge("telemetry_buffered_vehicles", "Vehicles with telemetry waiting to be written")
+telemetry_points = Counter("telemetry_points_total", "Telemetry points accepted into the buffer")
+telemetry_dropped = Counter("telemetry_dropped_total", "Telemetry points dropped: older than an accepted point or buffer full")
+admission_shed = Counter("admission_shed_total", "Requests rejected with 503: worker overloaded or route concurrency limit reached")
+admission_throttled = Counter("admission_throttled_total", "Requests rejected with 429 by per-client rate limits")
+
+HISTOGRAMS = [request_duration, pool_wait, hash_wait, telemetry_flush_lag]
+GAUGES = [in_flight, live_subscribers, telemetry_buffered]
+COUNTERS = [live_resyncs, telemetry_points, telemetry_dropped, admission_shed, admission_throttled]
+
+# Каталог текущего запуска: создаётся до запуска воркеров и передаётся им через fork и METRICS_RUN_DIR
+run_dir: str | None = None
+# pid процесса, создавшего run_dir: он удаляет каталог при остановке
+run_owner: int | None = None
+# Момент запуска процесса: отличает его снимок от снимка прежнего процесса с тем же pid
+started = time.time_ns()
+
+# Новый каталог запуска; каталоги и снимки завершившихся запусков удаляются
+def new_run() -> str:
+    global run_dir, run_owner
+    os.makedirs(METRICS_DIR, exist_ok=True)
+
+    for name in os.listdir(METRICS_DIR):
+        owner = name.split("-", 1)[0].split(".", 1)[0]
+
+        if owner.isdigit() and not alive(int(owner)):
+            path = os.path.join(METRICS_DIR, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    run_dir = tempfile.mkdtemp(prefix=f"{os.getpid()}-", dir=METRICS_DIR)
+    run_owner = os.getpid()
+    os.environ["METRICS_RUN_DIR"] = run_dir
+    return run_dir
+
+def remove_run():
+    global run_dir, run_owner
+
+    if run_dir is not None and run_owner == os.getpid():
+        shutil.rmtree(run_dir, ignore_errors=True)
+        os.environ.pop("METRICS_RUN_DIR", None)
+        run_dir = run_owner = None
+
+def snapshot():
+    return {
+        "pid": os.getpid(),
+        "started": started,
+        "histograms": {h.name: [[list(labels), series] for labels, series in h.series.items()] for h in HISTOGRAMS},
+        "gauges": {g.name: g.value for g in GAUGES},
+        "counters": {c.name: c.value for c in COUNTERS},
+    }
+
+def snapshot_path() -> str:
+    return os.path.join(run_dir, f"{os.getpid()}-{started}.json")
+
+def flush():
+    os.makedirs(run_dir, exist_ok=True)
+    path = snapshot_path()
+    temporary = f"{path}.tmp"
+
+    with open(temporary, "w") as file:
+        json.dump(snapshot(), file)
+
+    os.replace(temporary, path)
+
+def alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+# Снимки остальных процессов запуска; читаются в пуле потоков, не на цикле событий
+def read_snapshots() -> list:
+    own = snapshot_path()
+    snapshots = []
+
+    for entry in os.scandir(run_dir):
+        if not entry.name.endswith(".json") or entry.path == own:
+            continue
+
+        try:
+            with open(entry.path) as file:
+                snapshots.append(json.load(file))
+        except (OSError, ValueError):
+            continue
+
+    return snapshots
+
+# Гистограммы и счётчики суммируются по всем снимкам запуска, gauge — только у живых процессов,
+# и для каждого pid — из последнего запущенного процесса
+def collect(snapshots: list):
+    histograms = {h.name: {} for h in HISTOGRAMS}
+    gauges = {g.name: 0 for g in GAUGES}
+    counters = {c.name: 0 for c in COUNTERS}
+    latest = {}
+
+    for data in snapshots:
+        for metric, series_list in data["histograms"].items():
+            merged = histograms.setdefault(metric, {})
+
+            for labels, series in series_list:
+                total = merged.setdefault(tuple(labels), [0] * len(series))
+                for i, value in enumerate(series):
+                    total[i] += value
+
+        for metric, value in data.get("counters", {}).items():
+            counters[metric] = counters.get(metric, 0) + value
+
+        if data["pid"] not in latest or data["started"] > latest[data["pid"]]["started"]:
+            latest[data["pid"]] = data
+
+    for pid, data in latest.items():
+        if pid == os.getpid() or alive(pid):
+            for metric, value in data["gauges"].items():
+                gauges[metric] = gauges.get(metric, 0) + value
+
+    return histograms, gauges, counters
+
+def escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(names: tuple, values: tuple, extra: tuple = ()) -> str:
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names + extra[:1], values + extra[1:])]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+# Текстовый формат Prometheus 0.0.4. Собственные метрики читаются на цикле событий, где они меняются,
+# файлы остальных воркеров — в пуле потоков
+async def render() -> str:
+    others = await asyncio.get_running_loop().run_in_executor(None, read_snapshots)
+    histograms, gauges, counters = collect([snapshot()] + others)
+    lines = []
+
+    for h in HISTOGRAMS:
+        lines.append(f"# HELP {h.name} {h.help}")
+        lines.append(f"# TYPE {h.name} histogram")
+
+        for labels, series in sorted(histograms.get(h.name, {}).items()):
+            cumulative = 0
+
+            for bound, count in zip(BUCKETS + ("+Inf",), series[:-1]):
+                cumulative += count
+                lines.append(f"{h.name}_bucket{format_labels(h.labels, labels, ('le', bound))} {cumulative}")
+
+            lines.append(f"{h.name}_sum{format_labels(h.labels, labels)} {series[-1]}")
+            lines.append(f"{h.name}_count{format_labels(h.labels, labels)} {cumulative}")
+
+    for g in GAUGES:
+        lines.append(f"# HELP {g.name} {g.help}")
+        lines.append(f"# TYPE {g.name} gauge")
+        lines.append(f"{g.name} {gauges.get(g.name, 0)}")
+
+    for c in COUNTERS:
+        lines.append(f"# HELP {c.name} {c.help}")
+        lines.append(f"# TYPE {c.name} counter")
+        lines.append(f"{c.name} {counters.get(c.name, 0)}")
+
+    return "\n".join(lines) + "\n"
+
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        started = time.perf_counter()
+        status = 500
+        in_flight.value += 1
+
+        async def send_with_status(message):
+            nonlocal status
+
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            in_flight.value -= 1
+            # Шаблон маршрута (а не фактический путь), чтобы число серий оставалось ограниченным
+            route = scope.get('route')
+            template = getattr(route, 'path', 'unmatched')
+            tags = getattr(route, 'tags', None)
+            request_duration.observe(time.perf_counter() - started, (scope['method'], template, tags[0] if tags else '', str(status)))
+
+task: asyncio.Task | None = None
+loop: asyncio.AbstractEventLoop | None = None
+loop_thread: int | None = None
+
+# Для наблюдений из пула потоков: значение передаётся в поток цикла событий
+def observe_threadsafe(histogram: Histogram, value: float):
+    if loop is None or threading.get_ident() == loop_thread:
+        histogram.observe(value)
+    else:
+        loop.call_soon_threadsafe(histogram.observe, value)
+
+async def run():
+    while True:
+        await asyncio.sleep(METRICS_FLUSH_INTERVAL)
+        flush()
+
+def start():
+    global task, loop, loop_thread, run_dir, started
+    # Воркер, перезапущенный под pid упавшего, пишет отдельный снимок и не затирает его счётчики
+    started = time.time_ns()
+
+    # Воркеры получают каталог запуска от главного процесса; отдельный процесс создаёт его сам
+    if run_dir is None:
+        run_dir = os.getenv("METRICS_RUN_DIR") or new_run()
+
+    loop = asyncio.get_running_loop()
+    loop_thread = threading.get_ident()
+    task = loop.create_task(run())
+
+async def stop():
+    if task is not None:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    if run_owner == os.getpid():
+        remove_run()
+    else:
+        flush()
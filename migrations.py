@@ -0,0 +1,262 @@
+# Версионированные миграции схемы. Запускаются отдельной командой перед стартом сервера:
+#   py migrations.py            — применить недостающие ревизии
+#   py migrations.py status     — показать применённые и ожидающие ревизии
+# Применённые ревизии записываются в таблицу schema_version. Ревизия отмечается после успешного
+# выполнения, поэтому каждая ревизия должна спокойно переживать повторный запуск.
+from sqlalchemy import String, inspect, text
+from datetime import datetime, timezone
+import sys
+
+import geo
+from database import engine
+from locks import MIGRATION_LOCK_KEY
+
+BACKFILL_BATCH = 1000
+
+# Колонка добавляется, только если её ещё нет: ревизия переживает повторный запуск
+def add_column(engine, table: str, name: str, ddl: str):
+    columns = [column['name'] for column in inspect(engine).get_columns(table)]
+
+    if name in columns:
+        return False
+
+    with engine.begin() as connection:
+        connection.execute(text(f'ALTER TABLE {table} ADD COLUMN "{name}" {ddl}'))
+    return True
+
+def drop_column(engine, table: str, name: str):
+    columns = [column['name'] for column in inspect(engine).get_columns(table)]
+
+    if name not in columns:
+        return False
+
+    with engine.begin() as connection:
+        connection.execute(text(f'ALTER TABLE {table} DROP COLUMN "{name}"'))
+    return True
+
+# На postgres индекс строится CONCURRENTLY, не блокируя запись в таблицу; для этого нужен autocommit.
+# Недостроенный (invalid) индекс после прерванной миграции пересоздаётся.
+def create_index(engine, name: str, definition: str):
+    postgres = engine.dialect.name == 'postgresql'
+    definition = definition.format(pattern_ops=' varchar_pattern_ops' if postgres else '')
+
+    with engine.execution_options(isolation_level='AUTOCOMMIT').connect() as connection:
+        if postgres:
+            invalid = connection.execute(text(
+                'SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid '
+                'WHERE c.relname = :name AND NOT i.indisvalid'), {'name': name}).first()
+
+            if invalid:
+                connection.execute(text(f'DROP INDEX CONCURRENTLY "{name}"'))
+
+        connection.execute(text(f'CREATE INDEX {"CONCURRENTLY " if postgres else ""}IF NOT EXISTS "{name}" ON {definition}'))
+
+def drop_index(engine, name: str):
+    postgres = engine.dialect.name == 'postgresql'
+
+    with engine.execution_options(isolation_level='AUTOCOMMIT').connect() as connection:
+        connection.execute(text(f'DROP INDEX {"CONCURRENTLY " if postgres else ""}IF EXISTS "{name}"'))
+
+# Исходная схема, какой её создавал create_all до появления миграций. Ревизия заморожена: изменения моделей
+# вносятся только следующими ревизиями, поэтому новая и обновляемая базы проходят одни и те же шаги
+def create_schema(engine):
+    id_type = 'SERIAL PRIMARY KEY' if engine.dialect.name == 'postgresql' else 'INTEGER PRIMARY KEY'
+
+    with engine.begin() as connection:
+        connection.execute(text(
+            f'CREATE TABLE IF NOT EXISTS users (id {id_type}, name VARCHAR, password VARCHAR, disabled BOOLEAN, '
+            'balance FLOAT, "isAdmin" BOOLEAN)'))
+        connection.execute(text('CREATE INDEX IF NOT EXISTS ix_users_id ON users (id)'))
+        connection.execute(text('CREATE UNIQUE INDEX IF NOT EXISTS ix_users_name ON users (name)'))
+        connection.execute(text(
+            f'CREATE TABLE IF NOT EXISTS transport (id {id_type}, user_id INTEGER REFERENCES users (id), "canBeRented" BOOLEAN, '
+            '"transportType" VARCHAR, model VARCHAR, color VARCHAR, identifier VARCHAR UNIQUE, description VARCHAR, '
+            'latitude FLOAT, longitude FLOAT, "minutePrice" FLOAT, "dayPrice" FLOAT)'))
+        connection.execute(text('CREATE INDEX IF NOT EXISTS ix_transport_id ON transport (id)'))
+        connection.execute(text(
+            f'CREATE TABLE IF NOT EXISTS rent (id {id_type}, "rentType" VARCHAR, "transportId" INTEGER REFERENCES transport (id), '
+            'renter_user_id INTEGER REFERENCES users (id), "startTime" VARCHAR, "endTime" VARCHAR, "priceOfUnit" FLOAT, "finalPrice" FLOAT)'))
+        connection.execute(text('CREATE INDEX IF NOT EXISTS ix_rent_id ON rent (id)'))
+
+# Индекс для поиска по ячейкам строит ревизия 6 (частичные индексы по доступному транспорту)
+def add_transport_geohash(engine):
+    add_column(engine, 'transport', 'geohash', 'VARCHAR(12)')
+
+    while True:
+        with engine.begin() as connection:
+            batch = connection.execute(text(
+                'SELECT id, latitude, longitude FROM transport '
+                'WHERE geohash IS NULL AND latitude IS NOT NULL AND longitude IS NOT NULL LIMIT :limit'), {'limit': BACKFILL_BATCH}).all()
+
+            if not batch:
+                break
+
+            connection.execute(
+                text('UPDATE transport SET geohash = :geohash WHERE id = :id'),
+                [{'id': row.id, 'geohash': geo.encode(row.latitude, row.longitude)} for row in batch])
+
+# Колонка tokenVersion так и не вышла в релиз: токены отзываются через token_revocation (ревизия 7).
+# Ревизия оставлена пустой, чтобы не сдвигать номера
+def add_user_token_version(engine):
+    pass
+
+# Время аренды раньше хранилось строками '%Y-%m-%d %H:%M:%S' в локальном времени сервера.
+# В postgres колонки переводятся в timestamptz на месте (строка читается в часовом поясе сессии);
+# sqlite хранит DateTime в том же строковом виде, и там конвертация не нужна.
+def convert_rent_timestamps(engine):
+    if engine.dialect.name == 'postgresql':
+        columns = {column['name']: column['type'] for column in inspect(engine).get_columns('rent')}
+
+        with engine.begin() as connection:
+            for name in ('startTime', 'endTime'):
+                if isinstance(columns[name], String):
+                    connection.execute(text(
+                        f'ALTER TABLE rent ALTER COLUMN "{name}" TYPE TIMESTAMP WITH TIME ZONE '
+                        f'USING to_timestamp("{name}", \'YYYY-MM-DD HH24:MI:SS\')'))
+
+    create_index(engine, 'ix_rent_renter_user_id_startTime', 'rent (renter_user_id, "startTime")')
+
+# Активной считается последняя аренда транспорта, который сейчас недоступен;
+# просроченные среди них освободит планировщик истечения аренд
+def add_rent_is_active(engine):
+    if add_column(engine, 'rent', 'isActive', 'BOOLEAN NOT NULL DEFAULT TRUE'):
+        with engine.begin() as connection:
+            connection.execute(text(
+                'UPDATE rent SET "isActive" = FALSE WHERE id NOT IN ('
+                'SELECT max(r.id) FROM rent r JOIN transport t ON t.id = r."transportId" '
+                'WHERE t."canBeRented" = FALSE GROUP BY r."transportId")'))
+
+# Индексы под фактические запросы (должны совпадать с __table_args__ в models.py)
+PERFORMANCE_INDEXES = [
+    # FindTransport.get_available: доступный транспорт по типу (или любого типа) в ячейках geohash
+    ('ix_transport_available_type_geohash', 'transport ("transportType", geohash{pattern_ops}) WHERE "canBeRented"'),
+    ('ix_transport_available_geohash', 'transport (geohash{pattern_ops}) WHERE "canBeRented"'),
+    # Транспорт владельца и админский список по типу с курсором по id
+    ('ix_transport_user_id', 'transport (user_id)'),
+    ('ix_transport_transportType_id', 'transport ("transportType", id)'),
+    # FindRent.history: история пользователя или транспорта с курсором по id
+    ('ix_rent_renter_user_id_id', 'rent (renter_user_id, id)'),
+    ('ix_rent_transportId_id', 'rent ("transportId", id)'),
+    # Планировщик истечения: только активные аренды по времени окончания
+    ('ix_rent_active_endTime', 'rent ("endTime") WHERE "isActive"'),
+]
+# Полные индексы, которые ревизии 2 и 4 строили до выхода в релиз; заменены частичными выше
+REPLACED_INDEXES = ['ix_transport_geohash', 'ix_rent_endTime']
+
+def add_performance_indexes(engine):
+    for name, definition in PERFORMANCE_INDEXES:
+        create_index(engine, name, definition)
+
+    for name in REPLACED_INDEXES:
+        drop_index(engine, name)
+
+def add_token_revocation(engine):
+    id_type = 'SERIAL PRIMARY KEY' if engine.dialect.name == 'postgresql' else 'INTEGER PRIMARY KEY'
+
+    with engine.begin() as connection:
+        connection.execute(text(
+            f'CREATE TABLE IF NOT EXISTS token_revocation (id {id_type}, jti VARCHAR, user_id INTEGER, '
+            'issued_before TIMESTAMP WITH TIME ZONE, expires_at TIMESTAMP WITH TIME ZONE NOT NULL)'))
+
+    create_index(engine, 'ix_token_revocation_expires_at', 'token_revocation (expires_at)')
+
+def add_idempotency_key(engine):
+    with engine.begin() as connection:
+        connection.execute(text(
+            'CREATE TABLE IF NOT EXISTS idempotency_key (user_id INTEGER NOT NULL, key VARCHAR NOT NULL, '
+            'fingerprint VARCHAR NOT NULL, status_code INTEGER, body VARCHAR, '
+            'expires_at TIMESTAMP WITH TIME ZONE NOT NULL, PRIMARY KEY (user_id, key))'))
+
+    create_index(engine, 'ix_idempotency_key_expires_at', 'idempotency_key (expires_at)')
+
+def add_analytics_rollups(engine):
+    with engine.begin() as connection:
+        connection.execute(text(
+            'CREATE TABLE IF NOT EXISTS rent_daily (day DATE NOT NULL, "transportType" VARCHAR NOT NULL, owner_id INTEGER NOT NULL, '
+            'rents INTEGER NOT NULL, revenue FLOAT NOT NULL, rented_seconds FLOAT NOT NULL, PRIMARY KEY (day, "transportType", owner_id))'))
+        connection.execute(text(
+            'CREATE TABLE IF NOT EXISTS fleet_daily (day DATE NOT NULL, "transportType" VARCHAR NOT NULL, vehicles INTEGER NOT NULL, '
+            'PRIMARY KEY (day, "transportType"))'))
+
+    create_index(engine, 'ix_rent_startTime', 'rent ("startTime")')
+
+# Убирает tokenVersion из баз, где ревизия 3 успела её добавить; в остальных ничего не делает
+def drop_user_token_version(engine):
+    drop_column(engine, 'users', 'tokenVersion')
+
+# Отметка о построении сводок за всю историю (analytics.backfill)
+def add_analytics_backfill(engine):
+    with engine.begin() as connection:
+        connection.execute(text('CREATE TABLE IF NOT EXISTS analytics_backfill (id INTEGER PRIMARY KEY, completed_at TIMESTAMP WITH TIME ZONE NOT NULL)'))
+
+# Порядок ревизий менять нельзя, новые добавляются в конец
+REVISIONS = [
+    (1, 'initial schema', create_schema),
+    (2, 'transport geohash', add_transport_geohash),
+    (3, 'user token version', add_user_token_version),
+    (4, 'rent timestamps with time zone', convert_rent_timestamps),
+    (5, 'rent isActive', add_rent_is_active),
+    (6, 'performance and partial indexes', add_performance_indexes),
+    (7, 'token revocation', add_token_revocation),
+    (8, 'idempotency keys', add_idempotency_key),
+    (9, 'analytics rollups', add_analytics_rollups),
+    (10, 'drop user token version', drop_user_token_version),
+    (11, 'analytics backfill marker', add_analytics_backfill),
+]
+
+def pending_revisions(engine):
+    applied = set()
+
+    if inspect(engine).has_table('schema_version'):
+        with engine.connect() as connection:
+            applied = set(connection.execute(text('SELECT version FROM schema_version')).scalars())
+
+    return [revision for revision in REVISIONS if revision[0] not in applied]
+
+def upgrade(engine):
+    postgres = engine.dialect.name == 'postgresql'
+
+    with engine.execution_options(isolation_level='AUTOCOMMIT').connect() as lock:
+        if postgres:
+            lock.execute(text('SELECT pg_advisory_lock(:key)'), {'key': MIGRATION_LOCK_KEY})
+
+        try:
+            with engine.begin() as connection:
+                connection.execute(text(
+                    'CREATE TABLE IF NOT EXISTS schema_version ('
+                    'version INTEGER PRIMARY KEY, name VARCHAR NOT NULL, applied_at TIMESTAMP WITH TIME ZONE NOT NULL)'))
+
+            for version, name, migrate in pending_revisions(engine):
+                print(f'Applying {version}: {name}')
+                migrate(engine)
+
+                with engine.begin() as connection:
+                    connection.execute(
+                        text('INSERT INTO schema_version (version, name, applied_at) VALUES (:version, :name, :applied_at)'),
+                        {'version': version, 'name': name, 'applied_at': datetime.now(timezone.utc)})
+        finally:
+            if postgres:
+                lock.execute(text('SELECT pg_advisory_unlock(:key)'), {'key': MIGRATION_LOCK_KEY})
+
+# Сервер не применяет миграции сам, а только отказывается стартовать на устаревшей схеме
+def check_schema(engine):
+    pending = pending_revisions(engine)
+
+    if pending:
+        raise RuntimeError(f"Database schema is out of date ({len(pending)} pending revisions), run: py migrations.py")
+
+def status(engine):
+    pending = {revision[0] for revision in pending_revisions(engine)}
+
+    for version, name, _ in REVISIONS:
+        print(f"{version:4} {'pending' if version in pending else 'applied':8} {name}")
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else 'upgrade'
+
+    if command == 'upgrade':
+        upgrade(engine)
+    elif command == 'status':
+        status(engine)
+    else:
+        sys.exit(f'Unknown command: {command}')
@@ -1,6 +1,7 @@
-from sqlalchemy import Column, Integer, String, Boolean, Float, ForeignKey
+from sqlalchemy import Column, Integer, String, Boolean, Float, Date, DateTime, ForeignKey, Index, and_, delete, func, or_, select, text
 from sqlalchemy.orm import relationship
 from sqlalchemy.orm import Session
+from datetime import date, datetime, timedelta
 from database import Base
 
 class User(Base):
@@ -15,14 +16,25 @@ class User(Base):
     balance = Column(Float, default=0)
     isAdmin = Column(Boolean, default=False)
 
+# Колонки, которые отдаются наружу: списки выбираются кортежами, без создания ORM-объектов
+USER_COLUMNS = (User.id, User.name, User.disabled, User.balance, User.isAdmin)
+
 class FindUser:
     @staticmethod
     def get_user_by_id(id: int, db: Session):
-        return db.query(User).filter(User.id == id).first()
+        return db.execute(select(User).filter(User.id == id)).scalars().first()
 
     @staticmethod
     def get_user_by_name(name: str, db: Session):
-        return db.query(User).filter(User.name == name).first()
+        return db.execute(select(User).filter(User.name == name)).scalars().first()
+
+    @staticmethod
+    def get_users(start: int, count: int, db: Session):
+        return db.execute(select(*USER_COLUMNS).offset(start).limit(count)).all()
+
+    @staticmethod
+    def get_users_after(after_id: int, count: int, db: Session):
+        return db.execute(select(*USER_COLUMNS).filter(User.id > after_id).order_by(User.id).limit(count)).all()
 
 class Transport(Base):
     __tablename__ = 'transport'
@@ -39,13 +51,63 @@ class Transport(Base):
     description = Column(String, nullable=True)
     latitude = Column(Float)
     longitude = Column(Float)
+    geohash = Column(String(12), nullable=True)
     minutePrice = Column(Float, nullable=True)
     dayPrice = Column(Float, nullable=True)
 
+    # Индексы создаются миграцией performance and partial indexes (migrations.py)
+    __table_args__ = (
+        Index('ix_transport_available_type_geohash', 'transportType', 'geohash', postgresql_ops={'geohash': 'varchar_pattern_ops'},
+              postgresql_where=text('"canBeRented"'), sqlite_where=text('"canBeRented"')),
+        Index('ix_transport_available_geohash', 'geohash', postgresql_ops={'geohash': 'varchar_pattern_ops'},
+              postgresql_where=text('"canBeRented"'), sqlite_where=text('"canBeRented"')),
+        Index('ix_transport_user_id', 'user_id'),
+        Index('ix_transport_transportType_id', 'transportType', 'id'),
+    )
+
+TRANSPORT_COLUMNS = (Transport.id, Transport.user_id, Transport.canBeRented, Transport.transportType, Transport.model, Transport.color,
+                     Transport.identifier, Transport.description, Transport.latitude, Transport.longitude, Transport.minutePrice, Transport.dayPrice)
+
 class FindTransport:
     @staticmethod
     def get_transport_by_id(id: int, db: Session):
-        return db.query(Transport).filter(Transport.id == id).first()
+        return db.execute(select(Transport).filter(Transport.id == id)).scalars().first()
+
+    @staticmethod
+    def get_transports(start: int, count: int, transportType: str, db: Session):
+        query = select(*TRANSPORT_COLUMNS)
+
+        if transportType != "All":
+            query = query.filter(Transport.transportType == transportType)
+
+        return db.execute(query.offset(start).limit(count)).all()
+
+    @staticmethod
+    def get_transports_after(after_id: int, count: int, transportType: str, db: Session):
+        query = select(*TRANSPORT_COLUMNS).filter(Transport.id > after_id)
+
+        if transportType != "All":
+            query = query.filter(Transport.transportType == transportType)
+
+        return db.execute(query.order_by(Transport.id).limit(count)).all()
+
+    @staticmethod
+    def get_prices(ids: list[int], db: Session):
+        return db.execute(
+            select(Transport.id, Transport.canBeRented, Transport.minutePrice, Transport.dayPrice)
+            .filter(Transport.id.in_(ids))).all()
+
+    @staticmethod
+    def get_available(type: str, cells, db: Session):
+        query = select(*TRANSPORT_COLUMNS).filter(Transport.canBeRented == True)
+
+        if cells is not None:
+            query = query.filter(or_(*[Transport.geohash.startswith(cell) for cell in cells]))
+
+        if type is not None:
+            query = query.filter(Transport.transportType == type)
+
+        return db.execute(query).all()
 
 class Rent(Base):
     __tablename__ = 'rent'
@@ -56,27 +118,186 @@ class Rent(Base):
     transport = relationship("Transport", back_populates="rents")
     renter_user_id = Column(Integer, ForeignKey('users.id'))
     renter_user = relationship("User", back_populates="rents_as_renter", foreign_keys=[renter_user_id])
-    startTime = Column(String)
-    endTime = Column(String, nullable=True)
+    startTime = Column(DateTime(timezone=True))
+    endTime = Column(DateTime(timezone=True), nullable=True)
     priceOfUnit = Column(Float)
     finalPrice = Column(Float, nullable=True)
+    # Аренда держит транспорт, пока её не завершат или она не истечёт
+    isActive = Column(Boolean, default=True, nullable=False)
+
+    __table_args__ = (
+        Index('ix_rent_renter_user_id_startTime', 'renter_user_id', 'startTime'),
+        Index('ix_rent_renter_user_id_id', 'renter_user_id', 'id'),
+        Index('ix_rent_transportId_id', 'transportId', 'id'),
+        Index('ix_rent_active_endTime', 'endTime', postgresql_where=text('"isActive"'), sqlite_where=text('"isActive"')),
+        Index('ix_rent_startTime', 'startTime'),
+    )
 
 class FindRent:
     @staticmethod
     def get_rent_by_id(id: int, db: Session):
-        return db.query(Rent).filter(Rent.id == id).first()
+        return db.execute(select(Rent).filter(Rent.id == id)).scalars().first()
     
+    # История аренд как запрос по колонкам (без ORM-объектов), упорядоченный по id для keyset-пагинации
     @staticmethod
-    def get_rent_by_user_id(id: int, db: Session):
-        return db.query(Rent).filter(Rent.renter_user_id == id).all()
-    
+    def history(renter_user_id: int = None, transportId: int = None, since: datetime = None, until: datetime = None, after: int = 0):
+        query = select(*Rent.__table__.c).filter(Rent.id > after)
+
+        if renter_user_id is not None:
+            query = query.filter(Rent.renter_user_id == renter_user_id)
+
+        if transportId is not None:
+            query = query.filter(Rent.transportId == transportId)
+
+        if since is not None:
+            query = query.filter(Rent.startTime >= since)
+
+        if until is not None:
+            query = query.filter(Rent.startTime < until)
+
+        return query.order_by(Rent.id)
+
+# Отозванные токены: по jti (выход из системы) или все токены пользователя, выданные до issued_before
+# (смена пароля, прав, блокировка, удаление). Строки не нужны после expires_at — к этому времени
+# отозванные токены истекают сами.
+class TokenRevocation(Base):
+    __tablename__ = 'token_revocation'
+
+    id = Column(Integer, primary_key=True)
+    jti = Column(String, nullable=True)
+    user_id = Column(Integer, nullable=True)
+    issued_before = Column(DateTime(timezone=True), nullable=True)
+    expires_at = Column(DateTime(timezone=True), nullable=False)
+
+    __table_args__ = (
+        Index('ix_token_revocation_expires_at', 'expires_at'),
+    )
+
+class FindTokenRevocation:
     @staticmethod
-    def get_rent_by_transport_id(id: int, db: Session):
-        return db.query(Rent).filter(Rent.transportId == id).all()
-    
+    def get_after(after_id: int, db: Session):
+        return db.execute(
+            select(TokenRevocation.id, TokenRevocation.jti, TokenRevocation.user_id, TokenRevocation.issued_before, TokenRevocation.expires_at)
+            .filter(TokenRevocation.id > after_id)
+            .order_by(TokenRevocation.id)).all()
+
+    @staticmethod
+    def delete_expired(now: datetime, db: Session):
+        count = db.execute(delete(TokenRevocation).where(TokenRevocation.expires_at < now)).rowcount
+        db.commit()
+        return count
+
+# Сохранённые ответы на запросы с заголовком Idempotency-Key, ключи — в пространстве пользователя.
+# Строка без status_code — запрос с этим ключом ещё выполняется; повторы ждут его завершения.
+class IdempotencyKey(Base):
+    __tablename__ = 'idempotency_key'
+
+    user_id = Column(Integer, primary_key=True)
+    key = Column(String, primary_key=True)
+    fingerprint = Column(String, nullable=False)
+    status_code = Column(Integer, nullable=True)
+    body = Column(String, nullable=True)
+    expires_at = Column(DateTime(timezone=True), nullable=False)
+
+    __table_args__ = (
+        Index('ix_idempotency_key_expires_at', 'expires_at'),
+    )
+
+class FindIdempotencyKey:
+    @staticmethod
+    def get(user_id: int, key: str, db: Session):
+        return db.execute(
+            select(IdempotencyKey.fingerprint, IdempotencyKey.status_code, IdempotencyKey.body, IdempotencyKey.expires_at)
+            .filter(IdempotencyKey.user_id == user_id, IdempotencyKey.key == key)).first()
+
+    @staticmethod
+    def delete_expired(now: datetime, db: Session):
+        count = db.execute(delete(IdempotencyKey).where(IdempotencyKey.expires_at < now)).rowcount
+        db.commit()
+        return count
+
+# Сводки для админской аналитики, пересчитываются по дням фоновой задачей (analytics.py).
+# Выручка и число аренд относятся ко дню начала аренды, время аренды делится по дням, которые она покрывает.
+class RentDaily(Base):
+    __tablename__ = 'rent_daily'
+
+    day = Column(Date, primary_key=True)
+    transportType = Column(String, primary_key=True)
+    owner_id = Column(Integer, primary_key=True)
+    rents = Column(Integer, nullable=False)
+    revenue = Column(Float, nullable=False)
+    rented_seconds = Column(Float, nullable=False)
+
+# Размер парка по типам на день (последний пересчёт в течение этого дня)
+class FleetDaily(Base):
+    __tablename__ = 'fleet_daily'
+
+    day = Column(Date, primary_key=True)
+    transportType = Column(String, primary_key=True)
+    vehicles = Column(Integer, nullable=False)
+
+# Отметка о построении сводок за всю историю аренд: единственная строка с id = 1
+class AnalyticsBackfill(Base):
+    __tablename__ = 'analytics_backfill'
+
+    id = Column(Integer, primary_key=True)
+    completed_at = Column(DateTime(timezone=True), nullable=False)
+
+class FindAnalytics:
+    # Аренды, пересекающие [start, end): начатые не раньше чем за max_days до start, и все активные
+    @staticmethod
+    def overlapping(start: datetime, end: datetime, max_days: int, db: Session):
+        recent = and_(Rent.startTime >= start - timedelta(days=max_days), or_(Rent.endTime == None, Rent.endTime > start))
+        return db.execute(
+            select(Rent.startTime, Rent.endTime, Rent.finalPrice, Transport.transportType, Transport.user_id)
+            .outerjoin(Transport, Transport.id == Rent.transportId)
+            .filter(Rent.startTime < end, or_(recent, Rent.isActive == True))).all()
+
+    @staticmethod
+    def fleet(db: Session):
+        return db.execute(select(Transport.transportType, func.count()).group_by(Transport.transportType)).all()
+
+    @staticmethod
+    def first_rent_start(db: Session):
+        return db.execute(select(func.min(Rent.startTime))).scalar()
+
+    @staticmethod
+    def backfilled(db: Session):
+        return db.execute(select(AnalyticsBackfill.id)).first() is not None
+
+    @staticmethod
+    def revenue(first: date, last: date, column, db: Session):
+        return db.execute(
+            select(column.label('key'), func.sum(RentDaily.rents).label('rents'), func.sum(RentDaily.revenue).label('revenue'))
+            .filter(RentDaily.day.between(first, last), RentDaily.rents > 0)
+            .group_by(column)
+            .order_by(column)).all()
+
+    @staticmethod
+    def rented_seconds(first: date, last: date, type: str, db: Session):
+        query = (select(RentDaily.day, RentDaily.transportType, func.sum(RentDaily.rented_seconds).label('seconds'))
+            .filter(RentDaily.day.between(first, last))
+            .group_by(RentDaily.day, RentDaily.transportType))
+
+        if type is not None:
+            query = query.filter(RentDaily.transportType == type)
+
+        return db.execute(query).all()
+
+    @staticmethod
+    def fleet_by_day(first: date, last: date, type: str, db: Session):
+        query = select(FleetDaily.day, FleetDaily.transportType, FleetDaily.vehicles).filter(FleetDaily.day.between(first, last))
+
+        if type is not None:
+            query = query.filter(FleetDaily.transportType == type)
+
+        return db.execute(query.order_by(FleetDaily.day, FleetDaily.transportType)).all()
+
     @staticmethod
-    def get_rent_by_transport_id_and_user_id(transportId: int, user_id: int, db: Session):
-        return db.query(Rent).join(Transport, Rent.transportId == Transport.id).filter(
-        Rent.transportId == transportId,
-        Transport.user_id == user_id
-    ).all()
\ No newline at end of file
+    def active_rents(db: Session):
+        return db.execute(
+            select(Transport.transportType, func.count())
+            .select_from(Rent)
+            .outerjoin(Transport, Transport.id == Rent.transportId)
+            .filter(Rent.isActive == True)
+            .group_by(Transport.transportType)).all()
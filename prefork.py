@@ -0,0 +1,138 @@
+import gc
+import logging
+import os
+import signal
+import time
+import uvicorn
+
+import database
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Production-режим: главный процесс открывает сокет и загружает приложение, затем fork'ает воркеры uvicorn,
+# которые принимают соединения с общего сокета; упавший воркер перезапускается.
+# Первый SIGTERM или SIGINT останавливает воркеры мягко: они перестают принимать соединения и дорабатывают
+# начатые запросы до SERVER_GRACEFUL_TIMEOUT секунд. Повторный сигнал завершает их сразу.
+def available_cpus() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+# Число воркеров; по умолчанию — по числу доступных процессору ядер.
+# Пул соединений БД (DB_POOL_SIZE + DB_MAX_OVERFLOW) у каждого воркера свой
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY") or available_cpus())
+SERVER_GRACEFUL_TIMEOUT = int(os.getenv("SERVER_GRACEFUL_TIMEOUT", "30"))
+# Запас сверх SERVER_GRACEFUL_TIMEOUT на остановку фоновых задач, после которого воркер убивается
+SHUTDOWN_MARGIN = 10
+RESPAWN_DELAY = 1
+POLL_INTERVAL = 0.2
+# Код выхода воркера, который не смог запуститься (ошибка в startup); такой воркер не перезапускается
+STARTUP_FAILURE = 3
+
+def run_worker(config: uvicorn.Config, sock):
+    status = 1
+
+    try:
+        # Ctrl+C из терминала получает только главный процесс, он и решает, как останавливать воркеры
+        os.setpgid(0, 0)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        database.dispose_after_fork()
+
+        server = uvicorn.Server(config)
+        server.run(sockets=[sock])
+        status = 0 if server.started else STARTUP_FAILURE
+    except SystemExit as error:
+        status = error.code if isinstance(error.code, int) else 1
+    except BaseException:
+        logger.exception("Worker %s crashed", os.getpid())
+    finally:
+        logging.shutdown()
+        os._exit(status)
+
+def serve(app, host: str, port: int, workers: int = WEB_CONCURRENCY) -> int:
+    config = uvicorn.Config(app, host=host, port=port, loop='auto', http='auto', timeout_graceful_shutdown=SERVER_GRACEFUL_TIMEOUT)
+
+    # Без fork (Windows) остаётся один процесс
+    if not hasattr(os, 'fork'):
+        logger.warning("os.fork is not available, serving with a single process")
+        uvicorn.Server(config).run()
+        return 0
+
+    sock = config.bind_socket()
+    # Общий для воркеров каталог снимков метрик этого запуска
+    metrics.new_run()
+    # pid -> число сигналов остановки, уже переданных воркеру
+    children: dict[int, int] = {}
+    signals = 0
+    failed = False
+    deadline = None
+
+    def handle_signal(sig, frame):
+        nonlocal signals
+        signals += 1
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+
+    def spawn():
+        pid = os.fork()
+
+        if pid == 0:
+            run_worker(config, sock)
+        children[pid] = 0
+
+    # Загруженное приложение переходит в воркеры без копирования; сборщик мусора не трогает эти объекты
+    # и не заставляет копировать страницы памяти
+    gc.collect()
+    gc.freeze()
+
+    for _ in range(workers):
+        spawn()
+    logger.info("Started %s workers [%s]", workers, ', '.join(map(str, children)))
+
+    while children:
+        # Сигналы пересылаются здесь, а не в обработчике, чтобы не пропустить воркер, запущенный одновременно с сигналом.
+        # Для uvicorn SIGTERM — мягкая остановка, SIGINT после неё — немедленная
+        for pid, sent in children.items():
+            if sent < min(signals, 2):
+                os.kill(pid, signal.SIGTERM if sent == 0 else signal.SIGINT)
+                children[pid] = sent + 1
+
+        if signals and deadline is None:
+            deadline = time.monotonic() + SERVER_GRACEFUL_TIMEOUT + SHUTDOWN_MARGIN
+        if deadline is not None and time.monotonic() > deadline:
+            logger.error("Workers did not stop in time, killing %s", ', '.join(map(str, children)))
+            for pid in children:
+                os.kill(pid, signal.SIGKILL)
+            deadline = float('inf')
+
+        pid, status = os.waitpid(-1, os.WNOHANG)
+
+        if pid == 0:
+            time.sleep(POLL_INTERVAL)
+            continue
+
+        children.pop(pid, None)
+        code = os.waitstatus_to_exitcode(status)
+
+        if signals:
+            continue
+
+        if code == STARTUP_FAILURE:
+            # Остальные воркеры, скорее всего, упадут так же: останавливается весь сервер
+            logger.error("Worker %s failed to start, shutting down", pid)
+            failed = True
+            signals = 1
+            continue
+
+        logger.warning("Worker %s exited with code %s, restarting", pid, code)
+        time.sleep(RESPAWN_DELAY)
+        spawn()
+
+    sock.close()
+    metrics.remove_run()
+    logger.info("All workers stopped")
+    return 1 if failed else 0
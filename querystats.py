@@ -0,0 +1,94 @@
+from sqlalchemy import event
+from fastapi import Depends
+import contextvars
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+# Одинаковый запрос, выполненный за один HTTP-запрос не меньше этого числа раз, считается N+1
+N_PLUS_ONE_THRESHOLD = int(os.getenv("N_PLUS_ONE_THRESHOLD", "3"))
+# В строгом режиме (для тестов) превышение бюджета запросов роняет обработчик
+QUERY_BUDGET_STRICT = os.getenv("QUERY_BUDGET_STRICT", "False").lower() in ("1", "true", "yes")
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+class QueryStats:
+    __slots__ = ('count', 'duration', 'statements', 'budget')
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.statements = {}
+        self.budget = None
+
+    def suspects(self):
+        return {statement: count for statement, count in self.statements.items() if count >= N_PLUS_ONE_THRESHOLD}
+
+current = contextvars.ContextVar('query_stats', default=None)
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info['query_started'] = time.perf_counter()
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = current.get()
+
+    if stats is None:
+        return
+
+    stats.count += 1
+    stats.duration += time.perf_counter() - conn.info.pop('query_started', time.perf_counter())
+    stats.statements[statement] = stats.statements.get(statement, 0) + 1
+
+    if QUERY_BUDGET_STRICT and stats.budget is not None and stats.count > stats.budget:
+        raise QueryBudgetExceeded(f"Query budget of {stats.budget} exceeded")
+
+def instrument(engine):
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+
+# Бюджет запросов к БД для маршрута: dependencies=[query_budget(3)]
+def query_budget(limit: int):
+    def set_budget():
+        stats = current.get()
+
+        if stats is not None:
+            stats.budget = limit
+
+    return Depends(set_budget)
+
+# Считает запросы и время в БД на каждый HTTP-запрос и отдаёт их в заголовке Server-Timing
+class QueryStatsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        stats = QueryStats()
+        token = current.set(stats)
+
+        async def send_with_stats(message):
+            if message['type'] == 'http.response.start':
+                headers = list(message.get('headers', []))
+                headers.append((b'server-timing', f'db;dur={stats.duration * 1000:.2f};desc="{stats.count} queries"'.encode()))
+                suspects = stats.suspects()
+
+                if suspects:
+                    headers.append((b'x-db-n-plus-one', str(len(suspects)).encode()))
+                    logger.warning("N+1 suspects on %s %s: %s", scope['method'], scope['path'], suspects)
+
+                if stats.budget is not None and stats.count > stats.budget:
+                    headers.append((b'x-db-query-budget', f'{stats.count}/{stats.budget}'.encode()))
+                    logger.warning("Query budget exceeded on %s %s: %s/%s", scope['method'], scope['path'], stats.count, stats.budget)
+
+                message['headers'] = headers
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_stats)
+        finally:
+            current.reset(token)
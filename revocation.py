@@ -0,0 +1,122 @@
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from datetime import datetime, timezone
+import asyncio
+import logging
+import os
+import time
+
+from database import run_in_session
+from models import TokenRevocation, FindTokenRevocation
+from scheduler import utc
+
+logger = logging.getLogger(__name__)
+
+# Проверка отзыва токена без запросов к БД: каждый воркер держит в памяти отозванные jti
+# и отметки «все токены пользователя, выданные раньше T», и раз в REVOCATION_SYNC_INTERVAL секунд
+# дочитывает новые строки token_revocation. Отзыв в своём воркере действует сразу после commit.
+REVOCATION_SYNC_INTERVAL = float(os.getenv("REVOCATION_SYNC_INTERVAL", "2"))
+REVOCATION_CLEANUP_INTERVAL = float(os.getenv("REVOCATION_CLEANUP_INTERVAL", "300"))
+# id выдаются последовательностью, но транзакции фиксируются не по порядку:
+# последние id перечитываются, чтобы не пропустить строку, закоммиченную позже соседней
+SYNC_OVERLAP = 100
+
+# jti -> время истечения токена (epoch)
+tokens: dict[str, float] = {}
+# id пользователя -> (issued_before, время истечения отметки)
+users: dict[int, tuple[float, float]] = {}
+last_id = 0
+
+task: asyncio.Task | None = None
+stopping: asyncio.Event | None = None
+
+def apply(jti: str | None, user_id: int | None, issued_before: float | None, expires: float):
+    if jti is not None:
+        tokens[jti] = expires
+
+    if user_id is not None:
+        current = users.get(user_id)
+        if current is None or current[0] < issued_before:
+            users[user_id] = (issued_before, expires)
+
+def is_revoked(payload: dict) -> bool:
+    jti = payload.get('jti')
+
+    if jti is not None and jti in tokens:
+        return True
+
+    cut = users.get(payload.get('id'))
+    return cut is not None and payload.get('iat', 0) < cut[0]
+
+# Добавляет отзыв в сессию; в память воркера он попадает после commit
+def revoke(db: Session, expires_at: datetime, jti: str = None, user_id: int = None):
+    issued_before = datetime.now(timezone.utc) if user_id is not None else None
+    db.add(TokenRevocation(jti=jti, user_id=user_id, issued_before=issued_before, expires_at=expires_at))
+    db.info.setdefault('token_revocations', []).append(
+        (jti, user_id, issued_before.timestamp() if issued_before is not None else None, expires_at.timestamp()))
+
+@event.listens_for(Session, 'after_commit')
+def after_commit(session):
+    for revocation in session.info.pop('token_revocations', ()):
+        apply(*revocation)
+
+@event.listens_for(Session, 'after_rollback')
+def after_rollback(session):
+    session.info.pop('token_revocations', None)
+
+async def sync():
+    global last_id
+
+    for row in await run_in_session(FindTokenRevocation.get_after, max(0, last_id - SYNC_OVERLAP)):
+        issued_before = utc(row.issued_before).timestamp() if row.issued_before is not None else None
+        apply(row.jti, row.user_id, issued_before, utc(row.expires_at).timestamp())
+        last_id = max(last_id, row.id)
+
+# Истёкшие отзывы больше не нужны ни в памяти, ни в таблице.
+# Словари чистятся на месте: отзывы из пула потоков пишут в них же
+async def cleanup():
+    now = time.time()
+
+    for jti, expires in list(tokens.items()):
+        if expires <= now:
+            tokens.pop(jti, None)
+
+    for user_id, cut in list(users.items()):
+        if cut[1] <= now:
+            users.pop(user_id, None)
+
+    await run_in_session(FindTokenRevocation.delete_expired, datetime.now(timezone.utc))
+
+async def run():
+    cleaned = time.monotonic()
+
+    while not stopping.is_set():
+        try:
+            await asyncio.wait_for(stopping.wait(), REVOCATION_SYNC_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+        try:
+            await sync()
+
+            if time.monotonic() - cleaned >= REVOCATION_CLEANUP_INTERVAL:
+                cleaned = time.monotonic()
+                await cleanup()
+        except Exception:
+            logger.exception("Token revocation sync failed")
+
+# Первая загрузка выполняется до приёма запросов, иначе только что запущенный воркер
+# пропускал бы отозванные токены
+async def start():
+    global task, stopping
+    await sync()
+    stopping = asyncio.Event()
+    task = asyncio.get_running_loop().create_task(run())
+
+async def stop():
+    global task
+
+    if task is not None:
+        stopping.set()
+        await task
+        task = None
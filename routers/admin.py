@@ -1,141 +1,190 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, UploadFile
+from datetime import date, timedelta
+from typing import Annotated, Literal
 
-from database import db_dependency
+from database import db_dependency, read_db_dependency, run_db
+from admission import limit
 from routers.user import user_a
-from models import User, FindUser, Transport, FindTransport, FindRent
-from dtos import AdminUserRequest, AdminTransportModel, AdminRentModel, AdminRentModelWithAll
-from services import create_user_request, update_user, create_transport_request, update_transport, create_rent_request, end_rent
+from models import FindUser, FindTransport, FindRent, FindAnalytics, RentDaily
+from dtos import AdminUserRequest, AdminTransportModel, TelemetryPoint, AdminRentModel, AdminRentModelWithAll, HistoryQuery, UserRead, TransportRead, RentRead, Page, RevenueRead, UtilizationRead, ActiveRentsRead
+import analytics
+import telemetry
+from services import create_user_request, update_user, create_transport_request, update_transport, create_rent_request, end_rent, delete_entity, update_rent, import_transports, export_transports, hash, new_password_hash, decode_cursor, list_response, rent_history_query, history_response
 
-adminaccount = APIRouter(prefix='/api/Admin/Account', tags=["AdminAccountController"])
+# Общие ограничения админских роутеров: выгрузки и импорт тяжёлые, частота запросов не ограничивается
+admin_limit = limit('admin', concurrency=16)
 
-@adminaccount.get("/", summary="Получить все аккаунты")
-async def get_all_accounts(user: user_a, db: db_dependency, start: int = 0, count: int = 10):
-    accounts = db.query(User).offset(start).limit(count).all()
-    return accounts
+adminaccount = APIRouter(prefix='/api/Admin/Account', tags=["AdminAccountController"], dependencies=[admin_limit])
 
-@adminaccount.get("/{id}", summary="Получить аккаунт по ID")
+@adminaccount.get("/", response_model=list[UserRead] | Page[UserRead], summary="Получить все аккаунты")
+async def get_all_accounts(user: user_a, db: read_db_dependency, start: int = 0, count: int = 10, cursor: str = None):
+    # С параметром cursor (пустой — первая страница) выдача идёт по id и возвращает next_cursor
+    if cursor is not None:
+        accounts = await run_db(db, FindUser.get_users_after, decode_cursor(cursor), count)
+        return list_response(accounts, count)
+
+    accounts = await run_db(db, FindUser.get_users, start, count)
+    return list_response(accounts)
+
+@adminaccount.get("/{id}", response_model=UserRead | None, summary="Получить аккаунт по ID")
 async def get_account_by_id(id: int, user: user_a, db: db_dependency):
-    account = FindUser.get_user_by_id(id, db)
+    account = await run_db(db, FindUser.get_user_by_id, id)
     return account
 
-@adminaccount.post("/", summary="Создать аккаунт")
+@adminaccount.post("/", response_model=UserRead, summary="Создать аккаунт")
 async def create_account(data: AdminUserRequest, user: user_a, db: db_dependency):
-    account = create_user_request(data, db)
+    account = await run_db(db, create_user_request, data, await hash(data.password))
     return account
 
-@adminaccount.put("/{id}", summary="Обновить аккаунт по ID")
+@adminaccount.put("/{id}", response_model=UserRead, summary="Обновить аккаунт по ID")
 async def update_account(id: int, data: AdminUserRequest, user: user_a, db: db_dependency):
-    user = FindUser.get_user_by_id(id, db)
-    account = update_user(user, data, db)
+    user = await run_db(db, FindUser.get_user_by_id, id)
+    account = await run_db(db, update_user, user, data, await new_password_hash(user, data.password))
     return account
 
-@adminaccount.delete("/{id}", summary="Удалить аккаунт по ID")
+@adminaccount.delete("/{id}", response_model=UserRead, summary="Удалить аккаунт по ID")
 async def delete_account(id: int, user: user_a, db: db_dependency):
-    user = FindUser.get_user_by_id(id, db)
+    user = await run_db(db, FindUser.get_user_by_id, id)
 
     if user is None:
         raise HTTPException(status_code=404, detail="Account not found")
 
-    db.delete(user)
-    db.commit()
-    return user
+    return await run_db(db, delete_entity, user)
+
+admintranstor = APIRouter(prefix='/api/Admin/Transport', tags=["AdminTranstorController"], dependencies=[admin_limit])
 
-admintranstor = APIRouter(prefix='/api/Admin/Transport', tags=["AdminTranstorController"])
+@admintranstor.get("/", response_model=list[TransportRead] | Page[TransportRead], summary="Получить все транспортные средства")
+async def get_all_transport(user: user_a, db: read_db_dependency, start: int = 0, count: int = 10, transportType: str = 'All', cursor: str = None):
+    if cursor is not None:
+        transports = await run_db(db, FindTransport.get_transports_after, decode_cursor(cursor), count, transportType)
+        return list_response(transports, count)
 
-@admintranstor.get("/", summary="Получить все транспортные средства")
-async def get_all_transport(user: user_a, db: db_dependency, start: int = 0, count: int = 10, transportType: str = 'All'):
-    query = db.query(Transport)
-    
-    if transportType != "All":
-        query = query.filter(Transport.transportType == transportType)
-    
-    query = query.offset(start).limit(count)
-    transports = query.all()
-    return transports
+    transports = await run_db(db, FindTransport.get_transports, start, count, transportType)
+    return list_response(transports)
 
-@admintranstor.get("/{id}", summary="Получить транспорт по ID")
+# Объявлен раньше /{id}, иначе путь Export разбирался бы как id
+@admintranstor.get("/Export", summary="Выгрузить весь транспорт в CSV")
+async def export_transport(user: user_a, db: read_db_dependency):
+    return export_transports(db)
+
+@admintranstor.get("/{id}", response_model=TransportRead | None, summary="Получить транспорт по ID")
 async def get_transport_by_id(id: int, user: user_a, db: db_dependency):
-    transport = FindTransport.get_transport_by_id(id, db)
+    transport = await run_db(db, FindTransport.get_transport_by_id, id)
     return transport
 
-@admintranstor.post("/", summary="Создать новое транспортное средство с указанием владельца")
+@admintranstor.post("/", response_model=TransportRead, summary="Создать новое транспортное средство с указанием владельца")
 async def create_transport(data: AdminTransportModel, user: user_a, db: db_dependency):
-    transport = create_transport_request(data, db)
+    transport = await run_db(db, create_transport_request, data)
     return transport
 
-@admintranstor.put("/{id}", summary="Обновить транспорт по ID")
+@admintranstor.post("/Import", summary="Массовый импорт транспорта из CSV или NDJSON")
+async def import_transport(file: UploadFile, user: user_a, db: db_dependency, format: Literal['csv', 'ndjson'] = None):
+    # Без параметра format формат определяется по расширению файла
+    if format is None:
+        format = 'ndjson' if (file.filename or '').endswith(('.ndjson', '.jsonl')) else 'csv'
+
+    return await run_db(db, import_transports, file.file, format)
+
+# Точки только буферизуются: позиции попадают в БД при ближайшей записи буфера
+@admintranstor.post("/Telemetry", status_code=202, summary="Принять пачку точек телеметрии транспорта")
+async def post_telemetry(points: list[TelemetryPoint], user: user_a):
+    if len(points) > telemetry.TELEMETRY_MAX_BATCH:
+        raise HTTPException(status_code=413, detail=f"Too many points, max {telemetry.TELEMETRY_MAX_BATCH}")
+
+    accepted, dropped = telemetry.accept(points)
+    return {'accepted': accepted, 'dropped': dropped}
+
+@admintranstor.put("/{id}", response_model=TransportRead, summary="Обновить транспорт по ID")
 async def update_transport_by_id(id: int, data: AdminTransportModel, user: user_a, db: db_dependency):
-    query = FindTransport.get_transport_by_id(id, db)
-    transport = update_transport(query, data, db)
+    query = await run_db(db, FindTransport.get_transport_by_id, id)
+    transport = await run_db(db, update_transport, query, data)
     return transport
 
-@admintranstor.delete("/{id}", summary="Удалить транспорт по ID")
+@admintranstor.delete("/{id}", response_model=TransportRead, summary="Удалить транспорт по ID")
 async def delete_transport(id: int, user: user_a, db: db_dependency):
-    transport = FindTransport.get_transport_by_id(id, db)
+    transport = await run_db(db, FindTransport.get_transport_by_id, id)
 
     if transport is None:
         raise HTTPException(status_code=404, detail="Transport not found")
 
-    db.delete(transport)
-    db.commit()
-    return transport
+    return await run_db(db, delete_entity, transport)
 
-adminrent = APIRouter(prefix='/api/Admin', tags=["AdminRentController"])
+adminrent = APIRouter(prefix='/api/Admin', tags=["AdminRentController"], dependencies=[admin_limit])
 
-@adminrent.get("/Rent/{rentId}", summary="Получить аренду по ID")
+@adminrent.get("/Rent/{rentId}", response_model=RentRead | None, summary="Получить аренду по ID")
 async def get_rent_by_id(rentId: int, user: user_a, db: db_dependency):
-    rent = FindRent.get_rent_by_id(rentId, db)
+    rent = await run_db(db, FindRent.get_rent_by_id, rentId)
     return rent
 
-@adminrent.get("/UserHistory/{userId}", summary="Получить историю аренды по ID аккаунта")
-async def get_rent_history_by_account_id(userId: int, user: user_a, db: db_dependency):
-    rent = FindRent.get_rent_by_user_id(userId, db)
-    return rent
+@adminrent.get("/UserHistory/{userId}", response_model=list[RentRead] | Page[RentRead], summary="Получить историю аренды по ID аккаунта")
+async def get_rent_history_by_account_id(userId: int, user: user_a, db: read_db_dependency, params: Annotated[HistoryQuery, Depends()]):
+    query = rent_history_query(params, renter_user_id=userId)
+    return await history_response(query, params, db)
 
-@adminrent.get("/TransportHistory/{transportId}", summary="Получить историю аренды по ID транспорта")
-async def get_rent_transport_history_by_account_id(transportId: int, user: user_a, db: db_dependency):
-    rent = FindRent.get_rent_by_transport_id(transportId, db)
-    return rent
+@adminrent.get("/TransportHistory/{transportId}", response_model=list[RentRead] | Page[RentRead], summary="Получить историю аренды по ID транспорта")
+async def get_rent_transport_history_by_account_id(transportId: int, user: user_a, db: read_db_dependency, params: Annotated[HistoryQuery, Depends()]):
+    query = rent_history_query(params, transportId=transportId)
+    return await history_response(query, params, db)
 
-@adminrent.post("/Rent", summary="Создать новую аренду с указанием владельца")
+@adminrent.post("/Rent", response_model=RentRead, summary="Создать новую аренду с указанием владельца")
 async def create_rent_by_account_id(data: AdminRentModel, user: user_a, db: db_dependency):
-    rent = create_rent_request(data, user, db)
+    rent = await run_db(db, create_rent_request, data, user)
     return rent
 
-@adminrent.post("/Rent/End/{rentId}", summary="Завершить аренду по ID")
+@adminrent.post("/Rent/End/{rentId}", response_model=RentRead, summary="Завершить аренду по ID")
 async def end_rent_by_account_id(rentId: int, latitude: float, longitude: float, user: user_a, db: db_dependency):
-    rent = end_rent(rentId, latitude, longitude, user, db)
+    rent = await run_db(db, end_rent, rentId, latitude, longitude, user)
     return rent
 
-VALID_RENT_TYPES = ['Minutes', 'Days']
-
-@adminrent.put("/Rent/{rentId}", summary="Обновить аренду по ID")
+@adminrent.put("/Rent/{rentId}", response_model=RentRead, summary="Обновить аренду по ID")
 async def update_rent_by_account_id(rentId: int, data: AdminRentModelWithAll, user: user_a, db: db_dependency):
     try:
-        if not data.rentType in VALID_RENT_TYPES:
-            raise HTTPException(status_code=400, detail="Invalid rent type")
-        rent = FindRent.get_rent_by_id(rentId, db)
-        rent.rentType=data.rentType
-        rent.transportId=data.transportId
-        rent.renter_user_id=data.renter_user_id
-        rent.startTime=data.startTime
-        rent.endTime=data.endTime
-        rent.priceOfUnit=data.priceOfUnit
-        rent.finalPrice=data.finalPrice
-        db.add(rent)
-        db.commit()
-        db.refresh(rent)
-        return rent
+        rent = await run_db(db, FindRent.get_rent_by_id, rentId)
+        return await run_db(db, update_rent, rent, data)
     except Exception as e:
         raise HTTPException(status_code=400, detail=f'{e}')
 
-@adminrent.delete("/Rent/End/{rentId}", summary="Удалить аренду по ID (завершить и удалить из истории)")
+@adminrent.delete("/Rent/End/{rentId}", response_model=RentRead, summary="Удалить аренду по ID (завершить и удалить из истории)")
 async def delete_rent_by_account_id(rentId: int, user: user_a, db: db_dependency):
-    rent = FindRent.get_rent_by_id(rentId, db)
+    rent = await run_db(db, FindRent.get_rent_by_id, rentId)
 
     if rent is None:
         raise HTTPException(status_code=404, detail="Rental not found")
 
-    db.delete(rent)
-    db.commit()
-    return rent
\ No newline at end of file
+    return await run_db(db, delete_entity, rent)
+
+adminanalytics = APIRouter(prefix='/api/Admin/Analytics', tags=["AdminAnalyticsController"], dependencies=[admin_limit])
+
+REVENUE_GROUPS = {'day': RentDaily.day, 'type': RentDaily.transportType, 'owner': RentDaily.owner_id}
+
+# Период по умолчанию — последние 30 дней включая сегодня (UTC)
+def analytics_period(since: date | None, until: date | None):
+    until = until or analytics.today()
+    since = since or until - timedelta(days=29)
+
+    if since > until:
+        raise HTTPException(status_code=400, detail="since must not be after until")
+
+    return since, until
+
+# Читают только сводки rent_daily и fleet_daily, которые пересчитывает analytics.py
+@adminanalytics.get("/Revenue", response_model=list[RevenueRead], summary="Выручка и число аренд по дням, типам транспорта или владельцам")
+async def get_revenue(user: user_a, db: read_db_dependency, since: date = None, until: date = None, groupBy: Literal['day', 'type', 'owner'] = 'day'):
+    since, until = analytics_period(since, until)
+    rows = await run_db(db, FindAnalytics.revenue, since, until, REVENUE_GROUPS[groupBy])
+    return [{'key': row.key, 'rents': row.rents, 'revenue': row.revenue} for row in rows]
+
+@adminanalytics.get("/Utilization", response_model=list[UtilizationRead], summary="Загрузка парка по дням и типам транспорта")
+async def get_utilization(user: user_a, db: read_db_dependency, since: date = None, until: date = None, type: str = None):
+    since, until = analytics_period(since, until)
+    return await run_db(db, analytics.utilization, since, until, type)
+
+@adminanalytics.get("/ActiveRents", response_model=ActiveRentsRead, summary="Активные аренды по типам транспорта")
+async def get_active_rents(user: user_a, db: db_dependency):
+    return await run_db(db, analytics.active_rents)
+
+# После ручной правки старых аренд; за последние дни сводки пересчитываются сами
+@adminanalytics.post("/Refresh", summary="Пересчитать сводки аналитики за период")
+async def refresh_analytics(user: user_a, db: db_dependency, since: date = None, until: date = None):
+    since, until = analytics_period(since, until)
+    return {'days': await run_db(db, analytics.rebuild_range, since, until)}
@@ -1,24 +1,29 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, Request
 
-from database import db_dependency
-from routers.user import user_с, user_a
+import idempotency
+from database import db_dependency, run_db
+from admission import limit
+from idempotency import idempotency_header
+from routers.user import get_current_user_row, user_с, user_a
 from models import FindUser
+from services import add_balance
+from dtos import UserRead
 
-payment = APIRouter(prefix='/api/Payment', tags=["PaymentController"])
+payment = APIRouter(prefix='/api/Payment', tags=["PaymentController"], dependencies=[limit('payment', concurrency=32, rate=5, burst=10)])
 
-@payment.post("/Hesoyam", summary="Увеличить баланс текущего пользователя на 250000")
-async def hesoyam(user: user_с, db: db_dependency):
-    user.balance += 250000
-    db.add(user)
-    db.commit()
-    db.refresh(user)
-    return user
+# С заголовком Idempotency-Key баланс пополняется один раз, повторы получают сохранённый ответ.
+# Пользователь загружается внутри обработчика, чтобы повтор не читал users
+@payment.post("/Hesoyam", response_model=UserRead, summary="Увеличить баланс текущего пользователя на 250000")
+async def hesoyam(request: Request, user: user_с, db: db_dependency, idempotency_key: idempotency_header = None):
+    async def credit():
+        return await run_db(db, add_balance, await get_current_user_row(user, db), 250000)
 
-@payment.post("/Hesoyam/{accountId}", summary="Увеличить баланс пользователя по ID на 250000")
-async def hesoyam(user: user_a, db: db_dependency, accountId: float):
-    user = FindUser.get_user_by_id(accountId, db)
-    user.balance += 250000
-    db.add(user)
-    db.commit()
-    db.refresh(user)
-    return user
\ No newline at end of file
+    return await idempotency.execute(request, idempotency_key, user.id, UserRead, db, credit)
+
+@payment.post("/Hesoyam/{accountId}", response_model=UserRead, summary="Увеличить баланс пользователя по ID на 250000")
+async def hesoyam(request: Request, user: user_a, db: db_dependency, accountId: float, idempotency_key: idempotency_header = None):
+    async def credit():
+        account = await run_db(db, FindUser.get_user_by_id, accountId)
+        return await run_db(db, add_balance, account, 250000)
+
+    return await idempotency.execute(request, idempotency_key, user.id, UserRead, db, credit)
@@ -1,56 +1,117 @@
-from fastapi import APIRouter
-from sqlalchemy import func
+from fastapi import APIRouter, Depends, HTTPException, Request, Response, WebSocket
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from typing import Annotated
 
-from database import db_dependency
+import availability
+import idempotency
+import live
+from database import db_dependency, read_db_dependency, run_db
+from idempotency import idempotency_header
+from admission import limit
+from querystats import query_budget
 from routers.user import user_с
-from models import Transport
-from services import find_rent, create_rent_request, user_rent_history, transport_rent_history, end_rent
-from dtos import RentModel
+from services import list_response, search_available, find_available_transport, quote_candidates, quote_prices, find_quote_prices, find_rent, create_rent_request, user_rent_history, transport_rent_history, end_rent, history_response
+from dtos import RentModel, RentRead, TransportRead, QuoteRequest, TransportQuote, Page, HistoryQuery
 
-rent = APIRouter(prefix='/api/Rent', tags=["RentController"])
+rent = APIRouter(prefix='/api/Rent', tags=["RentController"], dependencies=[limit('rent', concurrency=128, rate=20, burst=40)])
 
-@rent.get("/Transport", summary="Получить доступные транспортные средства для аренды")
+@rent.get("/Transport", response_model=list[TransportRead], dependencies=[query_budget(10)], summary="Получить доступные транспортные средства для аренды")
 async def get_available_rent(
+    request: Request,
     latitude: float = None,
     longitude: float = None,
     radius: float = None,
     type: str = None,
-    db: db_dependency = None):
-    query = db.query(Transport).filter(Transport.canBeRented == True)
+    nearest: int = None,
+    db: read_db_dependency = None):
+    # radius задаётся в метрах, nearest возвращает k ближайших по расстоянию
+    if not availability.ready():
+        available_transport = await run_db(db, find_available_transport, latitude, longitude, radius, type, nearest)
+        return list_response(available_transport)
 
-    if latitude is not None and longitude is not None and radius is not None:
-        query = query.filter(
-            func.power(Transport.latitude - latitude, 2) + func.power(Transport.longitude - longitude, 2) <= func.power(radius, 2))
-        
-    if type is not None:
-        query = query.filter(Transport.transportType == type)
+    # Ответ из снимка в памяти; клиент с тем же ETag получает 304 без тела.
+    # Ранжирование по расстоянию идёт в пуле потоков, не на цикле событий
+    rows = await run_in_threadpool(search_available, availability.available_from_thread, latitude, longitude, radius, type, nearest)
+    body, etag = availability.render(rows)
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
 
-    available_transport = query.all()
-    return available_transport
+    if request.headers.get('if-none-match') == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type='application/json', headers=headers)
 
-@rent.get("/{rentId}", summary="Получить информацию о аренде по ID")
+# Цены для карты: для каждого транспорта и каждой длительности — самый дешёвый тариф.
+# Поиск в радиусе отвечает из снимка доступного транспорта без запросов к БД
+@rent.post("/Quote", response_model=list[TransportQuote], dependencies=[query_budget(1)], summary="Рассчитать цены аренды для набора транспорта и длительностей")
+async def quote_rent(data: QuoteRequest, db: read_db_dependency):
+    if data.transportIds is None and availability.ready():
+        rows = await run_in_threadpool(quote_candidates, data, availability.available_from_thread)
+        return ORJSONResponse(await run_in_threadpool(quote_prices, rows, data.durations))
+
+    return ORJSONResponse(await run_db(db, find_quote_prices, data))
+
+# Подписка на изменения доступного транспорта в области: радиус (latitude, longitude, radius)
+# или прямоугольник (minLatitude, maxLatitude, minLongitude, maxLongitude)
+@rent.get("/Transport/Stream", summary="Поток изменений доступного транспорта (Server-Sent Events)")
+async def stream_available_rent(
+    type: str = None,
+    latitude: float = None,
+    longitude: float = None,
+    radius: float = None,
+    minLatitude: float = None,
+    maxLatitude: float = None,
+    minLongitude: float = None,
+    maxLongitude: float = None):
+    sub = live.subscription(type, latitude, longitude, radius, minLatitude, maxLatitude, minLongitude, maxLongitude)
+    live.check_capacity()
+    return StreamingResponse(live.sse(sub), media_type='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@rent.websocket("/Transport/Live")
+async def live_available_rent(
+    websocket: WebSocket,
+    type: str = None,
+    latitude: float = None,
+    longitude: float = None,
+    radius: float = None,
+    minLatitude: float = None,
+    maxLatitude: float = None,
+    minLongitude: float = None,
+    maxLongitude: float = None):
+    try:
+        sub = live.subscription(type, latitude, longitude, radius, minLatitude, maxLatitude, minLongitude, maxLongitude)
+        live.subscribe(sub)
+    except HTTPException as e:
+        # 1013 — попробовать позже, 1008 — неверные параметры
+        await websocket.close(code=1013 if e.status_code == 503 else 1008, reason=e.detail)
+        return
+
+    await websocket.accept()
+    await live.websocket(websocket, sub)
+
+@rent.get("/{rentId}", response_model=RentRead, dependencies=[query_budget(3)], summary="Получить информацию о аренде по ID")
 async def get_rent(rentId: int, user: user_с, db: db_dependency):
-    rent = find_rent(rentId, user, db)
+    rent = await run_db(db, find_rent, rentId, user)
     return rent
 
-@rent.post("/New/{transportId}", summary="Создать новую аренду")
-async def create_rent(data: RentModel, user: user_с, db: db_dependency):
-    rent = create_rent_request(data, user, db)
-    return rent
+# С заголовком Idempotency-Key повтор запроса возвращает уже созданную аренду; ключ добавляет до трёх запросов к БД.
+# Без RETURNING (не postgres) создание аренды перечитывает цены и аренду — ещё два запроса
+@rent.post("/New/{transportId}", response_model=RentRead, dependencies=[query_budget(8)], summary="Создать новую аренду")
+async def create_rent(request: Request, data: RentModel, user: user_с, db: db_dependency, idempotency_key: idempotency_header = None):
+    return await idempotency.execute(request, idempotency_key, user.id, RentRead, db, lambda: run_db(db, create_rent_request, data, user))
 
-@rent.get("/MyHistory/", summary="Получить историю аренд текущего пользователя")
-async def my_rent(user: user_с, db: db_dependency):
-    rent = user_rent_history(user, db)
-    return rent
+@rent.get("/MyHistory/", response_model=list[RentRead] | Page[RentRead], dependencies=[query_budget(2)], summary="Получить историю аренд текущего пользователя")
+async def my_rent(user: user_с, db: read_db_dependency, params: Annotated[HistoryQuery, Depends()]):
+    query = user_rent_history(user, params)
+    return await history_response(query, params, db)
 
-@rent.get("/TransportHistory/{transportId}", summary="Получить историю аренды транспорта текущего пользователя")
-async def my_transport_rent(transportId: int, user: user_с, db: db_dependency):
-    rent = transport_rent_history(transportId, user, db)
-    return rent
+@rent.get("/TransportHistory/{transportId}", response_model=list[RentRead] | Page[RentRead], dependencies=[query_budget(3)], summary="Получить историю аренды транспорта текущего пользователя")
+async def my_transport_rent(transportId: int, user: user_с, db: read_db_dependency, params: Annotated[HistoryQuery, Depends()]):
+    query = await run_db(db, transport_rent_history, transportId, user, params)
+    return await history_response(query, params, db)
 
-@rent.post("/End/{rentId}", summary="Завершить аренду по ID")
+@rent.post("/End/{rentId}", response_model=RentRead, dependencies=[query_budget(6)], summary="Завершить аренду по ID")
 async def end_my_rent(rentId: int, latitude: float, longitude: float, user: user_с, db: db_dependency):
-    rent = end_rent(rentId, latitude, longitude, user, db)
+    rent = await run_db(db, end_rent, rentId, latitude, longitude, user)
     return rent
 
 
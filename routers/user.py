@@ -3,58 +3,67 @@ from typing import Annotated
 from fastapi.security import OAuth2PasswordRequestForm
 from fastapi.responses import RedirectResponse
 
-from dtos import UserRequest, Token
+from dtos import UserRequest, UserRead, Token, CurrentUser
 from models import User, FindUser
-from database import db_dependency
-from services import get_current_user, update_user, create_user_request, authenticate_user, create_access_token
+from database import db_dependency, run_db
+from admission import limit
+from querystats import query_budget
+from services import get_current_user, sign_out, update_user, create_user_request, authenticate_user, create_access_token, hash, new_password_hash
 
-account = APIRouter(prefix='/api/Account', tags=["AccountController"])
-user_dependency = Annotated[User, Depends(get_current_user)]
+account = APIRouter(prefix='/api/Account', tags=["AccountController"], dependencies=[limit('account', concurrency=64, rate=5, burst=20)])
+user_dependency = Annotated[CurrentUser, Depends(get_current_user)]
 
-# Функция для получения текущего активного пользователя
-async def get_current_active_user(current_user: user_dependency, db: db_dependency):
-    user = FindUser.get_user_by_id(current_user, db)
-
-    if user.disabled:
+# Функция для получения текущего активного пользователя (по claims токена, без запроса к БД)
+async def get_current_active_user(current_user: user_dependency):
+    if current_user.disabled:
         raise HTTPException(status_code=403, detail="Inactive user")
     
-    return user
+    return current_user
 
 # Функция для проверки прав администратора
-async def admin_endpoint(current_user: user_dependency, db: db_dependency):
-    user = FindUser.get_user_by_id(current_user, db)
-
-    if not user.isAdmin:
+async def admin_endpoint(current_user: user_dependency):
+    if not current_user.isAdmin:
         raise HTTPException(status_code=403, detail="You do not have permission")
     
+    return current_user
+
+# Загрузка строки пользователя для обработчиков, которым нужны его данные (например, баланс)
+async def get_current_user_row(current_user: Annotated[CurrentUser, Depends(get_current_active_user)], db: db_dependency):
+    user = await run_db(db, FindUser.get_user_by_id, current_user.id)
+
+    if user is None:
+        raise HTTPException(status_code=401, detail="Could not validate credentials")
+    
     return user
 
 # Зависимости для пользователей с разными правами
-user_с = Annotated[User, Depends(get_current_active_user)]
-user_a = Annotated[User, Depends(admin_endpoint)]
+user_с = Annotated[CurrentUser, Depends(get_current_active_user)]
+user_a = Annotated[CurrentUser, Depends(admin_endpoint)]
+user_row = Annotated[User, Depends(get_current_user_row)]
 
 @account.post('/SignUp', response_model=Token, summary="Регистрация нового пользователя")
 async def create_user(data: UserRequest, db: db_dependency):
-    user = create_user_request(data, db)
+    user = await run_db(db, create_user_request, data, await hash(data.password))
     token = create_access_token(user)
     return Token(access_token=token, token_type='bearer')
 
 @account.post('/SignIn', response_model=Token, summary="Вход в систему (для тестирования воспользуйтесь кнопкой справа)")
 async def login_for_access_token(data: Annotated[OAuth2PasswordRequestForm, Depends()], db: db_dependency):
-    user = authenticate_user(data.username, data.password, db)
+    user = await authenticate_user(data.username, data.password, db)
     token = create_access_token(user)
     return Token(access_token=token, token_type='bearer')
 
-@account.get('/Me', summary="Получить информацию текущем пользователе")
-async def get_current_account(user: user_с):
+@account.get('/Me', response_model=UserRead, dependencies=[query_budget(2)], summary="Получить информацию текущем пользователе")
+async def get_current_account(user: user_row):
     return user
 
-@account.put('/Update', summary="Обновление информации о текущем пользователе")
-async def update_current_account(user: user_с, data: UserRequest, db: db_dependency): 
-    return update_user(user, data, db)
+@account.put('/Update', response_model=UserRead, summary="Обновление информации о текущем пользователе")
+async def update_current_account(user: user_row, data: UserRequest, db: db_dependency): 
+    return await run_db(db, update_user, user, data, await new_password_hash(user, data.password))
 
 @account.post('/SignOut', summary="Выход из системы")
-async def logout(user: user_dependency):
-    # Дополнительные действия, связанные с выходом пользователя, могут быть добавлены здесь.
+async def logout(user: user_dependency, db: db_dependency):
+    # Текущий токен отзывается до своего истечения
+    await run_db(db, sign_out, user)
     e = RedirectResponse(url="/main")
     return e
\ No newline at end of file
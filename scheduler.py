@@ -0,0 +1,120 @@
+from sqlalchemy import select, update, text
+from sqlalchemy.orm import Session
+from datetime import datetime, timezone
+import asyncio
+import heapq
+import logging
+import os
+
+import availability
+from database import run_in_session
+from locks import EXPIRY_LOCK_KEY
+from models import Rent, Transport
+
+logger = logging.getLogger(__name__)
+
+EXPIRY_BATCH = int(os.getenv("EXPIRY_BATCH", "500"))
+# Не реже этого интервала проверяются и аренды, созданные другими воркерами
+EXPIRY_MAX_SLEEP = float(os.getenv("EXPIRY_MAX_SLEEP", "30"))
+
+# Min-куча (время окончания, id аренды) — когда проснуться в следующий раз
+heap: list[tuple[datetime, int]] = []
+loop: asyncio.AbstractEventLoop | None = None
+wakeup: asyncio.Event | None = None
+task: asyncio.Task | None = None
+
+def utc(time: datetime) -> datetime:
+    return time if time.tzinfo is not None else time.replace(tzinfo=timezone.utc)
+
+def push(end_time: datetime, rent_id: int):
+    heapq.heappush(heap, (end_time, rent_id))
+
+    if heap[0][1] == rent_id:
+        wakeup.set()
+
+# Вызывается из сервисов (в том числе из пула потоков) после создания аренды
+def schedule(rent_id: int, end_time: datetime):
+    if loop is None or end_time is None:
+        return
+    loop.call_soon_threadsafe(push, utc(end_time), rent_id)
+
+def load_active(db: Session):
+    return db.execute(select(Rent.endTime, Rent.id).filter(Rent.isActive == True, Rent.endTime != None)).all()
+
+# Освобождает просроченные аренды пачками; возвращает число освобождённых
+def release_expired(now: datetime, db: Session):
+    released = 0
+
+    while True:
+        if db.bind.dialect.name == 'postgresql':
+            locked = db.execute(text('SELECT pg_try_advisory_xact_lock(:key)'), {'key': EXPIRY_LOCK_KEY}).scalar()
+
+            if not locked:
+                db.rollback()
+                return released
+
+        rows = db.execute(
+            select(Rent.id, Rent.transportId)
+            .filter(Rent.isActive == True, Rent.endTime <= now)
+            .limit(EXPIRY_BATCH)
+            .with_for_update(skip_locked=True)).all()
+
+        if not rows:
+            db.rollback()
+            return released
+
+        db.execute(update(Rent).where(Rent.id.in_([row.id for row in rows])).values(isActive=False))
+        db.execute(update(Transport).where(Transport.id.in_([row.transportId for row in rows])).values(canBeRented=True))
+        availability.changed(db, [row.transportId for row in rows])
+        db.commit()
+        released += len(rows)
+
+        if len(rows) < EXPIRY_BATCH:
+            return released
+
+async def run():
+    for end_time, rent_id in await run_in_session(load_active):
+        heap.append((utc(end_time), rent_id))
+    heapq.heapify(heap)
+
+    # stop() сбрасывает loop до отмены: если wait_for потеряет отмену, цикл завершится по этой проверке
+    while loop is not None:
+        now = datetime.now(timezone.utc)
+
+        while heap and heap[0][0] <= now:
+            heapq.heappop(heap)
+
+        try:
+            released = await run_in_session(release_expired, now)
+
+            if released:
+                logger.info("Released %s expired rents", released)
+        except Exception:
+            logger.exception("Rent expiry failed")
+
+        timeout = EXPIRY_MAX_SLEEP
+        if heap:
+            timeout = min(timeout, max(0.0, (heap[0][0] - datetime.now(timezone.utc)).total_seconds()))
+
+        try:
+            await asyncio.wait_for(wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        wakeup.clear()
+
+def start():
+    global loop, wakeup, task
+    loop = asyncio.get_running_loop()
+    wakeup = asyncio.Event()
+    task = loop.create_task(run())
+
+async def stop():
+    global loop
+    loop = None
+
+    if task is not None:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
@@ -1,31 +1,92 @@
 from fastapi.security import OAuth2PasswordBearer
 from fastapi import Depends, HTTPException, status
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from sqlalchemy import delete, insert, literal, or_, select, update
 from sqlalchemy.orm import Session
-from datetime import timedelta, datetime
+from datetime import timedelta, datetime, timezone
 from passlib.context import CryptContext
 from typing import Annotated
 from jose import jwt, JWTError
 from sqlalchemy.exc import IntegrityError
+from concurrent.futures import ThreadPoolExecutor
+from pydantic import ValidationError
+import asyncio
+import base64
+import csv
+import io
+import itertools
+import time
+import orjson
 import os
-
+import uuid
+
+import availability
+import geo
+import idempotency
+import metrics
+import revocation
+import scheduler
+from database import run_cpu, run_db, stream_batches
+from dtos import AdminTransportModel, CurrentUser, HistoryQuery
 from models import User, FindUser, Transport, Rent, FindRent, FindTransport
 
 SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = os.getenv("ALGORITHM")
 ACCESS_TOKEN_EXPIRE = os.getenv("ACCESS_TOKEN_EXPIRE")
 
-bcrypt_context = CryptContext(schemes=['bcrypt'], deprecated='auto')
+# Стоимость bcrypt; хэши с другой стоимостью пересчитываются при входе
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+# Сколько хэшей считается одновременно и сколько запросов может ждать в очереди
+HASH_CONCURRENCY = int(os.getenv("HASH_CONCURRENCY", "2"))
+HASH_QUEUE_LIMIT = int(os.getenv("HASH_QUEUE_LIMIT", "32"))
+
+bcrypt_context = CryptContext(schemes=['bcrypt'], deprecated='auto', bcrypt__default_rounds=BCRYPT_ROUNDS, bcrypt__min_rounds=BCRYPT_ROUNDS, bcrypt__max_rounds=BCRYPT_ROUNDS)
 oauth_bearer = OAuth2PasswordBearer(tokenUrl='api/Account/SignIn')
 
-def verify_password(plain_password, hashed_password):
-    return bcrypt_context.verify(plain_password, hashed_password)
+# bcrypt отпускает GIL, поэтому хватает отдельного пула потоков
+hash_executor = ThreadPoolExecutor(max_workers=HASH_CONCURRENCY, thread_name_prefix='bcrypt')
+hash_pending = 0
+
+def hashing_full() -> bool:
+    return hash_pending >= HASH_CONCURRENCY + HASH_QUEUE_LIMIT
+
+async def run_hashing(fn, *args):
+    global hash_pending
+
+    if hashing_full():
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many authentication requests",
+            headers={"Retry-After": "1"})
+
+    hash_pending += 1
+    submitted = time.perf_counter()
+
+    def timed():
+        return time.perf_counter() - submitted, fn(*args)
+
+    try:
+        waited, result = await asyncio.get_running_loop().run_in_executor(hash_executor, timed)
+    finally:
+        hash_pending -= 1
+
+    metrics.hash_wait.observe(waited)
+    return result
+
+async def verify_password(plain_password, hashed_password):
+    return await run_hashing(bcrypt_context.verify, plain_password, hashed_password)
     
-def hash(password):
-    password = bcrypt_context.hash(password)
+async def hash(password):
+    password = await run_hashing(bcrypt_context.hash, password)
     return password
 
-def create_user_request(data, db: Session):
-    bcrypt_password = hash(data.password)
+# Хеш для обновления аккаунта; None — пароль совпадает с прежним и не меняется
+async def new_password_hash(user: User, password: str):
+    if user is not None and await verify_password(password, user.password):
+        return None
+    return await hash(password)
+
+def create_user_request(data, bcrypt_password: str, db: Session):
     user = User(name=data.name, password=bcrypt_password)
 
     if hasattr(data, 'isAdmin'):
@@ -34,45 +95,86 @@ def create_user_request(data, db: Session):
     if hasattr(data, 'balance'):
         user.balance = data.balance
 
+    if hasattr(data, 'disabled'):
+        user.disabled = data.disabled
+
     db.add(user)
     db.commit()
     db.refresh(user)
     return user
 
-def update_user(user: User, data, db: Session):
+def update_user(user: User, data, bcrypt_password: str | None, db: Session):
+    # Смена пароля, прав или блокировка отзывают ранее выданные токены; имени и баланса в токене нет
+    revoke = bcrypt_password is not None
     user.name = data.name
-    bcrypt_password = bcrypt_context.hash(data.password)
-    user.password = bcrypt_password
+
+    if bcrypt_password is not None:
+        user.password = bcrypt_password
 
     if hasattr(data, 'isAdmin'):
+        revoke = revoke or bool(user.isAdmin) != data.isAdmin
         user.isAdmin = data.isAdmin
 
     if hasattr(data, 'balance'):
         user.balance = data.balance
 
+    if hasattr(data, 'disabled'):
+        revoke = revoke or bool(user.disabled) != data.disabled
+        user.disabled = data.disabled
+
+    if revoke:
+        revoke_user_tokens(user.id, db)
     db.add(user)
     db.commit()
     db.refresh(user)
-    return data
+    return user
+
+def save_entity(entity, db: Session):
+    db.add(entity)
+    db.commit()
+    db.refresh(entity)
+    return entity
 
-def authenticate_user(name: str, password: str, db: Session):    
-    user = FindUser.get_user_by_name(name, db)
+async def authenticate_user(name: str, password: str, db: Session):    
+    user = await run_db(db, FindUser.get_user_by_name, name)
 
-    if not user or not verify_password(password, user.password):
+    if not user or not await verify_password(password, user.password):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
             headers={"WWW-Authenticate": "Bearer"})
+
+    # Перехеширование под новые параметры попутное: при полной очереди вход не отклоняется,
+    # а перехеширование откладывается до следующего входа
+    if bcrypt_context.needs_update(user.password) and not hashing_full():
+        user.password = await hash(password)
+        await run_db(db, save_entity, user)
     
     return user
 
+# iat с миллисекундами: токен, выданный сразу после отзыва всех токенов пользователя, остаётся действительным
 def create_access_token(user: User):
-    encode = {'id': user.id}
+    encode = {'id': user.id, 'admin': bool(user.isAdmin), 'disabled': bool(user.disabled), 'jti': uuid.uuid4().hex, 'iat': round(time.time(), 3)}
     expires = datetime.utcnow() + timedelta(minutes=int(ACCESS_TOKEN_EXPIRE))
     encode.update({"exp": expires})
     token = jwt.encode(encode, SECRET_KEY, algorithm=ALGORITHM)
     return token
 
+def token_lifetime() -> timedelta:
+    return timedelta(minutes=int(ACCESS_TOKEN_EXPIRE))
+
+# Все токены пользователя, выданные до этого момента; отметка нужна, пока живут такие токены
+def revoke_user_tokens(user_id: int, db: Session):
+    revocation.revoke(db, datetime.now(timezone.utc) + token_lifetime(), user_id=user_id)
+
+def sign_out(user: CurrentUser, db: Session):
+    # Токены, выданные до появления jti, отозвать по одному нельзя — они истекут сами
+    if user.jti is None:
+        return
+
+    revocation.revoke(db, datetime.fromtimestamp(user.exp, timezone.utc), jti=user.jti)
+    db.commit()
+
 async def get_current_user(token: Annotated[str, Depends(oauth_bearer)]):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -84,11 +186,43 @@ async def get_current_user(token: Annotated[str, Depends(oauth_bearer)]):
 
         if id is None:
             raise credentials_exception
-        
-        return id
     except JWTError:
         raise credentials_exception
 
+    # Отозванный токен: выход, смена пароля или прав, блокировка, удаление пользователя
+    if revocation.is_revoked(payload):
+        raise credentials_exception
+
+    return CurrentUser(id=id, isAdmin=payload.get('admin', False), disabled=payload.get('disabled', False), jti=payload.get('jti'), exp=payload.get('exp'))
+
+# Курсор постраничной выдачи: непрозрачная для клиента строка с id последней записи
+def encode_cursor(id: int) -> str:
+    return base64.urlsafe_b64encode(str(id).encode()).decode().rstrip('=')
+
+def decode_cursor(cursor: str) -> int:
+    if not cursor:
+        return 0
+
+    try:
+        return int(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode())
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def cursor_page(items: list, count: int):
+    next_cursor = None
+
+    if items and len(items) == count:
+        last = items[-1]
+        next_cursor = encode_cursor(last["id"] if isinstance(last, dict) else last.id)
+
+    return {"items": items, "next_cursor": next_cursor}
+
+# Списки отдаются прямо из строк выборки колонок: orjson без ORM-объектов и jsonable_encoder.
+# С count ответ оборачивается в страницу с next_cursor.
+def list_response(rows, count: int = None):
+    items = [dict(row._mapping) for row in rows]
+    return ORJSONResponse(cursor_page(items, count) if count is not None else items)
+
 VALID_TRANSPORT_TYPES = ['Car', 'Bike', 'Scooter']
 
 def create_transport_request(data, db: Session, user_id: int = 0):
@@ -98,12 +232,14 @@ def create_transport_request(data, db: Session, user_id: int = 0):
         if not transport_type in VALID_TRANSPORT_TYPES:
             raise HTTPException(status_code=400, detail="Invalid transport type")
         
-        transport = Transport(user_id=user_id, canBeRented=data.canBeRented, transportType=transport_type, model=data.model, color=data.color, identifier=data.identifier, description=data.description, latitude=data.latitude, longitude=data.longitude, minutePrice=data.minutePrice, dayPrice=data.dayPrice)
+        transport = Transport(user_id=user_id, canBeRented=data.canBeRented, transportType=transport_type, model=data.model, color=data.color, identifier=data.identifier, description=data.description, latitude=data.latitude, longitude=data.longitude, geohash=geo.encode(data.latitude, data.longitude), minutePrice=data.minutePrice, dayPrice=data.dayPrice)
         
         if hasattr(data, 'ownerId'):
             transport.user_id = data.ownerId
 
         db.add(transport)
+        db.flush()
+        availability.changed(db, [transport.id])
         db.commit()
         db.refresh(transport)
         return transport
@@ -128,28 +264,239 @@ def update_transport(transport: Transport, data, db: Session):
         transport.description=data.description
         transport.latitude=data.latitude
         transport.longitude=data.longitude
+        transport.geohash=geo.encode(data.latitude, data.longitude)
         transport.minutePrice=data.minutePrice
         transport.dayPrice=data.dayPrice
         db.add(transport)
+        availability.changed(db, [transport.id])
         db.commit()
         db.refresh(transport)
         return transport
     except IntegrityError as e:
         raise HTTPException(status_code=400, detail=f"{e}")
     
+NEAREST_START_PRECISION = 6
+
+def rank_by_distance(transports, latitude: float, longitude: float):
+    ranked = [(geo.haversine(latitude, longitude, t.latitude, t.longitude), t) for t in transports]
+    ranked.sort(key=lambda item: item[0])
+    return ranked
+
+# available(type, cells) — источник доступного транспорта: FindTransport.get_available или снимок в памяти
+def search_available(available, latitude: float, longitude: float, radius: float, type: str, nearest: int):
+    if latitude is None or longitude is None:
+        if nearest is not None:
+            raise HTTPException(status_code=400, detail="Nearest search requires latitude and longitude")
+        return available(type, None)
+
+    if nearest is not None and nearest < 1:
+        raise HTTPException(status_code=400, detail="Nearest must be positive")
+
+    if radius is not None:
+        cells = geo.cells_for_radius(latitude, longitude, radius)
+        min_lat, max_lat, min_lon, max_lon = geo.bounding_box(latitude, longitude, radius)
+        candidates = [t for t in available(type, cells) if min_lat <= t.latitude <= max_lat and min_lon <= t.longitude <= max_lon]
+        ranked = run_cpu(rank_by_distance, candidates, latitude, longitude)
+        found = [t for distance, t in ranked if distance <= radius]
+        return found[:nearest] if nearest else found
+
+    if nearest is None:
+        return available(type, None)
+
+    # Расширяем окрестность, пока k-й ближайший не окажется внутри гарантированно просмотренной зоны
+    for precision in range(NEAREST_START_PRECISION, 0, -1):
+        cells = geo.neighbours(latitude, longitude, precision)
+        ranked = run_cpu(rank_by_distance, available(type, cells), latitude, longitude)
+
+        if len(ranked) >= nearest:
+            distance = ranked[nearest - 1][0]
+            if distance <= geo.cell_size_meters(latitude, precision, distance):
+                return [t for _, t in ranked[:nearest]]
+
+    ranked = run_cpu(rank_by_distance, available(type, None), latitude, longitude)
+    return [t for _, t in ranked[:nearest]]
+
+def find_available_transport(latitude: float, longitude: float, radius: float, type: str, nearest: int, db: Session):
+    return search_available(lambda type, cells: FindTransport.get_available(type, cells, db), latitude, longitude, radius, type, nearest)
+
 def delete_transport(transport: Transport, db: Session):
-    data = db.query(Transport).filter(Transport.id == transport.id).delete()
+    data = db.execute(delete(Transport).where(Transport.id == transport.id)).rowcount
+    availability.changed(db, [transport.id])
     db.commit()
     return data
 
-def is_renter(user: User, rent: Rent):
+IMPORT_CHUNK = int(os.getenv("IMPORT_CHUNK", "1000"))
+# Ошибок в ответе не больше этого числа, остальные только считаются
+IMPORT_MAX_ERRORS = 1000
+
+# Строки файла импорта: (номер строки, словарь полей или ошибка разбора)
+def import_records(file, format: str):
+    if format == 'ndjson':
+        for number, line in enumerate(file, 1):
+            if not line.strip():
+                continue
+
+            try:
+                yield number, orjson.loads(line)
+            except orjson.JSONDecodeError:
+                yield number, None
+        return
+
+    reader = csv.DictReader(io.TextIOWrapper(file, encoding='utf-8-sig', newline=''))
+    for record in reader:
+        yield reader.line_num, record
+
+class ImportReport:
+    def __init__(self):
+        self.imported = 0
+        self.failed = 0
+        self.errors = []
+        self.identifiers = set()
+
+    def fail(self, number: int, error: str):
+        self.failed += 1
+
+        if len(self.errors) < IMPORT_MAX_ERRORS:
+            self.errors.append({'row': number, 'error': error})
+
+def validation_message(error: ValidationError):
+    return '; '.join(f"{'.'.join(map(str, item['loc']))}: {item['msg']}" for item in error.errors())
+
+# Следующие IMPORT_CHUNK строк файла, проверенные моделью: [(номер строки, модель, значения для вставки)];
+# None — файл закончился. Только разбор и проверка, без запросов, поэтому вызывается через run_cpu
+def read_chunk(records, report: ImportReport):
+    chunk = list(itertools.islice(records, IMPORT_CHUNK))
+    valid = []
+
+    if not chunk:
+        return None
+
+    for number, record in chunk:
+        if not isinstance(record, dict):
+            report.fail(number, "Invalid JSON object")
+            continue
+
+        try:
+            data = AdminTransportModel.model_validate(record)
+        except ValidationError as e:
+            report.fail(number, validation_message(e))
+            continue
+
+        if data.transportType not in VALID_TRANSPORT_TYPES:
+            report.fail(number, "Invalid transport type")
+        elif data.identifier in report.identifiers:
+            report.fail(number, "Duplicate identifier in file")
+        else:
+            report.identifiers.add(data.identifier)
+            values = data.model_dump(exclude={'ownerId'})
+            valid.append((number, data, dict(values, user_id=data.ownerId, geohash=geo.encode(data.latitude, data.longitude))))
+
+    return valid
+
+# Проверенная пачка: два запроса на дубликаты и владельцев, затем один executemany.
+# Если параллельный запрос успел вставить тот же identifier, пачка повторяется построчно под savepoint.
+def import_chunk(valid: list, report: ImportReport, db: Session):
+    if not valid:
+        return
+
+    existing = set(db.execute(select(Transport.identifier).filter(Transport.identifier.in_([data.identifier for _, data, _ in valid]))).scalars())
+    owners = set(db.execute(select(User.id).filter(User.id.in_({data.ownerId for _, data, _ in valid}))).scalars())
+    rows = []
+
+    for number, data, values in valid:
+        if data.identifier in existing:
+            report.fail(number, "Transport with this identifier already exists")
+        elif data.ownerId not in owners:
+            report.fail(number, "Owner not found")
+        else:
+            rows.append((number, values))
+
+    if not rows:
+        return
+
+    try:
+        with db.begin_nested():
+            db.execute(insert(Transport), [values for _, values in rows])
+        report.imported += len(rows)
+    except IntegrityError:
+        for number, values in rows:
+            try:
+                with db.begin_nested():
+                    db.execute(insert(Transport), values)
+                report.imported += 1
+            except IntegrityError:
+                report.fail(number, "Transport with this identifier already exists")
+
+# Импорт идёт одной транзакцией; ошибочные строки пропускаются и попадают в отчёт.
+# Чтение файла и проверка строк идут в пуле потоков, в транзакции — только запросы
+def import_transports(file, format: str, db: Session):
+    report = ImportReport()
+    records = import_records(file, format)
+
+    while True:
+        valid = run_cpu(read_chunk, records, report)
+
+        if valid is None:
+            break
+
+        import_chunk(valid, report, db)
+
+    # id вставленных строк неизвестны (executemany без RETURNING), поэтому снимок перечитывается целиком
+    if report.imported:
+        availability.changed(db)
+
+    db.commit()
+    return {'imported': report.imported, 'failed': report.failed, 'errors': sorted(report.errors, key=lambda error: error['row'])}
+
+# Колонки выгрузки совпадают с полями импорта, поэтому выгруженный файл можно загрузить обратно
+EXPORT_COLUMNS = [Transport.id, Transport.user_id.label('ownerId'), Transport.canBeRented, Transport.transportType, Transport.model, Transport.color,
+                  Transport.identifier, Transport.description, Transport.latitude, Transport.longitude, Transport.minutePrice, Transport.dayPrice]
+
+async def csv_lines(db, query):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([column.name for column in query.selected_columns])
+
+    async for rows in stream_batches(db, query):
+        writer.writerows(rows)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+def export_transports(db):
+    query = select(*EXPORT_COLUMNS).order_by(Transport.id)
+    return StreamingResponse(csv_lines(db, query), media_type="text/csv", headers={"Content-Disposition": 'attachment; filename="transport.csv"'})
+
+def delete_entity(entity, db: Session):
+    if isinstance(entity, Transport):
+        availability.changed(db, [entity.id])
+
+    if isinstance(entity, User):
+        revoke_user_tokens(entity.id, db)
+
+    db.delete(entity)
+    db.commit()
+    return entity
+
+def add_balance(user: User, amount: float, db: Session):
+    user.balance += amount
+    db.add(user)
+    idempotency.stage(db, user)
+    db.commit()
+    db.refresh(user)
+    return user
+
+def is_renter(user: CurrentUser, rent: Rent):
     return user.id == rent.renter_user_id
 
-def is_owner(user: User, transport_id: int, db: Session):
+def is_owner(user: CurrentUser, transport_id: int, db: Session):
     transport = FindTransport.get_transport_by_id(transport_id, db)
     return transport and user.id == transport.user_id
 
-def find_rent(rentId: int, user: User, db: Session):
+def find_rent(rentId: int, user: CurrentUser, db: Session):
     rent = FindRent.get_rent_by_id(rentId, db)
 
     if not rent:
@@ -160,64 +507,213 @@ def find_rent(rentId: int, user: User, db: Session):
     
     return rent
 
-def create_rent_request(data, user: User, db: Session):
-    transport = FindTransport.get_transport_by_id(data.transportId, db)
+VALID_RENT_TYPES = ['Minutes', 'Days']
 
-    if not transport:
-        raise HTTPException(status_code=404, detail="Transport not found")
-    
-    if not transport.canBeRented:
-        raise HTTPException(status_code=400, detail="Transport is rented")
-    
-    time = datetime.now()
-    rent = Rent(rentType=data.rentType, transportId=data.transportId)
+# Цена аренды: (цена единицы, итоговая цена, длительность)
+def rent_price(rentType: str, duration: int, minutePrice: float, dayPrice: float):
+    if rentType == 'Minutes':
+        priceOfUnit, length = minutePrice, timedelta(minutes=duration)
+    elif rentType == 'Days':
+        priceOfUnit, length = dayPrice, timedelta(days=duration)
+    else:
+        raise HTTPException(status_code=400, detail="Invalid rent type")
+
+    if priceOfUnit is None:
+        raise HTTPException(status_code=400, detail="Transport has no price for this rent type")
+
+    return priceOfUnit, priceOfUnit * duration, length
+
+MINUTES_PER_DAY = 24 * 60
+QUOTE_MAX_TRANSPORTS = 1000
+
+# Цены для всего транспорта сразу: по каждой длительности один проход по столбцам цен,
+# из поминутного и посуточного (целые сутки с округлением вверх) тарифов берётся более дешёвый.
+# Считается так же, как rent_price при создании аренды; ничего не меняет.
+def quote_prices(rows, durations: list[int]):
+    minute_prices = [row.minutePrice for row in rows]
+    day_prices = [row.dayPrice for row in rows]
+    columns = []
+
+    for minutes in durations:
+        days = -(-minutes // MINUTES_PER_DAY)
+        column = []
+
+        for minute_price, day_price in zip(minute_prices, day_prices):
+            by_minutes = minute_price * minutes if minute_price is not None else None
+            by_days = day_price * days if day_price is not None else None
+
+            if by_days is not None and (by_minutes is None or by_days < by_minutes):
+                column.append({'minutes': minutes, 'rentType': 'Days', 'duration': days, 'priceOfUnit': day_price, 'finalPrice': by_days})
+            elif by_minutes is not None:
+                column.append({'minutes': minutes, 'rentType': 'Minutes', 'duration': minutes, 'priceOfUnit': minute_price, 'finalPrice': by_minutes})
+            else:
+                column.append(None)
+
+        columns.append(column)
+
+    return [{'transportId': row.id, 'canBeRented': row.canBeRented, 'quotes': list(quotes)} for row, *quotes in zip(rows, *columns)]
+
+# Транспорт для расчёта: по id — одним запросом цен (в порядке запроса, неизвестные id пропускаются),
+# иначе QUOTE_MAX_TRANSPORTS ближайших доступных в радиусе тем же поиском, что и /api/Rent/Transport
+def quote_candidates(data, available):
+    if data.transportIds is not None:
+        return None
+
+    if data.latitude is None or data.longitude is None or data.radius is None:
+        raise HTTPException(status_code=400, detail="Quote requires transportIds or latitude, longitude and radius")
+    if data.radius <= 0:
+        raise HTTPException(status_code=400, detail="Radius must be positive")
+
+    return search_available(available, data.latitude, data.longitude, data.radius, data.type, QUOTE_MAX_TRANSPORTS)
+
+def find_quote_prices(data, db: Session):
+    rows = quote_candidates(data, lambda type, cells: FindTransport.get_available(type, cells, db))
+
+    if rows is None:
+        found = {row.id: row for row in FindTransport.get_prices(data.transportIds, db)}
+        rows = [found[id] for id in dict.fromkeys(data.transportIds) if id in found]
+
+    return run_cpu(quote_prices, rows, data.durations)
+
+# Аренда создаётся двумя условными запросами в одной транзакции:
+# захват транспорта (UPDATE ... WHERE canBeRented RETURNING цены) и
+# списание баланса вместе со вставкой аренды (UPDATE users в CTE + INSERT ... RETURNING).
+# Из конкурирующих запросов на один транспорт захват удаётся только одному.
+def create_rent_request(data, user: CurrentUser, db: Session):
+    if not data.rentType in VALID_RENT_TYPES:
+        raise HTTPException(status_code=400, detail="Invalid rent type")
+
+    if data.duration < 0:
+        raise HTTPException(status_code=400, detail="Invalid duration")
+
+    claim = update(Transport).where(Transport.id == data.transportId, Transport.canBeRented == True)
 
     if hasattr(data, "renter_user_id"):
-        rent.renter_user_id=data.renter_user_id
+        renter_user_id = data.renter_user_id
     else:
-        if is_owner(user, data.transportId, db):
-            raise HTTPException(status_code=400, detail="You cannot rent your own transport")
-        rent.renter_user_id=user.id
-    
-    rent.startTime = time.strftime("%Y-%m-%d %H:%M:%S")
-    
-    if data.rentType == 'Minutes':
-        rent.endTime = (time + timedelta(minutes=data.duration)).strftime("%Y-%m-%d %H:%M:%S")
-        rent.priceOfUnit = transport.minutePrice
-        rent.finalPrice = transport.minutePrice * data.duration
-    elif data.rentType == 'Days':
-        rent.endTime = (time + timedelta(days=data.duration)).strftime("%Y-%m-%d %H:%M:%S")
-        rent.priceOfUnit = transport.dayPrice
-        rent.finalPrice = transport.dayPrice * data.duration
+        renter_user_id = user.id
+        claim = claim.where(or_(Transport.user_id == None, Transport.user_id != user.id))
+
+    # RETURNING есть только у postgres; на остальных БД тот же условный UPDATE, а цены перечитываются
+    # в этой же транзакции после успешного захвата
+    postgres = db.bind.dialect.name == 'postgresql'
+    claim = claim.values(canBeRented=False)
+
+    if postgres:
+        claimed = db.execute(claim.returning(Transport.minutePrice, Transport.dayPrice)).first()
     else:
-        raise HTTPException(status_code=400, detail="Invalid rent type")
-    
-    if user.balance < rent.finalPrice:
-        raise HTTPException(status_code=400, detail="Insufficient balance")
+        claimed = FindTransport.get_prices([data.transportId], db)[0] if db.execute(claim).rowcount == 1 else None
 
-    user.balance -= rent.finalPrice
-    transport.canBeRented = False
+    if claimed is None:
+        db.rollback()
+        transport = FindTransport.get_transport_by_id(data.transportId, db)
 
-    db.add(rent)
-    db.add(transport)
+        if not transport:
+            raise HTTPException(status_code=404, detail="Transport not found")
+
+        if not transport.canBeRented:
+            raise HTTPException(status_code=400, detail="Transport is rented")
+
+        raise HTTPException(status_code=400, detail="You cannot rent your own transport")
+
+    try:
+        priceOfUnit, finalPrice, length = rent_price(data.rentType, data.duration, claimed.minutePrice, claimed.dayPrice)
+    except HTTPException:
+        db.rollback()
+        raise
+
+    time = datetime.now(timezone.utc)
+    debit = (update(User)
+        .where(User.id == user.id, User.balance >= finalPrice)
+        .values(balance=User.balance - finalPrice)
+        .execution_options(synchronize_session=False))
+    values = {
+        'rentType': data.rentType,
+        'transportId': data.transportId,
+        'renter_user_id': renter_user_id,
+        'startTime': time,
+        'endTime': time + length,
+        'priceOfUnit': priceOfUnit,
+        'finalPrice': finalPrice,
+        'isActive': True,
+    }
+    columns = Rent.__table__.c
+
+    if postgres:
+        # Списание и вставка одним запросом: аренда создаётся, только если UPDATE списал деньги
+        paid = debit.returning(User.id).cte('paid')
+        source = select(*[literal(value, columns[name].type) for name, value in values.items()]).select_from(paid)
+        rent = db.execute(insert(Rent).from_select(list(values), source).returning(*columns)).first()
+    elif db.execute(debit).rowcount == 1:
+        rent_id = db.execute(insert(Rent).values(values)).inserted_primary_key[0]
+        rent = db.execute(select(*columns).where(columns.id == rent_id)).first()
+    else:
+        rent = None
+
+    if rent is None:
+        db.rollback()
+        raise HTTPException(status_code=400, detail="Insufficient balance")
+
+    availability.changed(db, [data.transportId])
+    idempotency.stage(db, dict(rent._mapping))
     db.commit()
-    db.refresh(rent)
-    db.refresh(transport)
-    return rent
+    scheduler.schedule(rent.id, rent.endTime)
+    return dict(rent._mapping)
     
-def user_rent_history(user: User, db: Session):
-    rent = FindRent.get_rent_by_user_id(user.id, db)
-    return rent
+HISTORY_PAGE_LIMIT = 1000
 
-def transport_rent_history(transportId: int, user: User, db: Session):
-    rent = FindRent.get_rent_by_transport_id_and_user_id(transportId, user.id, db)
+# Время без часового пояса считается UTC (так же его возвращает sqlite)
+def as_utc(time: datetime):
+    if time is None or time.tzinfo is not None:
+        return time
+    return time.replace(tzinfo=timezone.utc)
 
-    if not rent:
+def rent_history_query(params: HistoryQuery, **filters):
+    return FindRent.history(**filters, since=as_utc(params.since), until=as_utc(params.until), after=decode_cursor(params.cursor))
+
+def user_rent_history(user: CurrentUser, params: HistoryQuery):
+    return rent_history_query(params, renter_user_id=user.id)
+
+def transport_rent_history(transportId: int, user: CurrentUser, params: HistoryQuery, db: Session):
+    if not is_owner(user, transportId, db):
         raise HTTPException(status_code=400, detail="You cannot see someone else car")
 
-    return rent
+    return rent_history_query(params, transportId=transportId)
+
+def fetch_rows(query, db: Session):
+    return db.execute(query).all()
+
+async def ndjson_lines(db, query):
+    async for rows in stream_batches(db, query):
+        yield b"".join(orjson.dumps(dict(row._mapping)) + b"\n" for row in rows)
+
+# Тот же поток одним JSON-массивом
+async def json_array(db, query):
+    separator = b"["
+
+    async for rows in stream_batches(db, query):
+        yield separator + b",".join(orjson.dumps(dict(row._mapping)) for row in rows)
+        separator = b","
 
-def end_rent(rentId: int, latitude: float, longitude: float, user: User, db: Session):
+    yield b"]" if separator == b"," else b"[]"
+
+# json с cursor — страница не больше HISTORY_PAGE_LIMIT строк вместе с next_cursor; без cursor — вся история списком,
+# как раньше (клиенты переходят на страницы, передав cursor, для первой страницы пустой). Список и ndjson
+# идут потоком без накопления в памяти
+async def history_response(query, params: HistoryQuery, db: Session):
+    if params.format == 'ndjson':
+        return StreamingResponse(ndjson_lines(db, query), media_type="application/x-ndjson")
+
+    if params.cursor is None:
+        return StreamingResponse(json_array(db, query), media_type="application/json")
+
+    if not 1 <= params.count <= HISTORY_PAGE_LIMIT:
+        raise HTTPException(status_code=400, detail=f"Count must be between 1 and {HISTORY_PAGE_LIMIT}")
+
+    rows = await run_db(db, fetch_rows, query.limit(params.count))
+    return list_response(rows, params.count)
+
+def end_rent(rentId: int, latitude: float, longitude: float, user: CurrentUser, db: Session):
     rent = FindRent.get_rent_by_id(rentId, db)
 
     if not rent:
@@ -227,20 +723,42 @@ def end_rent(rentId: int, latitude: float, longitude: float, user: User, db: Ses
         if not rent.renter_user_id == user.id:
             raise HTTPException(status_code=403, detail="You do not have permission")
     
-    time = datetime.now()
+    time = datetime.now(timezone.utc)
 
-    if time > datetime.strptime(rent.endTime, "%Y-%m-%d %H:%M:%S"):
+    if not rent.isActive or time > as_utc(rent.endTime):
         raise HTTPException(status_code=400, detail="Rental has already ended")
     
-    rent.endTime = time.strftime("%Y-%m-%d %H:%M:%S")
+    rent.endTime = time
+    rent.isActive = False
 
     transport = FindTransport.get_transport_by_id(rent.transportId, db)
     transport.latitude = latitude
     transport.longitude = longitude
+    transport.geohash = geo.encode(latitude, longitude)
     transport.canBeRented = True
     db.add(rent)
     db.add(transport)
+    availability.changed(db, [transport.id])
     db.commit()
     db.refresh(rent)
-    db.refresh(transport)
-    return rent
\ No newline at end of file
+    return rent
+
+def update_rent(rent: Rent, data, db: Session):
+    if not data.rentType in VALID_RENT_TYPES:
+        raise HTTPException(status_code=400, detail="Invalid rent type")
+
+    rent.rentType=data.rentType
+    rent.transportId=data.transportId
+    rent.renter_user_id=data.renter_user_id
+    rent.startTime=as_utc(data.startTime)
+    rent.endTime=as_utc(data.endTime)
+    rent.priceOfUnit=data.priceOfUnit
+    rent.finalPrice=data.finalPrice
+    db.add(rent)
+    db.commit()
+    db.refresh(rent)
+
+    if rent.isActive:
+        scheduler.schedule(rent.id, rent.endTime)
+
+    return rent
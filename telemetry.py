@@ -0,0 +1,154 @@
+from sqlalchemy import select, text
+from sqlalchemy.orm import Session
+from functools import lru_cache
+import asyncio
+import logging
+import os
+import time
+
+import availability
+import geo
+import metrics
+from database import run_in_session
+from models import Transport
+from scheduler import utc
+
+logger = logging.getLogger(__name__)
+
+# Телеметрия транспорта: точки копятся в памяти воркера (для каждого транспорта — только последняя)
+# и раз в TELEMETRY_FLUSH_INTERVAL секунд записываются в БД одним UPDATE ... FROM (VALUES ...)
+TELEMETRY_FLUSH_INTERVAL = float(os.getenv("TELEMETRY_FLUSH_INTERVAL", "1"))
+TELEMETRY_FLUSH_CHUNK = int(os.getenv("TELEMETRY_FLUSH_CHUNK", "1000"))
+# Предел числа транспортов в буфере; точки сверх него отбрасываются до следующей записи
+TELEMETRY_MAX_VEHICLES = int(os.getenv("TELEMETRY_MAX_VEHICLES", "100000"))
+TELEMETRY_MAX_BATCH = int(os.getenv("TELEMETRY_MAX_BATCH", "5000"))
+
+# identifier -> (ts, latitude, longitude), ещё не записанные в БД
+buffer: dict[str, tuple] = {}
+# Момент поступления самой старой точки в буфере — для задержки записи
+oldest: float | None = None
+# identifier -> ts последней принятой точки: точка старше уже принятой отбрасывается.
+# Только в пределах воркера; при переполнении словарь очищается целиком.
+latest: dict[str, object] = {}
+
+task: asyncio.Task | None = None
+stopping: asyncio.Event | None = None
+
+def accept(points) -> tuple[int, int]:
+    global oldest
+    accepted = dropped = 0
+
+    if len(latest) >= TELEMETRY_MAX_VEHICLES:
+        latest.clear()
+
+    for point in points:
+        ts = utc(point.ts)
+        seen = latest.get(point.identifier)
+
+        if seen is not None and ts < seen:
+            dropped += 1
+            continue
+        if point.identifier not in buffer and len(buffer) >= TELEMETRY_MAX_VEHICLES:
+            dropped += 1
+            continue
+
+        buffer[point.identifier] = (ts, point.latitude, point.longitude)
+        latest[point.identifier] = ts
+        accepted += 1
+
+    if buffer and oldest is None:
+        oldest = time.perf_counter()
+
+    metrics.telemetry_points.inc(accepted)
+    metrics.telemetry_dropped.inc(dropped)
+    metrics.telemetry_buffered.value = len(buffer)
+    return accepted, dropped
+
+# Разбор текста с тысячами параметров заметно дороже самого UPDATE, поэтому запрос строится один раз на размер пачки.
+# Типы указаны явно: asyncpg иначе считает параметры в VALUES текстом.
+@lru_cache(maxsize=4)
+def update_statement(size: int):
+    rows = ', '.join(
+        f'(CAST(:i{n} AS VARCHAR), CAST(:a{n} AS DOUBLE PRECISION), CAST(:o{n} AS DOUBLE PRECISION), CAST(:g{n} AS VARCHAR))'
+        for n in range(size))
+    return text(
+        'UPDATE transport SET latitude = v.latitude, longitude = v.longitude, geohash = v.geohash '
+        f'FROM (VALUES {rows}) AS v (identifier, latitude, longitude, geohash) '
+        'WHERE transport.identifier = v.identifier '
+        'AND (transport.latitude, transport.longitude) IS DISTINCT FROM (v.latitude, v.longitude) '
+        'RETURNING transport.id')
+
+# Записывает позиции пачками; возвращает число транспортов с новой позицией
+def update_positions(points: list[tuple], db: Session):
+    changed = []
+
+    for start in range(0, len(points), TELEMETRY_FLUSH_CHUNK):
+        chunk = points[start:start + TELEMETRY_FLUSH_CHUNK]
+        params = {}
+
+        for n, (identifier, latitude, longitude) in enumerate(chunk):
+            params.update({f'i{n}': identifier, f'a{n}': latitude, f'o{n}': longitude, f'g{n}': geo.encode(latitude, longitude)})
+
+        if db.bind.dialect.name == 'postgresql':
+            changed += db.execute(update_statement(len(chunk)), params).scalars().all()
+        else:
+            # В sqlite нет VALUES с именами колонок во FROM — построчный executemany
+            db.execute(
+                text('UPDATE transport SET latitude = :latitude, longitude = :longitude, geohash = :geohash WHERE identifier = :identifier'),
+                [{'identifier': identifier, 'latitude': latitude, 'longitude': longitude, 'geohash': params[f'g{n}']}
+                 for n, (identifier, latitude, longitude) in enumerate(chunk)])
+            changed += db.execute(select(Transport.id).filter(Transport.identifier.in_([point[0] for point in chunk]))).scalars().all()
+
+    if changed:
+        availability.changed(db, changed)
+
+    db.commit()
+    return len(changed)
+
+async def flush():
+    global buffer, oldest
+
+    if not buffer:
+        return
+
+    pending, received = buffer, oldest
+    buffer, oldest = {}, None
+    # Одинаковый порядок строк во всех воркерах, чтобы параллельные UPDATE не брали блокировки встречно
+    points = sorted((identifier, latitude, longitude) for identifier, (_, latitude, longitude) in pending.items())
+
+    try:
+        await run_in_session(update_positions, points)
+    except Exception:
+        logger.exception("Telemetry flush failed, %d points kept for retry", len(pending))
+
+        # Точки, пришедшие во время записи, новее — возвращаются только остальные
+        for identifier, value in pending.items():
+            buffer.setdefault(identifier, value)
+        oldest = received
+        metrics.telemetry_buffered.value = len(buffer)
+        return
+
+    metrics.telemetry_flush_lag.observe(time.perf_counter() - received)
+    metrics.telemetry_buffered.value = len(buffer)
+
+async def run():
+    while not stopping.is_set():
+        try:
+            await asyncio.wait_for(stopping.wait(), TELEMETRY_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        await flush()
+
+def start():
+    global task, stopping
+    stopping = asyncio.Event()
+    task = asyncio.get_running_loop().create_task(run())
+
+# Задача не отменяется посреди записи: после сигнала она записывает остаток буфера и завершается
+async def stop():
+    global task
+
+    if task is not None:
+        stopping.set()
+        await task
+        task = None